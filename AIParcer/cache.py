@@ -0,0 +1,162 @@
+import os, json, time, hashlib, logging, threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+from sqlalchemy import MetaData, Table, Column, String, Text, Float, select, delete, func
+from config import metrics
+
+# 同じ画像の再投稿や Slack の再送で Gemini を呼び直さないための解析結果キャッシュ。
+# メモリ上の LRU を1段目、DATABASE_URL の DB を2段目（任意）として使う。
+
+def cache_key(image_bytes: bytes, model_name: str, prompt_version: str) -> str:
+  h = hashlib.sha256()
+  h.update(model_name.encode())
+  h.update(b"\0")
+  h.update(prompt_version.encode())
+  h.update(b"\0")
+  h.update(image_bytes)
+  return h.hexdigest()
+
+class MemoryCache:
+  """TTL 付き LRU。max_entries を超えたら最も古く使われたものから捨てる。"""
+
+  def __init__(self, max_entries: int = 256, ttl_seconds: float = 7 * 24 * 3600):
+    self.max_entries = max_entries
+    self.ttl_seconds = ttl_seconds
+    self._lock = threading.Lock()
+    self._items = OrderedDict()  # key -> (stored_at, value)
+
+  def get(self, key: str) -> Optional[Dict[str, Any]]:
+    with self._lock:
+      item = self._items.get(key)
+      if item is None:
+        return None
+      stored_at, value = item
+      if time.time() - stored_at > self.ttl_seconds:
+        del self._items[key]
+        return None
+      self._items.move_to_end(key)
+      return dict(value)
+
+  def set(self, key: str, value: Dict[str, Any], stored_at: Optional[float] = None):
+    with self._lock:
+      self._items[key] = (stored_at or time.time(), dict(value))
+      self._items.move_to_end(key)
+      while len(self._items) > self.max_entries:
+        self._items.popitem(last=False)
+
+  def __len__(self):
+    with self._lock:
+      return len(self._items)
+
+metadata = MetaData()
+
+parse_cache_table = Table(
+  "card_parse_cache",
+  metadata,
+  Column("key", String(64), primary_key=True),
+  Column("result", Text, nullable=False),
+  Column("created_at", Float, nullable=False, index=True),
+)
+
+def create_tables(engine):
+  metadata.create_all(engine, checkfirst=True)
+
+class SQLCache:
+  """DB 上のキャッシュ。プロセス・再起動をまたいで結果を共有する。"""
+
+  def __init__(self, engine, ttl_seconds: float = 7 * 24 * 3600, max_rows: int = 10000):
+    self.engine = engine
+    self.ttl_seconds = ttl_seconds
+    self.max_rows = max_rows
+    self._writes = 0
+    create_tables(engine)
+
+  def get(self, key: str):
+    """(stored_at, value) を返す。期限切れ・未登録なら None。"""
+    t = parse_cache_table
+    with self.engine.connect() as conn:
+      row = conn.execute(select(t.c.result, t.c.created_at).where(t.c.key == key)).first()
+    if row is None or time.time() - row.created_at > self.ttl_seconds:
+      return None
+    return row.created_at, json.loads(row.result)
+
+  def set(self, key: str, value: Dict[str, Any]):
+    t = parse_cache_table
+    with self.engine.begin() as conn:
+      conn.execute(delete(t).where(t.c.key == key))
+      conn.execute(t.insert().values(key=key, result=json.dumps(value, ensure_ascii=False), created_at=time.time()))
+    self._writes += 1
+    # 書き込み100回に1回、期限切れと上限超過分をまとめて削除
+    if self._writes % 100 == 1:
+      self.evict()
+
+  def evict(self):
+    t = parse_cache_table
+    with self.engine.begin() as conn:
+      conn.execute(delete(t).where(t.c.created_at < time.time() - self.ttl_seconds))
+      count = conn.execute(select(func.count()).select_from(t)).scalar()
+      if count > self.max_rows:
+        cutoff = conn.execute(
+          select(t.c.created_at).order_by(t.c.created_at.desc()).offset(self.max_rows).limit(1)
+        ).scalar()
+        conn.execute(delete(t).where(t.c.created_at <= cutoff))
+
+class ResultCache:
+  def __init__(self, memory: Optional[MemoryCache] = None, sql: Optional[SQLCache] = None):
+    self.memory = memory
+    self.sql = sql
+    self._lock = threading.Lock()
+    self.stats = {"memory_hits": 0, "sql_hits": 0, "misses": 0}
+
+  def _count(self, name: str):
+    with self._lock:
+      self.stats[name] += 1
+
+  def get(self, key: str) -> Optional[Dict[str, Any]]:
+    if self.memory is not None:
+      value = self.memory.get(key)
+      if value is not None:
+        self._count("memory_hits")
+        return value
+    if self.sql is not None:
+      try:
+        found = self.sql.get(key)
+      except Exception as e:
+        logging.warning(f"解析キャッシュ（DB）の読み込みに失敗: {e}")
+        found = None
+      if found is not None:
+        stored_at, value = found
+        if self.memory is not None:
+          self.memory.set(key, value, stored_at=stored_at)
+        self._count("sql_hits")
+        return value
+    self._count("misses")
+    return None
+
+  def set(self, key: str, value: Dict[str, Any]):
+    if self.memory is not None:
+      self.memory.set(key, value)
+    if self.sql is not None:
+      try:
+        self.sql.set(key, value)
+      except Exception as e:
+        logging.warning(f"解析キャッシュ（DB）の書き込みに失敗: {e}")
+
+def create_result_cache() -> Optional[ResultCache]:
+  """環境変数からキャッシュを組み立てる。どの段も無効なら None。"""
+  ttl = float(os.environ.get("PARSE_CACHE_TTL", str(7 * 24 * 3600)))
+  size = int(os.environ.get("PARSE_CACHE_SIZE", "256"))
+  memory = MemoryCache(max_entries=size, ttl_seconds=ttl) if size > 0 else None
+
+  sql = None
+  if os.environ.get("PARSE_CACHE_SQL", "").lower() in ("1", "true", "yes"):
+    from config.database import get_engine
+    sql = SQLCache(get_engine(), ttl_seconds=ttl, max_rows=int(os.environ.get("PARSE_CACHE_SQL_MAX_ROWS", "10000")))
+
+  if memory is None and sql is None:
+    return None
+  cache = ResultCache(memory=memory, sql=sql)
+  metrics.register_snapshot(
+    "parse_cache", lambda: dict(cache.stats), "解析結果キャッシュ", counters=("memory_hits", "sql_hits", "misses"),
+  )
+  return cache
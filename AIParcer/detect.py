@@ -0,0 +1,153 @@
+"""1枚の写真に並べて撮られた複数の名刺の領域を検出する。
+
+縮小したグレースケール画像で、写真の縁（机などの背景）の明るさとの差が大きい画素を前景とし、
+行・列ごとの前景の量（射影）が途切れるところで再帰的に分割する（XY-cut）。
+名刺らしい形（塗りつぶし率・縦横比）の領域が2つ以上見つかったときだけ複数枚として扱う。
+numpy があれば射影の計算に使い、なければ素の Python で計算する（解析用の画像は小さい）。
+"""
+import os
+from dataclasses import dataclass
+from typing import List, Tuple
+from PIL import Image, ImageFilter
+
+try:
+  import numpy as np
+except ImportError:  # numpy は任意
+  np = None
+
+Box = Tuple[int, int, int, int]  # (left, top, right, bottom)
+
+# 検出はこの長辺まで縮小した画像で行う
+ANALYSIS_EDGE = 320
+
+@dataclass(frozen=True)
+class DetectOptions:
+  max_cards: int = 8
+  min_area_ratio: float = 0.03   # 画像全体に対する1枚の最小面積
+  min_gap_ratio: float = 0.015   # 分割とみなす空白の最小幅（辺の長さに対する比）
+  threshold: int = 40            # 背景との輝度差がこれを超える画素を前景とする
+  min_fill: float = 0.6          # 領域内の前景の割合（名刺は背景と違う色の塊として写る）
+  max_aspect: float = 2.4        # 長辺 / 短辺（名刺は 91x55mm で約 1.65）
+  padding_ratio: float = 0.02    # 切り出すときに足す余白
+
+  @classmethod
+  def from_env(cls) -> "DetectOptions":
+    return cls(max_cards=int(os.environ.get("MULTI_CARD_MAX", "8")))
+
+def _background_level(gray: Image.Image) -> int:
+  """写真の縁（上下左右 2px）の輝度の中央値を背景の明るさとみなす。"""
+  w, h = gray.size
+  hist = [0] * 256
+  for box in ((0, 0, w, 2), (0, h - 2, w, h), (0, 0, 2, h), (w - 2, 0, w, h)):
+    for i, n in enumerate(gray.crop(box).histogram()):
+      hist[i] += n
+  half, acc = sum(hist) / 2, 0
+  for level, n in enumerate(hist):
+    acc += n
+    if acc >= half:
+      return level
+  return 0
+
+def _foreground_grid(gray: Image.Image, threshold: int):
+  bg = _background_level(gray)
+  mask = gray.point(lambda v: 1 if abs(v - bg) > threshold else 0)
+  # 文字の隙間や細かなノイズで領域が途切れないよう少し膨張させる
+  mask = mask.filter(ImageFilter.MaxFilter(3))
+  w, h = mask.size
+  if np is not None:
+    return np.asarray(mask, dtype=np.uint8)
+  data = list(mask.getdata())
+  return [data[y * w:(y + 1) * w] for y in range(h)]
+
+def _profile(grid, box: Box, axis: str) -> List[int]:
+  """box 内の前景画素数を行ごと（axis="rows"）または列ごと（axis="cols"）に数える。"""
+  left, top, right, bottom = box
+  if np is not None:
+    return grid[top:bottom, left:right].sum(axis=1 if axis == "rows" else 0).tolist()
+  rows = [row[left:right] for row in grid[top:bottom]]
+  if axis == "rows":
+    return [sum(r) for r in rows]
+  return [sum(c) for c in zip(*rows)]
+
+def _segments(profile: List[int], span: int, min_gap: int) -> List[Tuple[int, int]]:
+  """前景のある区間 [start, end) を返す。min_gap 未満の空白はつなげる。"""
+  noise = max(1, int(span * 0.02))
+  segments = []
+  start = None
+  for i, v in enumerate(profile):
+    if v > noise:
+      if start is None:
+        # 直前の区間との空白が狭ければ同じ区間として続ける
+        if segments and i - segments[-1][1] < min_gap:
+          start = segments.pop()[0]
+        else:
+          start = i
+    elif start is not None:
+      segments.append((start, i))
+      start = None
+  if start is not None:
+    segments.append((start, len(profile)))
+  return segments
+
+def _xy_cut(grid, box: Box, min_gap: Tuple[int, int], out: List[Box], depth: int = 0):
+  left, top, right, bottom = box
+  if depth > 8 or right - left < 2 or bottom - top < 2:
+    return
+  rows = _segments(_profile(grid, box, "rows"), right - left, min_gap[1])
+  if len(rows) > 1:
+    for s, e in rows:
+      _xy_cut(grid, (left, top + s, right, top + e), min_gap, out, depth + 1)
+    return
+  if not rows:
+    return
+  top, bottom = top + rows[0][0], top + rows[0][1]
+  cols = _segments(_profile(grid, (left, top, right, bottom), "cols"), bottom - top, min_gap[0])
+  if len(cols) > 1:
+    for s, e in cols:
+      _xy_cut(grid, (left + s, top, left + e, bottom), min_gap, out, depth + 1)
+    return
+  if not cols:
+    return
+  out.append((left + cols[0][0], top, left + cols[0][1], bottom))
+
+def _looks_like_card(grid, box: Box, image_area: int, options: DetectOptions) -> bool:
+  left, top, right, bottom = box
+  w, h = right - left, bottom - top
+  area = w * h
+  if area < image_area * options.min_area_ratio:
+    return False
+  if max(w, h) / max(1, min(w, h)) > options.max_aspect:
+    return False
+  return sum(_profile(grid, box, "rows")) / area >= options.min_fill
+
+def detect_card_boxes(img: Image.Image, options: DetectOptions = DetectOptions()) -> List[Box]:
+  """img 上の名刺の領域を、上から下・左から右の順で返す。
+
+  名刺が2枚以上見つからない（1枚だけ、または判定できない）ときは空リストを返すので、
+  呼び出し側は画像全体を1枚として扱う。
+  """
+  gray = img.convert("L")
+  gray.thumbnail((ANALYSIS_EDGE, ANALYSIS_EDGE))
+  w, h = gray.size
+  if w < 16 or h < 16:
+    return []
+  grid = _foreground_grid(gray, options.threshold)
+
+  found: List[Box] = []
+  min_gap = (max(2, int(w * options.min_gap_ratio)), max(2, int(h * options.min_gap_ratio)))
+  _xy_cut(grid, (0, 0, w, h), min_gap, found)
+  cards = [b for b in found if _looks_like_card(grid, b, w * h, options)]
+  if not 2 <= len(cards) <= options.max_cards:
+    return []
+
+  # 元画像の座標に戻し、少し余白を付ける
+  sx, sy = img.width / w, img.height / h
+  boxes = []
+  for left, top, right, bottom in cards:
+    pad_x = (right - left) * options.padding_ratio
+    pad_y = (bottom - top) * options.padding_ratio
+    boxes.append((
+      max(0, int((left - pad_x) * sx)), max(0, int((top - pad_y) * sy)),
+      min(img.width, int((right + pad_x) * sx)), min(img.height, int((bottom + pad_y) * sy)),
+    ))
+  return boxes
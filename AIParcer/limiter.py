@@ -0,0 +1,291 @@
+"""Gemini 呼び出しの流量制御。
+
+- TokenBucket / SQLTokenBucket: 1分あたりのリクエスト数を抑える（SQL 版は複数プロセスで共有）
+- AdaptiveLimiter: 同時実行数の上限を AIMD で自動調整する。
+  成功してレイテンシが目標以内なら少しずつ増やし、429/5xx や遅延が出たら半分に減らす
+- GeminiLimiter: 上の2つを通して呼び出し、429/5xx はジッター付き指数バックオフでリトライする
+"""
+import os, time, random, asyncio, logging, threading
+from typing import Optional
+from sqlalchemy import MetaData, Table, Column, String, Float, select, insert, update
+from sqlalchemy.exc import IntegrityError
+from config import metrics
+
+def is_retryable(e: Exception) -> bool:
+  """429（クォータ超過）と 5xx はリトライ対象。google.api_core の例外は code に HTTP ステータスを持つ。"""
+  code = getattr(e, "code", None)
+  try:
+    status = int(code) if code is not None else None
+  except (TypeError, ValueError):
+    status = None
+  if status is not None:
+    return status == 429 or status >= 500
+  return isinstance(e, (ConnectionError, TimeoutError))
+
+class TokenBucket:
+  """プロセス内のトークンバケット。rate_per_minute 件/分、最大 burst 件まで連続で通す。"""
+
+  def __init__(self, rate_per_minute: float, burst: Optional[int] = None):
+    self.rate = rate_per_minute / 60.0
+    self.burst = burst or max(1, int(rate_per_minute // 6))
+    self._tokens = float(self.burst)
+    self._updated_at = time.monotonic()
+    self._lock = threading.Lock()
+
+  def try_acquire(self) -> float:
+    """1トークン取れたら 0、取れなければ次に取れるまでの秒数を返す。"""
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+      self._updated_at = now
+      if self._tokens >= 1:
+        self._tokens -= 1
+        return 0.0
+      return (1 - self._tokens) / self.rate
+
+  def acquire(self):
+    while (wait := self.try_acquire()) > 0:
+      time.sleep(wait)
+
+  async def acquire_async(self):
+    while (wait := self.try_acquire()) > 0:
+      await asyncio.sleep(wait)
+
+metadata = MetaData()
+
+rate_limit_table = Table(
+  "gemini_rate_limit",
+  metadata,
+  Column("name", String(64), primary_key=True),
+  Column("tokens", Float, nullable=False),
+  Column("updated_at", Float, nullable=False),
+)
+
+def create_tables(engine):
+  metadata.create_all(engine, checkfirst=True)
+
+class SQLTokenBucket(TokenBucket):
+  """DATABASE_URL の DB にトークン残量を持つ。複数プロセス・複数 dyno でクォータを共有できる。"""
+
+  def __init__(self, engine, rate_per_minute: float, burst: Optional[int] = None, name: str = "gemini"):
+    super().__init__(rate_per_minute, burst)
+    self.engine = engine
+    self.name = name
+    create_tables(engine)
+
+  def try_acquire(self) -> float:
+    t = rate_limit_table
+    now = time.time()
+    try:
+      with self.engine.begin() as conn:
+        row = conn.execute(select(t.c.tokens, t.c.updated_at).where(t.c.name == self.name).with_for_update()).first()
+        if row is None:
+          conn.execute(insert(t).values(name=self.name, tokens=self.burst - 1, updated_at=now))
+          return 0.0
+        tokens = min(self.burst, row.tokens + max(0.0, now - row.updated_at) * self.rate)
+        acquired = tokens >= 1
+        conn.execute(update(t).where(t.c.name == self.name).values(
+          tokens=tokens - 1 if acquired else tokens, updated_at=now,
+        ))
+        return 0.0 if acquired else (1 - tokens) / self.rate
+    except IntegrityError:
+      # 他のプロセスが先に行を作った
+      return self.try_acquire()
+
+  async def acquire_async(self):
+    while (wait := await asyncio.to_thread(self.try_acquire)) > 0:
+      await asyncio.sleep(wait)
+
+class AdaptiveLimiter:
+  """同時実行数の上限を AIMD（加算増・乗算減）で調整するリミッター。"""
+
+  def __init__(self, initial: int = 4, min_limit: int = 1, max_limit: int = 16,
+               target_latency: float = 15.0, decrease_ratio: float = 0.5, cooldown: float = 2.0):
+    self.min_limit = min_limit
+    self.max_limit = max_limit
+    self.target_latency = target_latency
+    self.decrease_ratio = decrease_ratio
+    self.cooldown = cooldown
+    self.limit = float(max(min_limit, min(initial, max_limit)))
+    self.in_flight = 0
+    self.waiting = 0
+    self._last_decrease = 0.0
+    self._cond = threading.Condition()
+
+  def try_acquire(self) -> bool:
+    with self._cond:
+      if self.in_flight < int(self.limit):
+        self.in_flight += 1
+        return True
+      return False
+
+  def acquire(self):
+    with self._cond:
+      self.waiting += 1
+      try:
+        self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+        self.in_flight += 1
+      finally:
+        self.waiting -= 1
+
+  async def acquire_async(self):
+    """acquire の asyncio 版（空くまで短い間隔で確認する）。"""
+    if self.try_acquire():
+      return
+    with self._cond:
+      self.waiting += 1
+    try:
+      while not self.try_acquire():
+        await asyncio.sleep(0.05)
+    finally:
+      with self._cond:
+        self.waiting -= 1
+
+  def release(self, latency: float, overloaded: bool = False, weight: int = 1):
+    """呼び出しの終了を伝える。overloaded は 429/5xx を受けたとき。
+    weight は1回の呼び出しで送った画像の枚数で、レイテンシの目標をその倍数にする（まとめた解析は長くかかる）。"""
+    with self._cond:
+      self.in_flight -= 1
+      now = time.monotonic()
+      if overloaded or latency > self.target_latency * max(1, weight):
+        # 同時に失敗した呼び出しで何度も半減しないよう、減らすのは cooldown 秒に1回
+        if now - self._last_decrease >= self.cooldown:
+          old = self.limit
+          self.limit = max(self.min_limit, self.limit * self.decrease_ratio)
+          self._last_decrease = now
+          logging.warning(
+            f"Gemini 同時実行数の上限を下げます: {old:.1f} -> {self.limit:.1f}"
+            f"（{'429/5xx' if overloaded else f'レイテンシ {latency:.1f}s'}）"
+          )
+      else:
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+      self._cond.notify_all()
+
+class GeminiLimiter:
+  """トークンバケット → 同時実行数の枠 の順に待ってから呼び出し、429/5xx はリトライする。"""
+
+  def __init__(self, concurrency: AdaptiveLimiter, bucket: Optional[TokenBucket] = None,
+               max_retries: int = 3, backoff_base: float = 1.0, backoff_max: float = 30.0):
+    self.concurrency = concurrency
+    self.bucket = bucket
+    self.max_retries = max_retries
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    self._lock = threading.Lock()
+    self._stats = {"calls": 0, "retries": 0, "throttled": 0, "failures": 0,
+                   "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+
+  def _backoff(self, attempt: int) -> float:
+    return min(self.backoff_max, self.backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.5)
+
+  def _record_wait(self, waited: float):
+    with self._lock:
+      self._stats["calls"] += 1
+      self._stats["wait_seconds_total"] += waited
+      self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], waited)
+
+  def _record_error(self, retryable: bool, will_retry: bool):
+    with self._lock:
+      if retryable:
+        self._stats["throttled"] += 1
+      if will_retry:
+        self._stats["retries"] += 1
+      else:
+        self._stats["failures"] += 1
+
+  def stats(self) -> dict:
+    with self._lock:
+      stats = dict(self._stats)
+    stats.update(
+      in_flight=self.concurrency.in_flight,
+      waiting=self.concurrency.waiting,
+      concurrency_limit=self.concurrency.limit,
+    )
+    return stats
+
+  def call(self, fn, *args, weight: int = 1, **kwargs):
+    """fn を呼ぶ。weight は1回で送る画像の枚数（同時実行数の調整でレイテンシの目標に掛ける）。"""
+    for attempt in range(self.max_retries + 1):
+      queued_at = time.monotonic()
+      if self.bucket is not None:
+        self.bucket.acquire()
+      self.concurrency.acquire()
+      start = time.monotonic()
+      self._record_wait(start - queued_at)
+      try:
+        result = fn(*args, **kwargs)
+      except Exception as e:
+        retryable = is_retryable(e)
+        self.concurrency.release(time.monotonic() - start, overloaded=retryable, weight=weight)
+        metrics.observe_stage("generate_content", time.monotonic() - start, ok=False)
+        will_retry = retryable and attempt < self.max_retries
+        self._record_error(retryable, will_retry)
+        if not will_retry:
+          raise
+        delay = self._backoff(attempt)
+        logging.warning(f"Gemini 呼び出しが失敗、{delay:.1f}s 後にリトライ（{attempt + 1}/{self.max_retries}）: {e}")
+        time.sleep(delay)
+        continue
+      self.concurrency.release(time.monotonic() - start, weight=weight)
+      metrics.observe_stage("generate_content", time.monotonic() - start)
+      return result
+
+  async def call_async(self, fn, *args, weight: int = 1, **kwargs):
+    """call の asyncio 版。fn はコルーチン関数。待機はイベントループを塞がない。"""
+    for attempt in range(self.max_retries + 1):
+      queued_at = time.monotonic()
+      if self.bucket is not None:
+        await self.bucket.acquire_async()
+      await self.concurrency.acquire_async()
+      start = time.monotonic()
+      self._record_wait(start - queued_at)
+      try:
+        result = await fn(*args, **kwargs)
+      except Exception as e:
+        retryable = is_retryable(e)
+        self.concurrency.release(time.monotonic() - start, overloaded=retryable, weight=weight)
+        metrics.observe_stage("generate_content", time.monotonic() - start, ok=False)
+        will_retry = retryable and attempt < self.max_retries
+        self._record_error(retryable, will_retry)
+        if not will_retry:
+          raise
+        delay = self._backoff(attempt)
+        logging.warning(f"Gemini 呼び出しが失敗、{delay:.1f}s 後にリトライ（{attempt + 1}/{self.max_retries}）: {e}")
+        await asyncio.sleep(delay)
+        continue
+      self.concurrency.release(time.monotonic() - start, weight=weight)
+      metrics.observe_stage("generate_content", time.monotonic() - start)
+      return result
+
+def create_limiter() -> GeminiLimiter:
+  bucket = None
+  rate = float(os.environ.get("GEMINI_RATE_PER_MINUTE", "0"))
+  if rate > 0:
+    if os.environ.get("GEMINI_RATE_BACKEND", "memory") == "sql":
+      from config.database import get_engine
+      bucket = SQLTokenBucket(get_engine(), rate)
+    else:
+      bucket = TokenBucket(rate)
+  concurrency = AdaptiveLimiter(
+    initial=int(os.environ.get("GEMINI_CONCURRENCY", "4")),
+    min_limit=int(os.environ.get("GEMINI_MIN_CONCURRENCY", "1")),
+    max_limit=int(os.environ.get("GEMINI_MAX_CONCURRENCY", "16")),
+    target_latency=float(os.environ.get("GEMINI_TARGET_LATENCY", "15")),
+  )
+  limiter = GeminiLimiter(concurrency, bucket, max_retries=int(os.environ.get("GEMINI_MAX_RETRIES", "3")))
+  metrics.register_snapshot(
+    "gemini_limiter", limiter.stats, "Gemini 呼び出しの流量制御",
+    counters=("calls", "retries", "throttled", "failures", "wait_seconds_total"),
+  )
+  return limiter
+
+_default_limiter: Optional[GeminiLimiter] = None
+_default_limiter_lock = threading.Lock()
+
+def get_limiter() -> GeminiLimiter:
+  global _default_limiter
+  if _default_limiter is None:
+    with _default_limiter_lock:
+      if _default_limiter is None:
+        _default_limiter = create_limiter()
+  return _default_limiter
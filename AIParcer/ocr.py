@@ -0,0 +1,234 @@
+"""Gemini の前に手元で行う OCR と、正規表現による項目の読み取り。
+
+印刷のきれいな名刺なら、メール・電話・URL・郵便番号（〒xxx-xxxx）・住所・会社名は
+OCR のテキストから決まった規則で読み取れる。読み取れた項目は信頼度付きで返し、
+足りない項目・信頼度の低い項目だけを Gemini に聞く（全部そろえば Gemini を呼ばない）。
+
+OCR には pytesseract（と tesseract 本体・jpn の学習データ）を使う。入っていなければ何もしない。
+
+オフラインでの評価:
+  python -m AIParcer.ocr <画像のディレクトリ>
+同じ名前の .json（SCHEMA の項目）を置いておくと、項目ごとの一致率も出す。
+"""
+import os, re, sys, json, time, logging, unicodedata
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from AIParcer.preprocess import decode_image
+
+try:
+  import pytesseract
+except ImportError:  # pytesseract は任意
+  pytesseract = None
+
+# OCR に渡す画像の長辺（小さすぎると日本語の画数の多い文字が潰れる）
+OCR_MAX_EDGE = 2000
+
+EMAIL_RE = re.compile(r"[A-Za-z0-9._%+\-]+@[A-Za-z0-9\-]+(?:\.[A-Za-z0-9\-]+)+")
+URL_RE = re.compile(r"(?:https?://|www\.)[A-Za-z0-9\-._~/?#=&%:+]+")
+POSTAL_RE = re.compile(r"(〒)?\s*(\d{3})\s*[-‐ー―]\s*(\d{4})")
+PHONE_RE = re.compile(r"(?:\+81[\s\-]?\(?0?\)?|0)\d{1,4}[\s\-()]{0,2}\d{1,4}[\s\-]{0,2}\d{3,4}")
+PHONE_LABEL_RE = re.compile(r"(?:TEL|Tel|tel|電話|Phone|PHONE|Mobile|携帯|T\s*[.:])")
+FAX_LABEL_RE = re.compile(r"(?:FAX|Fax|fax|F\s*[.:])")
+COMPANY_RE = re.compile(
+  r"(株式会社|有限会社|合同会社|合資会社|一般社団法人|一般財団法人|公益社団法人|\(株\)|（株）"
+  r"|\bInc\b\.?|\bCo\.,?\s?Ltd\b\.?|\bCorporation\b|\bCorp\b\.?|\bLLC\b|\bK\.K\.)"
+)
+PREFECTURE_RE = re.compile(r"(東京都|北海道|大阪府|京都府|.{2,3}県)")
+ADDRESS_HINT_RE = re.compile(r"[都道府県市区町村郡]|丁目|番地")
+
+@dataclass(frozen=True)
+class OcrLine:
+  text: str
+  confidence: float   # 0〜1（tesseract の単語ごとの信頼度の平均）
+  height: int         # 文字の高さ（px）。大きい行は名前・会社名の可能性が高い
+
+@dataclass(frozen=True)
+class FieldGuess:
+  value: str
+  confidence: float   # 0〜1
+
+def _normalize(text: str) -> str:
+  # 全角英数・記号を半角に揃え、日本語の文字間に入った空白を詰める
+  text = unicodedata.normalize("NFKC", text)
+  text = re.sub(r"(?<=[^\x00-\x7F]) (?=[^\x00-\x7F])", "", text)
+  return re.sub(r"\s+", " ", text).strip()
+
+def _format_phone(raw: str) -> str:
+  # +81 は国内表記（先頭 0）に直し、区切りはハイフンに揃える
+  raw = re.sub(r"^\+81[\s\-]?\(?0?\)?", "0", raw.strip())
+  parts = [p for p in re.split(r"[\s\-()]+", raw) if p]
+  return "-".join(parts) if len(parts) >= 2 else re.sub(r"\D", "", raw)
+
+def extract_fields(lines: List[OcrLine]) -> Dict[str, FieldGuess]:
+  """OCR の行から SCHEMA の項目を読み取る。読み取れなかった項目は含めない。"""
+  guesses: Dict[str, FieldGuess] = {}
+  used = set()   # 他の項目に使った行（名前の候補から外す）
+
+  def put(field: str, value: str, confidence: float, index: int):
+    if value and (field not in guesses or guesses[field].confidence < confidence):
+      guesses[field] = FieldGuess(value, confidence)
+      used.add(index)
+
+  for i, line in enumerate(lines):
+    text = line.text
+    if m := EMAIL_RE.search(text):
+      put("email", m.group(0), 0.95 * line.confidence, i)
+    if m := URL_RE.search(text):
+      put("website", m.group(0).rstrip(".,"), 0.9 * line.confidence, i)
+    if m := POSTAL_RE.search(text):
+      put("postal_code", f"{m.group(2)}-{m.group(3)}", (0.95 if m.group(1) else 0.8) * line.confidence, i)
+      # 郵便番号の後ろ（なければ次の行）を住所とみなす
+      rest = text[m.end():].strip()
+      if not rest and i + 1 < len(lines):
+        rest = lines[i + 1].text
+        used.add(i + 1)
+      if rest:
+        looks_like = PREFECTURE_RE.search(rest) or ADDRESS_HINT_RE.search(rest)
+        put("address", rest, (0.85 if looks_like else 0.5) * line.confidence, i)
+    if not EMAIL_RE.search(text) and (m := PHONE_RE.search(text)):
+      if FAX_LABEL_RE.search(text[:m.start()]) and not PHONE_LABEL_RE.search(text[:m.start()]):
+        used.add(i)
+      else:
+        labeled = bool(PHONE_LABEL_RE.search(text[:m.start()]))
+        put("phone", _format_phone(m.group(0)), (0.95 if labeled else 0.75) * line.confidence, i)
+    if COMPANY_RE.search(text):
+      put("company", text, 0.85 * line.confidence, i)
+
+  # 住所が郵便番号と別の行にある場合
+  if "address" not in guesses:
+    for i, line in enumerate(lines):
+      if i not in used and PREFECTURE_RE.match(line.text):
+        put("address", line.text, 0.7 * line.confidence, i)
+        break
+
+  # 名前: 残りの行で一番大きく印字された短い行（規則では確かめられないので信頼度は低め）
+  candidates = [
+    (line.height, i) for i, line in enumerate(lines)
+    if i not in used and 2 <= len(line.text) <= 20 and not re.search(r"[\d@/:]", line.text)
+  ]
+  if candidates:
+    _, i = max(candidates)
+    put("name", lines[i].text, 0.6 * lines[i].confidence, i)
+  return guesses
+
+class LocalOCR:
+  """tesseract で行単位のテキストを読み、extract_fields で項目にする。"""
+
+  def __init__(self, lang: str = "jpn+eng", min_confidence: float = 0.8, name_min_confidence: float = 0.5):
+    self.lang = lang
+    self.min_confidence = min_confidence
+    # 名前は規則で確かめられず信頼度が最大でも 0.6 なので、他の項目とは別のしきい値で判定する
+    self.name_min_confidence = name_min_confidence
+
+  @property
+  def available(self) -> bool:
+    return pytesseract is not None
+
+  def read_lines(self, image_bytes: bytes) -> List[OcrLine]:
+    img = decode_image(image_bytes, OCR_MAX_EDGE, "L")
+    img.thumbnail((OCR_MAX_EDGE, OCR_MAX_EDGE))
+    data = pytesseract.image_to_data(img, lang=self.lang, output_type=pytesseract.Output.DICT)
+    grouped = {}
+    for i, word in enumerate(data["text"]):
+      conf = float(data["conf"][i])
+      if not word.strip() or conf < 0:
+        continue
+      key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+      grouped.setdefault(key, []).append((word, conf, data["height"][i]))
+    lines = []
+    for key in sorted(grouped):
+      words = grouped[key]
+      text = _normalize(" ".join(w for w, _, _ in words))
+      if text:
+        lines.append(OcrLine(
+          text=text,
+          confidence=sum(c for _, c, _ in words) / len(words) / 100,
+          height=max(h for _, _, h in words),
+        ))
+    return lines
+
+  def guess(self, image_bytes: bytes) -> Dict[str, str]:
+    """信頼度がしきい値（名前は name_min_confidence、他は min_confidence）以上の項目だけを返す。
+    OCR に失敗したら空。"""
+    try:
+      guesses = extract_fields(self.read_lines(image_bytes))
+    except Exception as e:
+      logging.warning(f"OCR に失敗（Gemini で全項目を解析します）: {e}")
+      return {}
+    return {k: g.value for k, g in guesses.items() if g.confidence >= self._threshold(k)}
+
+  def _threshold(self, field: str) -> float:
+    return self.name_min_confidence if field == "name" else self.min_confidence
+
+def create_local_ocr() -> Optional[LocalOCR]:
+  """OCR_PREPASS=true で pytesseract が使えるときだけ作る。"""
+  if os.environ.get("OCR_PREPASS", "").lower() not in ("1", "true", "yes"):
+    return None
+  if pytesseract is None:
+    logging.warning("OCR_PREPASS が有効ですが pytesseract が入っていないため、OCR は使いません")
+    return None
+  return LocalOCR(
+    lang=os.environ.get("OCR_LANG", "jpn+eng"),
+    min_confidence=float(os.environ.get("OCR_MIN_CONFIDENCE", "0.8")),
+    name_min_confidence=float(os.environ.get("OCR_NAME_MIN_CONFIDENCE", "0.5")),
+  )
+
+def _bench(directory: str, ocr: LocalOCR, fields: List[str]):
+  """ディレクトリ内の画像で OCR の前処理を評価する（ネットワークは使わない）。"""
+  exts = (".jpg", ".jpeg", ".png", ".webp", ".heic", ".heif")
+  paths = sorted(p for p in os.listdir(directory) if p.lower().endswith(exts))
+  timings, skipped = [], 0
+  filled = {f: 0 for f in fields}
+  matched = {f: 0 for f in fields}
+  labeled = 0
+  for name in paths:
+    with open(os.path.join(directory, name), "rb") as fp:
+      image_bytes = fp.read()
+    start = time.perf_counter()
+    got = ocr.guess(image_bytes)
+    timings.append((time.perf_counter() - start) * 1000)
+    if all(f in got for f in fields):
+      skipped += 1
+    expected_path = os.path.join(directory, os.path.splitext(name)[0] + ".json")
+    expected = None
+    if os.path.exists(expected_path):
+      with open(expected_path, encoding="utf-8") as fp:
+        expected = json.load(fp)
+      labeled += 1
+    for f in fields:
+      if f in got:
+        filled[f] += 1
+        if expected is not None and _normalize(expected.get(f, "")) == got[f]:
+          matched[f] += 1
+    print(f"{name}: {timings[-1]:.0f}ms {json.dumps(got, ensure_ascii=False)}")
+
+  if not paths:
+    print("画像がありません")
+    return
+  timings.sort()
+  pct = lambda q: timings[min(len(timings) - 1, int(len(timings) * q))]
+  print(f"\n{len(paths)} 枚: p50={pct(0.5):.0f}ms p95={pct(0.95):.0f}ms "
+        f"Gemini 不要={skipped}/{len(paths)}")
+  for f in fields:
+    line = f"  {f:<12} 読み取り {filled[f]}/{len(paths)}"
+    if labeled:
+      line += f"  正解 {matched[f]}/{labeled}"
+    print(line)
+
+if __name__ == "__main__":
+  if len(sys.argv) != 2:
+    print("usage: python -m AIParcer.ocr <画像のディレクトリ>")
+    sys.exit(2)
+  if pytesseract is None:
+    print("pytesseract が入っていません")
+    sys.exit(1)
+  from AIParcer.parser import SCHEMA
+  _bench(
+    sys.argv[1],
+    LocalOCR(
+      lang=os.environ.get("OCR_LANG", "jpn+eng"),
+      min_confidence=float(os.environ.get("OCR_MIN_CONFIDENCE", "0.8")),
+      name_min_confidence=float(os.environ.get("OCR_NAME_MIN_CONFIDENCE", "0.5")),
+    ),
+    list(SCHEMA["properties"].keys()),
+  )
@@ -1,13 +1,16 @@
-import io, os, json
-from typing import Dict, Any
-from PIL import Image
-from pillow_heif import register_heif_opener
+import os, time, asyncio, logging, threading
+from typing import Dict, Any, List, Optional
 import google.generativeai as genai
-
-# HEICファイルサポートを有効にする
-register_heif_opener()
+from AIParcer.preprocess import PreprocessOptions, decode_image, preprocess_decoded, preprocess_image
+from AIParcer.detect import DetectOptions, detect_card_boxes
+from AIParcer.cache import ResultCache, cache_key, create_result_cache
+from AIParcer.limiter import GeminiLimiter, get_limiter
+from AIParcer.ocr import LocalOCR, create_local_ocr
+from AIParcer.validate import SchemaError, compile_validator, parse_array, parse_object
 
 MODEL = "gemini-2.5-flash-lite"
+# SCHEMA / SYSTEM_PROMPT を変えたら上げる（解析キャッシュのキーに含まれる）
+PROMPT_VERSION = "1"
 
 SCHEMA = {
   "type": "object",
@@ -29,43 +32,338 @@ SYSTEM_PROMPT = (
   "Do not include the postal code in the address field."
 )
 
-def _bytes_to_pil(b: bytes) -> Image.Image:
-  try:
-    img = Image.open(io.BytesIO(b))
-    print(f"Image format detected: {img.format}")
-    return img.convert("RGB")
-  except Exception as e:
-    print(f"Error opening image: {type(e).__name__}: {e}")
-    print(f"Image bytes length: {len(b)}")
-    print(f"First 20 bytes: {b[:20]}")
-    raise
-
-def extract_from_bytes(image_bytes: bytes) -> Dict[str, Any]:
-  genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-  img = _bytes_to_pil(image_bytes)
-
-  model = genai.GenerativeModel(
-    model_name=MODEL,
-    generation_config={
-      "response_mime_type": "application/json",
-      "response_schema": SCHEMA
-    },
-    system_instruction=SYSTEM_PROMPT
-  )
+# 複数の名刺画像を1リクエストで送るときのスキーマ（画像と同じ順の配列）
+BATCH_SCHEMA = {"type": "array", "items": SCHEMA}
 
-  resp = model.generate_content([img])
+BATCH_SYSTEM_PROMPT = SYSTEM_PROMPT + (
+  " You may receive several images, each showing exactly one business card. "
+  "Return a JSON array with exactly one object per image, in the same order as the images."
+)
 
+def _response_text(resp) -> str:
   text = getattr(resp, "text", None)
   if text is None:
     text = resp.candidates[0].content.parts[0].text
+  return text
+
+_validate = compile_validator(SCHEMA)
+
+def _parse_json(text: str) -> Dict[str, Any]:
+  return parse_object(text, _validate)
+
+def _parse_json_array(text: str, expected: int) -> List[Dict[str, Any]]:
+  return parse_array(text, _validate, expected)
+
+def _reask_prompt(error: Exception) -> str:
+  return (
+    f"Your previous answer could not be used ({error}). "
+    "Reply again with only the JSON that matches the schema; every value must be a string."
+  )
+
+def _reask_contents(contents: list, previous: str, error: Exception) -> list:
+  """聞き直しの会話。最初の依頼・モデルの不正な応答・直してほしい点、の3ターンにする。"""
+  return [
+    {"role": "user", "parts": list(contents)},
+    {"role": "model", "parts": [previous]},
+    {"role": "user", "parts": [_reask_prompt(error)]},
+  ]
 
+def _parse_or_reask(resp, contents: list):
+  """応答を解析して (結果, None) を返す。不正なら (None, 聞き直す contents)。"""
+  text = _response_text(resp)
   try:
-    data = json.loads(text)
-  except Exception:
-    left, right = text.find("{"), text.rfind("}")
-    data = json.loads(text[left:right+1])
+    return _parse_json(text), None
+  except SchemaError as e:
+    logging.warning(f"Gemini の応答が不正なため聞き直します: {e}")
+    return None, _reask_contents(contents, text, e)
+
+class CardParser:
+  """Gemini の設定とモデルを一度だけ作って使い回す名刺パーサ。
+
+  複数スレッドから同時に extract を呼んでよい。backend に generate_content を持つ
+  オブジェクトを渡すと Gemini の代わりにそれを使う（テスト用のフェイクなど）。
+  同じ画像の結果は cache から返し、Gemini は呼ばない。
+  """
+
+  _DEFAULT_CACHE = object()
+  _DEFAULT_OCR = object()
+
+  def __init__(self, api_key: Optional[str] = None, model_name: str = MODEL, backend=None,
+               preprocess_options: Optional[PreprocessOptions] = None,
+               cache: Optional[ResultCache] = _DEFAULT_CACHE, batch_size: Optional[int] = None,
+               limiter: Optional[GeminiLimiter] = None, ocr: Optional[LocalOCR] = _DEFAULT_OCR):
+    self.model_name = model_name
+    # extract_batch で1リクエストにまとめる画像の上限
+    self.batch_size = max(1, batch_size or int(os.environ.get("PARSE_BATCH_SIZE", "4")))
+    self.preprocess_options = preprocess_options or PreprocessOptions.from_env()
+    self.cache = create_result_cache() if cache is CardParser._DEFAULT_CACHE else cache
+    self.detect_options = DetectOptions.from_env()
+    # 同時実行数・レートの制御と 429/5xx のリトライ
+    self.limiter = limiter or get_limiter()
+    # 手元の OCR で読み取れた項目は Gemini に聞かない（OCR_PREPASS=true のとき）
+    self.ocr = create_local_ocr() if ocr is CardParser._DEFAULT_OCR else ocr
+    self._api_key = api_key
+    self._backend = backend
+    # フェイクを渡された場合は配列の応答もそれに任せる
+    self._batch_backend = backend
+    self._lock = threading.Lock()
+
+  def _get_backend(self):
+    if self._backend is None:
+      with self._lock:
+        if self._backend is None:
+          genai.configure(api_key=self._api_key or os.environ["GEMINI_API_KEY"])
+          self._backend = genai.GenerativeModel(
+            model_name=self.model_name,
+            generation_config={
+              "response_mime_type": "application/json",
+              "response_schema": SCHEMA
+            },
+            system_instruction=SYSTEM_PROMPT
+          )
+    return self._backend
+
+  def _get_batch_backend(self):
+    if self._batch_backend is None:
+      self._get_backend()  # genai.configure を済ませる
+      with self._lock:
+        if self._batch_backend is None:
+          self._batch_backend = genai.GenerativeModel(
+            model_name=self.model_name,
+            generation_config={
+              "response_mime_type": "application/json",
+              "response_schema": BATCH_SCHEMA
+            },
+            system_instruction=BATCH_SYSTEM_PROMPT
+          )
+    return self._batch_backend
+
+  def warm_up(self):
+    """起動時にモデルを生成し、API への接続も張っておく。失敗しても起動は止めない。"""
+    try:
+      self._get_backend().count_tokens("warm-up")
+    except Exception as e:
+      logging.warning(f"Gemini ウォームアップに失敗（初回リクエストで再接続します）: {e}")
+
+  def extract(self, image_bytes: bytes) -> Dict[str, Any]:
+    key = None
+    if self.cache is not None:
+      key = cache_key(image_bytes, self.model_name, PROMPT_VERSION)
+      cached = self.cache.get(key)
+      if cached is not None:
+        logging.info(f"解析キャッシュにヒット: {key[:12]}")
+        return cached
+
+    data = self._extract_uncached(image_bytes)
+    if key is not None:
+      self.cache.set(key, data)
+    return data
+
+  async def extract_async(self, image_bytes: bytes) -> Dict[str, Any]:
+    """extract の asyncio 版。前処理・キャッシュはスレッドで、Gemini 呼び出しは非同期 API で行う。"""
+    key = None
+    if self.cache is not None:
+      key = cache_key(image_bytes, self.model_name, PROMPT_VERSION)
+      cached = await asyncio.to_thread(self.cache.get, key)
+      if cached is not None:
+        logging.info(f"解析キャッシュにヒット: {key[:12]}")
+        return cached
+
+    local = await asyncio.to_thread(self._ocr_guess, image_bytes)
+    if len(local) == len(SCHEMA["properties"]):
+      data = dict(local)
+    else:
+      pre = await asyncio.to_thread(self._preprocess, image_bytes)
+      contents, kwargs = self._request_for(pre, local)
+      data = {**await self._generate_card_async(contents, kwargs), **local}
+    if key is not None:
+      await asyncio.to_thread(self.cache.set, key, data)
+    return data
+
+  def extract_cards(self, image_bytes: bytes) -> List[Optional[Dict[str, Any]]]:
+    """1枚の写真に並んだ複数の名刺を、それぞれ1件ずつの結果として返す。
+
+    名刺の領域を手元で検出して切り出し、全部まとめて1回の Gemini 呼び出しで解析する。
+    2枚以上見つからなければ画像全体を1枚として extract と同じ結果を返す。
+    解析できなかった名刺は None のまま残す（レビューで「解析に失敗」として1件に数える）。
+    """
+    key = None
+    if self.cache is not None:
+      key = cache_key(image_bytes, self.model_name, PROMPT_VERSION + ":cards")
+      cached = self.cache.get(key)
+      if cached is not None:
+        logging.info(f"解析キャッシュにヒット: {key[:12]}")
+        return cached["cards"]
+
+    img = decode_image(image_bytes, self.preprocess_options.max_edge * 2)
+    boxes = detect_card_boxes(img, self.detect_options)
+    if not boxes:
+      return [self.extract(image_bytes)]
+
+    logging.info(f"1枚の画像から名刺を {len(boxes)} 枚検出しました")
+    pres = [preprocess_decoded(img.crop(box), self.preprocess_options) for box in boxes]
+    cards = self._extract_preprocessed(pres)
+    if all(c is None for c in cards):
+      raise ValueError("切り出した名刺をどれも解析できませんでした")
+    failed = sum(c is None for c in cards)
+    if failed:
+      logging.warning(f"切り出した名刺 {len(cards)} 枚のうち {failed} 枚を解析できませんでした")
+    elif key is not None:
+      # 失敗した名刺がある結果はキャッシュしない（次は解析し直す）
+      self.cache.set(key, {"cards": cards})
+    return cards
+
+  async def extract_cards_async(self, image_bytes: bytes) -> List[Optional[Dict[str, Any]]]:
+    """extract_cards の asyncio 版（検出・切り出しが CPU 処理のため、まとめてスレッドで実行）。"""
+    return await asyncio.to_thread(self.extract_cards, image_bytes)
+
+  def extract_batch(self, images: List[bytes]) -> List[Optional[Dict[str, Any]]]:
+    """複数の画像（1枚に名刺1枚）を batch_size 枚ずつ1回の Gemini 呼び出しで解析する。
+
+    結果は images と同じ順。キャッシュにあるものは送らない。まとめた応答が崩れていたら
+    その回の画像を1枚ずつ解析し直し、それでも失敗した画像は None になる。
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(images)
+    keys: List[Optional[str]] = [None] * len(images)
+    locals_: List[Dict[str, str]] = [{} for _ in images]
+    todo = []
+    for i, image_bytes in enumerate(images):
+      if self.cache is not None:
+        keys[i] = cache_key(image_bytes, self.model_name, PROMPT_VERSION)
+        cached = self.cache.get(keys[i])
+        if cached is not None:
+          logging.info(f"解析キャッシュにヒット: {keys[i][:12]}")
+          results[i] = cached
+          continue
+      # OCR で全項目そろった画像は送らない。一部だけなら、まとめた解析の結果を OCR の値で上書きする
+      locals_[i] = self._ocr_guess(image_bytes)
+      if len(locals_[i]) == len(SCHEMA["properties"]):
+        results[i] = dict(locals_[i])
+        if keys[i] is not None:
+          self.cache.set(keys[i], results[i])
+        continue
+      todo.append(i)
+
+    for start in range(0, len(todo), self.batch_size):
+      indexes, pres = [], []
+      for i in todo[start:start + self.batch_size]:
+        try:
+          pres.append(self._preprocess(images[i]))
+          indexes.append(i)
+        except Exception:
+          logging.exception("画像の前処理に失敗")
+      for i, data in zip(indexes, self._extract_preprocessed(pres)):
+        if data is None:
+          continue
+        results[i] = {**data, **locals_[i]}
+        if keys[i] is not None:
+          self.cache.set(keys[i], results[i])
+    return results
+
+  async def extract_batch_async(self, images: List[bytes]) -> List[Optional[Dict[str, Any]]]:
+    """extract_batch の asyncio 版（前処理とまとめた呼び出しをスレッドで実行）。"""
+    return await asyncio.to_thread(self.extract_batch, images)
+
+  def _extract_preprocessed(self, pres) -> List[Optional[Dict[str, Any]]]:
+    """前処理済みの画像をまとめて1回で解析する。配列で返ってこなければ1枚ずつ解析し直す。"""
+    if not pres:
+      return []
+    if len(pres) > 1:
+      try:
+        resp = self.limiter.call(
+          self._get_batch_backend().generate_content, [pre.as_blob() for pre in pres], weight=len(pres),
+        )
+        return _parse_json_array(_response_text(resp), len(pres))
+      except Exception as e:
+        logging.warning(f"{len(pres)} 枚のまとめて解析に失敗、1枚ずつ解析します: {e}")
+
+    results = []
+    for pre in pres:
+      try:
+        results.append(self._generate_card([pre.as_blob()], {}))
+      except Exception:
+        logging.exception("Gemini 解析に失敗")
+        results.append(None)
+    return results
+
+  def _preprocess(self, image_bytes: bytes):
+    pre = preprocess_image(image_bytes, self.preprocess_options)
+    logging.info(
+      f"画像前処理: {pre.original_size[0]}x{pre.original_size[1]} -> {pre.output_size[0]}x{pre.output_size[1]}, "
+      f"{pre.original_bytes} -> {pre.output_bytes} bytes（{pre.saved_bytes} bytes 削減）, 前処理 {pre.elapsed_ms:.1f}ms"
+    )
+    return pre
+
+  def _ocr_guess(self, image_bytes: bytes) -> Dict[str, str]:
+    """手元の OCR で信頼度の高い項目を読み取る。全部そろえば Gemini は呼ばない。"""
+    if self.ocr is None:
+      return {}
+    start = time.perf_counter()
+    local = self.ocr.guess(image_bytes)
+    logging.info(
+      f"OCR 前処理: {len(local)}/{len(SCHEMA['properties'])} 項目を読み取り"
+      f"（{(time.perf_counter() - start) * 1000:.0f}ms）{'、Gemini は呼びません' if len(local) == len(SCHEMA['properties']) else ''}"
+    )
+    return local
+
+  def _request_for(self, pre, local: Dict[str, str]):
+    """generate_content の (contents, kwargs)。OCR で読み取れた項目は聞かない。"""
+    if not local:
+      return [pre.as_blob()], {}
+    missing = [k for k in SCHEMA["properties"] if k not in local]
+    schema = {"type": "object", "properties": {k: SCHEMA["properties"][k] for k in missing}}
+    return (
+      [f"Extract only these fields: {', '.join(missing)}.", pre.as_blob()],
+      {"generation_config": {"response_mime_type": "application/json", "response_schema": schema}},
+    )
+
+  def _extract_uncached(self, image_bytes: bytes) -> Dict[str, Any]:
+    local = self._ocr_guess(image_bytes)
+    if len(local) == len(SCHEMA["properties"]):
+      return dict(local)
+    pre = self._preprocess(image_bytes)
+    contents, kwargs = self._request_for(pre, local)
+    return {**self._generate_card(contents, kwargs), **local}
+
+  def _generate_card(self, contents: list, kwargs: dict) -> Dict[str, Any]:
+    """1枚分を解析する。応答が JSON として不正なら、その応答と理由を添えて一度だけ聞き直す。"""
+    resp = self.limiter.call(self._get_backend().generate_content, contents, **kwargs)
+    data, reask = _parse_or_reask(resp, contents)
+    if reask is None:
+      return data
+    resp = self.limiter.call(self._get_backend().generate_content, reask, **kwargs)
+    return _parse_json(_response_text(resp))
+
+  async def _generate_card_async(self, contents: list, kwargs: dict) -> Dict[str, Any]:
+    resp = await self.limiter.call_async(self._get_backend().generate_content_async, contents, **kwargs)
+    data, reask = _parse_or_reask(resp, contents)
+    if reask is None:
+      return data
+    resp = await self.limiter.call_async(self._get_backend().generate_content_async, reask, **kwargs)
+    return _parse_json(_response_text(resp))
+
+_default_parser: Optional[CardParser] = None
+_default_parser_lock = threading.Lock()
+
+def get_parser() -> CardParser:
+  global _default_parser
+  if _default_parser is None:
+    with _default_parser_lock:
+      if _default_parser is None:
+        _default_parser = CardParser()
+  return _default_parser
+
+def set_parser(parser: CardParser):
+  """既定のパーサを差し替える（テストでフェイクのバックエンドを注入する場合など）。"""
+  global _default_parser
+  with _default_parser_lock:
+    _default_parser = parser
+
+def extract_from_bytes(image_bytes: bytes) -> Dict[str, Any]:
+  return get_parser().extract(image_bytes)
 
-  for k in SCHEMA["properties"].keys():
-    data.setdefault(k, "")
+def extract_cards_from_bytes(image_bytes: bytes) -> List[Dict[str, Any]]:
+  return get_parser().extract_cards(image_bytes)
 
-  return data
+def extract_batch_from_bytes(images: List[bytes]) -> List[Optional[Dict[str, Any]]]:
+  return get_parser().extract_batch(images)
@@ -0,0 +1,119 @@
+import io, os, time, logging
+from dataclasses import dataclass
+from typing import Optional, Tuple
+from PIL import Image, ImageOps
+from pillow_heif import register_heif_opener
+from config.metrics import timed
+
+# HEICファイルサポートを有効にする
+register_heif_opener()
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+@dataclass(frozen=True)
+class PreprocessOptions:
+  """Gemini に送る前の縮小・再エンコード設定。名刺の読み取りには長辺1600px程度で十分。"""
+  max_edge: int = 1600
+  format: str = "JPEG"    # JPEG / WEBP
+  quality: int = 85
+  grayscale: bool = False
+
+  @classmethod
+  def from_env(cls) -> "PreprocessOptions":
+    fmt = os.environ.get("IMAGE_FORMAT", "JPEG").upper()
+    if fmt not in MIME_TYPES:
+      raise ValueError(f"IMAGE_FORMAT must be one of {', '.join(MIME_TYPES)}: {fmt}")
+    return cls(
+      max_edge=int(os.environ.get("IMAGE_MAX_EDGE", "1600")),
+      format=fmt,
+      quality=int(os.environ.get("IMAGE_QUALITY", "85")),
+      grayscale=os.environ.get("IMAGE_GRAYSCALE", "").lower() in ("1", "true", "yes"),
+    )
+
+@dataclass(frozen=True)
+class PreprocessResult:
+  data: bytes
+  mime_type: str
+  original_bytes: int
+  original_size: Tuple[int, int]
+  output_size: Tuple[int, int]
+  elapsed_ms: float       # 前処理（デコード〜再エンコード）にかかった時間。縮小で短縮できた時間ではない
+
+  @property
+  def output_bytes(self) -> int:
+    return len(self.data)
+
+  @property
+  def saved_bytes(self) -> int:
+    return self.original_bytes - self.output_bytes
+
+  def as_blob(self) -> dict:
+    """generate_content にそのまま渡せる inline blob。"""
+    return {"mime_type": self.mime_type, "data": self.data}
+
+def open_image(b: bytes) -> Image.Image:
+  """ヘッダだけを読んで画像を開く（ピクセルはまだ展開しない）。"""
+  try:
+    img = Image.open(io.BytesIO(b))
+    logging.debug(f"画像形式: {img.format}")
+    return img
+  except Exception as e:
+    logging.warning(f"画像を開けませんでした（{len(b)} bytes, 先頭 {b[:16]!r}）: {type(e).__name__}: {e}")
+    raise
+
+@timed("decode_image")
+def decode_opened(img: Image.Image, max_edge: Optional[int] = None, mode: str = "RGB") -> Image.Image:
+  """open_image で開いた画像をデコードし、EXIF の向きを反映して mode に変換する。
+
+  max_edge を指定すると、JPEG は draft() で DCT スケーリングを使い、
+  フル解像度を展開せずに max_edge 以上の最小サイズでデコードする。
+  """
+  try:
+    if max_edge:
+      # load() より前に呼ぶ必要がある（JPEG 以外では何もしない）
+      img.draft(mode, (max_edge, max_edge))
+    img = ImageOps.exif_transpose(img)
+    return img.convert(mode)
+  except Exception as e:
+    logging.warning(f"画像をデコードできませんでした（{img.format}, {img.size[0]}x{img.size[1]}）: {type(e).__name__}: {e}")
+    raise
+
+def decode_image(b: bytes, max_edge: Optional[int] = None, mode: str = "RGB") -> Image.Image:
+  """画像のバイト列を decode_opened と同じようにデコードする。"""
+  return decode_opened(open_image(b), max_edge, mode)
+
+def preprocess_image(b: bytes, options: Optional[PreprocessOptions] = None) -> PreprocessResult:
+  """縮小・向き補正・（任意で）グレースケール化して JPEG/WebP に再エンコードする。"""
+  options = options or PreprocessOptions()
+  start = time.perf_counter()
+
+  # 元のサイズは draft() で変わる前に控え、同じ Image をそのままデコードに使う（開くのは1回）
+  img = open_image(b)
+  original_size = img.size
+  mode = "L" if options.grayscale else "RGB"
+  img = decode_opened(img, options.max_edge, mode)
+  return preprocess_decoded(img, options, original_bytes=len(b), original_size=original_size, start=start)
+
+def preprocess_decoded(img: Image.Image, options: Optional[PreprocessOptions] = None,
+                       original_bytes: int = 0, original_size: Optional[Tuple[int, int]] = None,
+                       start: Optional[float] = None) -> PreprocessResult:
+  """デコード済みの画像（複数名刺の切り出しなど）を縮小・再エンコードする。"""
+  options = options or PreprocessOptions()
+  start = time.perf_counter() if start is None else start
+  original_size = original_size or img.size
+  if options.grayscale and img.mode != "L":
+    img = img.convert("L")
+  # reducing_gap を指定すると reduce() で整数倍縮小してから仕上げのリサンプルを行う
+  img.thumbnail((options.max_edge, options.max_edge), Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+  out = io.BytesIO()
+  img.save(out, format=options.format, quality=options.quality)
+
+  return PreprocessResult(
+    data=out.getvalue(),
+    mime_type=MIME_TYPES[options.format],
+    original_bytes=original_bytes,
+    original_size=original_size,
+    output_size=img.size,
+    elapsed_ms=(time.perf_counter() - start) * 1000,
+  )
@@ -0,0 +1,104 @@
+"""Gemini の応答（JSON）の検証と正規化。
+
+SCHEMA から項目ごとの検査・正規化の関数を一度だけ組み立てて使い回す。
+- 文字列以外の値は SchemaError（null は空文字として扱う）
+- 全角英数・記号は半角に、半角カナは全角に揃える（NFKC）
+- 電話番号・郵便番号・メールアドレスは表記を揃える
+orjson が入っていれば JSON のパースに使う。
+"""
+import re, json, unicodedata
+from typing import Any, Callable, Dict, List
+
+try:
+  import orjson
+except ImportError:  # orjson は任意
+  orjson = None
+
+class SchemaError(ValueError):
+  """応答が JSON でない、または SCHEMA に合わない。"""
+
+def loads(text):
+  if orjson is not None:
+    try:
+      return orjson.loads(text)
+    except orjson.JSONDecodeError as e:
+      raise SchemaError(f"invalid JSON: {e}") from e
+  try:
+    return json.loads(text)
+  except json.JSONDecodeError as e:
+    raise SchemaError(f"invalid JSON: {e}") from e
+
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+_DASHES_RE = re.compile(r"[‐‑‒–—―ー−－]")
+
+def _text(value: str) -> str:
+  value = unicodedata.normalize("NFKC", value)
+  return re.sub(r"\s+", " ", value).strip()
+
+def normalize_phone(value: str) -> str:
+  value = _DASHES_RE.sub("-", _text(value))
+  # 括弧・空白の区切りはハイフンに揃える（例: 03 (1234) 5678 -> 03-1234-5678）
+  value = re.sub(r"[\s()]+", "-", value).strip("-")
+  return re.sub(r"-{2,}", "-", value)
+
+def normalize_postal_code(value: str) -> str:
+  value = _DASHES_RE.sub("-", _text(value)).replace("〒", "").strip()
+  m = re.fullmatch(r"(\d{3})-?(\d{4})", value)
+  return f"{m.group(1)}-{m.group(2)}" if m else value
+
+def normalize_email(value: str) -> str:
+  value = _text(value).replace(" ", "")
+  local, sep, domain = value.rpartition("@")
+  return f"{local}@{domain.lower()}" if sep else value
+
+NORMALIZERS: Dict[str, Callable[[str], str]] = {
+  "phone": normalize_phone,
+  "postal_code": normalize_postal_code,
+  "email": normalize_email,
+}
+
+def compile_validator(schema: dict) -> Callable[[Any], Dict[str, str]]:
+  """schema（type: object / 値は string）の検証・正規化関数を作る。"""
+  fields = [
+    (name, NORMALIZERS.get(name, _text))
+    for name, spec in schema["properties"].items()
+    if spec.get("type") == "string"
+  ]
+
+  def validate(data: Any) -> Dict[str, str]:
+    if not isinstance(data, dict):
+      raise SchemaError(f"expected a JSON object, got {type(data).__name__}")
+    out, errors = {}, []
+    for name, normalize in fields:
+      value = data.get(name)
+      if value is None:
+        out[name] = ""
+      elif isinstance(value, str):
+        out[name] = normalize(value) if value else ""
+      else:
+        errors.append(f"{name} must be a string, got {type(value).__name__}")
+    if errors:
+      raise SchemaError("; ".join(errors))
+    return out
+
+  return validate
+
+def _loads_salvaged(text: str, open_ch: str, close_ch: str):
+  """コードフェンスを外してパースし、だめなら最初の open_ch から最後の close_ch までを切り出して再度パースする。"""
+  text = _FENCE_RE.sub("", text)
+  try:
+    return loads(text)
+  except SchemaError:
+    left, right = text.find(open_ch), text.rfind(close_ch)
+    if left < 0 or right <= left:
+      raise
+    return loads(text[left:right + 1])
+
+def parse_object(text: str, validate: Callable[[Any], Dict[str, str]]) -> Dict[str, str]:
+  return validate(_loads_salvaged(text, "{", "}"))
+
+def parse_array(text: str, validate: Callable[[Any], Dict[str, str]], expected: int) -> List[Dict[str, str]]:
+  data = _loads_salvaged(text, "[", "]")
+  if not isinstance(data, list) or len(data) != expected:
+    raise SchemaError(f"expected a JSON array of {expected} objects")
+  return [validate(d) for d in data]
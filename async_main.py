@@ -0,0 +1,23 @@
+# asyncio 版のエントリーポイント（Bolt AsyncApp + aiohttp）
+#   開発: python async_main.py
+#   本番: gunicorn async_main:web_app --worker-class aiohttp.GunicornWebWorker --bind 0.0.0.0:$PORT
+from config.logging import setup_logging
+import os
+import logging
+from dotenv import load_dotenv
+load_dotenv()
+
+log_level = logging.DEBUG if os.environ.get('ENVIRONMENT') == 'development' else logging.INFO
+logger, log_print, safe_log_info = setup_logging(log_level)
+
+from slackApp.async_app import create_web_app
+from AIParcer.parser import get_parser
+
+get_parser().warm_up()
+web_app = create_web_app()
+
+if __name__ == "__main__":
+    from aiohttp import web
+    port = int(os.environ.get("PORT", 3000))
+    safe_log_info(f"Starting async app on port {port}")
+    web.run_app(web_app, host="0.0.0.0", port=port)
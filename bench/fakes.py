@@ -0,0 +1,289 @@
+"""ベンチマーク用のフェイク（ネットワークに出ない）。
+
+- FakeSlackServer: 127.0.0.1 で動く Slack Web API（chat.* / users.info）と url_private のファイル配信
+- FakeGeminiBackend: CardParser の backend に渡す。レイテンシ・429/5xx・壊れた JSON を注入できる
+- FakeWorksheet: gspread の Worksheet の代わり（append_rows / row_values / update）
+"""
+import asyncio
+import io
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+from PIL import Image, ImageDraw
+
+
+class CallCounter:
+    """名前ごとの呼び出し回数（スレッドセーフ）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def add(self, name: str, n: int = 1):
+        with self._lock:
+            self._counts[name] += n
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._counts)
+
+    def total(self) -> int:
+        with self._lock:
+            return sum(self._counts.values())
+
+
+class FakeSlackServer:
+    """Slack Web API と url_private のファイル配信を1つのローカル HTTP サーバで受ける。
+
+    WebClient は base_url=api_url で、ファイルは add_file が返す URL で取得させる。
+    結果メッセージ（save_text ボタン付き）が投稿・更新されたら on_review(channel) を呼ぶ。
+    """
+
+    def __init__(self, api_latency: float = 0.0, download_latency: float = 0.0, on_review=None):
+        self.api_latency = api_latency
+        self.download_latency = download_latency
+        self.on_review = on_review
+        self.calls = CallCounter()
+        self._files = {}   # file_id -> (bytes, content_type)
+        self._ts = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.base_url}/api/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-slack", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_file(self, file_id: str, data: bytes, content_type: str) -> str:
+        self._files[file_id] = (data, content_type)
+        return f"{self.base_url}/files/{file_id}"
+
+    def _next_ts(self) -> str:
+        with self._lock:
+            self._ts += 1
+            return f"1700000000.{self._ts:06d}"
+
+    def _api(self, method: str, params: dict, raw: str) -> dict:
+        self.calls.add(method)
+        if self.api_latency:
+            time.sleep(self.api_latency)
+        channel = params.get("channel", "")
+        if method in ("chat.postMessage", "chat.update"):
+            if self.on_review is not None and "save_text" in raw:
+                self.on_review(channel)
+            ts = params.get("ts") or self._next_ts()
+            return {"ok": True, "channel": channel, "ts": ts, "message": {"ts": ts}}
+        if method == "users.info":
+            user = params.get("user", "")
+            return {"ok": True, "user": {
+                "id": user, "name": "bench",
+                "profile": {"display_name": f"bench-{user}", "real_name": "Bench User"},
+            }}
+        return {"ok": True}
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle_api(self, body: bytes):
+                url = urlparse(self.path)
+                method = url.path[len("/api/"):]
+                raw = body.decode("utf-8", "replace")
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if raw:
+                    if self.headers.get("Content-Type", "").startswith("application/json"):
+                        params.update(json.loads(raw))
+                    else:
+                        params.update({k: v[0] for k, v in parse_qs(raw).items()})
+                resp = server._api(method, params, raw)
+                self._send(200, json.dumps(resp).encode(), "application/json; charset=utf-8")
+
+            def do_GET(self):
+                if self.path.startswith("/api/"):
+                    return self._handle_api(b"")
+                if self.path.startswith("/files/"):
+                    server.calls.add("files.download")
+                    if server.download_latency:
+                        time.sleep(server.download_latency)
+                    item = server._files.get(self.path[len("/files/"):])
+                    if item is None:
+                        return self._send(404, b"not found", "text/plain")
+                    return self._send(200, item[0], item[1])
+                self._send(404, b"not found", "text/plain")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if self.path.startswith("/api/"):
+                    return self._handle_api(body)
+                self._send(404, b"not found", "text/plain")
+
+        return Handler
+
+
+class FakeGeminiError(Exception):
+    """google.api_core の例外と同じく code に HTTP ステータスを持つ。"""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class FakeGeminiBackend:
+    """generate_content / generate_content_async / count_tokens を持つ Gemini の代わり。
+
+    送られた画像（inline blob）の数だけ名刺の結果を返す（2枚以上なら配列）。
+    error_rate の割合で 429 / 503、malformed_rate の割合で JSON でない応答を返す。
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, per_image: float = 0.0,
+                 error_rate: float = 0.0, malformed_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.per_image = per_image
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.calls = CallCounter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._serial = 0
+
+    def _draw(self) -> float:
+        with self._lock:
+            return self._random.random()
+
+    def _delay(self, images: int) -> float:
+        with self._lock:
+            jitter = self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0
+        return max(0.0, self.latency + jitter + self.per_image * images)
+
+    def _card(self) -> dict:
+        with self._lock:
+            self._serial += 1
+            n = self._serial
+        return {
+            "name": f"山田 太郎{n}",
+            "company": "株式会社ベンチ",
+            "postal_code": "100-0001",
+            "address": "東京都千代田区千代田1-1",
+            "email": f"taro{n}@example.com",
+            "website": "https://example.com",
+            "phone": "03-1234-5678",
+        }
+
+    @staticmethod
+    def _images(contents) -> int:
+        # 聞き直しは {"role", "parts"} のターンのリストで届く
+        return sum(
+            FakeGeminiBackend._images(c["parts"]) if isinstance(c, dict) and "parts" in c
+            else int(isinstance(c, dict) and "data" in c)
+            for c in contents
+        )
+
+    def _respond(self, contents) -> SimpleNamespace:
+        images = self._images(contents)
+        self.calls.add("generate_content")
+        roll = self._draw()
+        if roll < self.error_rate:
+            self.calls.add("errors")
+            raise FakeGeminiError(429 if roll < self.error_rate / 2 else 503, "injected error")
+        if roll < self.error_rate + self.malformed_rate:
+            self.calls.add("malformed")
+            return SimpleNamespace(text="Sorry, I can't read this card.")
+        if images > 1:
+            return SimpleNamespace(text=json.dumps([self._card() for _ in range(images)], ensure_ascii=False))
+        return SimpleNamespace(text=json.dumps(self._card(), ensure_ascii=False))
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(self._delay(self._images(contents)))
+        return self._respond(contents)
+
+    async def generate_content_async(self, contents, **kwargs):
+        await asyncio.sleep(self._delay(self._images(contents)))
+        return self._respond(contents)
+
+    def count_tokens(self, contents):
+        return SimpleNamespace(total_tokens=1)
+
+
+class FakeWorksheet:
+    """gspread の Worksheet の代わり。書き込んだ行はメモリに残す。"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = CallCounter()
+        self.rows = []
+        self._header = []
+        self._lock = threading.Lock()
+
+    def row_values(self, row: int) -> list:
+        self.calls.add("row_values")
+        return list(self._header) if row == 1 else []
+
+    def update(self, range_name, values):
+        self.calls.add("update")
+        if range_name == "A1":
+            self._header = list(values[0])
+
+    def append_rows(self, rows, value_input_option=None):
+        self.calls.add("append_rows")
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.rows.extend(rows)
+
+
+def make_card_image(width: int = 2400, height: int = 1600, cards: int = 1, seed: int = 0) -> bytes:
+    """名刺を写したような JPEG を作る（暗い机の上に白い名刺と文字の代わりの線）。"""
+    rnd = random.Random(seed)
+    img = Image.new("RGB", (width, height), (60, 55, 50))
+    draw = ImageDraw.Draw(img)
+    cols = min(cards, 2)
+    rows = (cards + cols - 1) // cols
+    cell_w, cell_h = width // cols, height // rows
+    for i in range(cards):
+        cx, cy = (i % cols) * cell_w, (i // cols) * cell_h
+        card_w = int(cell_w * 0.8)
+        card_h = min(int(card_w / 1.65), int(cell_h * 0.8))
+        left, top = cx + (cell_w - card_w) // 2, cy + (cell_h - card_h) // 2
+        draw.rectangle((left, top, left + card_w, top + card_h), fill=(245, 245, 240))
+        for line in range(6):
+            y = top + card_h * (line + 1) // 8
+            length = int(card_w * rnd.uniform(0.3, 0.8))
+            draw.rectangle((left + card_w // 10, y, left + card_w // 10 + length, y + card_h // 40), fill=(30, 30, 30))
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
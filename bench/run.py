@@ -0,0 +1,353 @@
+"""名刺スキャンの処理全体をローカルのフェイク相手に流し、スループットとステージごとの所要時間を測る。
+
+    python -m bench.run --cards 200 --channels 8 --gemini-latency 1.5 --json bench.json
+
+handle_message_events にファイル付きメッセージを渡し、結果メッセージが出るたびに
+save_text / edit_text → save_changes / cancel_text を押して次へ進める。
+Slack・Gemini・Sheets は bench/fakes.py のフェイクで、ネットワークには出ない（CI で回帰を数字で見る用途）。
+ステージの所要時間は、該当する関数をこのプロセスの中だけラップして測る。
+PARSE_BATCH_SIZE / PREFETCH_DEPTH / SCAN_WORKERS / SHEETS_* などの環境変数は本番と同じく効く。
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from slack_sdk import WebClient
+from slack_bolt.context.say import Say
+from bench.fakes import FakeGeminiBackend, FakeSlackServer, FakeWorksheet, make_card_image
+
+BOT_TOKEN = "xoxb-bench"
+TEAM_ID = "TBENCH"
+STAGES = ["download", "detect", "preprocess", "parse", "post", "sheet_write"]
+NOT_AN_IMAGE = b"%PDF-1.4\n%bench\n" + b"0" * 1024
+
+
+class StageTimer:
+    """ステージごとの所要時間（秒）を集めて、件数と p50 / p95 / p99 を出す。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(list)
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self._samples[stage].append(seconds)
+
+    def wrap(self, stage: str, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    def summary(self) -> dict:
+        with self._lock:
+            samples = {k: sorted(v) for k, v in self._samples.items()}
+        out = {}
+        for stage, values in samples.items():
+            pct = lambda q: values[min(len(values) - 1, int(len(values) * q))]
+            out[stage] = {"count": len(values), "p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99)}
+        return out
+
+
+class TimedWebClient(WebClient):
+    """chat.* の呼び出し時間を post ステージとして記録する WebClient。"""
+
+    def __init__(self, timer: StageTimer, **kwargs):
+        super().__init__(**kwargs)
+        self._timer = timer
+
+    def api_call(self, api_method, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().api_call(api_method, **kwargs)
+        finally:
+            if api_method.startswith("chat."):
+                self._timer.record("post", time.perf_counter() - start)
+
+
+def _configure_env(args):
+    """slackApp を import する前に、ローカルだけで完結する設定にしておく。"""
+    os.environ.setdefault("SLACK_SIGNING_SECRET", "bench")
+    os.environ.setdefault("SLACK_CLIENT_ID", "bench")
+    os.environ.setdefault("SLACK_CLIENT_SECRET", "bench")
+    # 本物の DB には繋がない（インストール情報の参照は通らないので中身は空でよい）
+    os.environ["DATABASE_URL"] = "sqlite://"
+    os.environ["SCAN_STATE_BACKEND"] = "memory"
+    os.environ["SCAN_JOURNAL"] = ""
+    os.environ["SCAN_JOB_BACKEND"] = "thread"
+    os.environ["GEMINI_RATE_BACKEND"] = "memory"
+    os.environ["MULTI_CARD_DETECTION"] = "true" if args.multi_card else ""
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.timer = StageTimer()
+        self.random = random.Random(args.seed)
+        self.reviews = {f"CBENCH{i:03d}": queue.Queue() for i in range(args.channels)}
+        self.actions = defaultdict(int)
+        self._actions_lock = threading.Lock()
+        self.slack = FakeSlackServer(
+            api_latency=args.slack_latency,
+            download_latency=args.download_latency,
+            on_review=lambda channel: self.reviews[channel].put(channel) if channel in self.reviews else None,
+        )
+        self.gemini = FakeGeminiBackend(
+            latency=args.gemini_latency,
+            jitter=args.gemini_jitter,
+            per_image=args.gemini_per_image,
+            error_rate=args.gemini_error_rate,
+            malformed_rate=args.gemini_malformed_rate,
+            seed=args.seed,
+        )
+        self.worksheet = FakeWorksheet(latency=args.sheets_latency)
+        self.client = None
+
+    def _instrument(self):
+        """フェイクを差し込み、各ステージの関数を計測用にラップする。"""
+        import google.sheets as sheets
+        from AIParcer import parser as parser_module
+        from AIParcer.limiter import create_limiter
+        from slackApp import flow, handlers
+
+        flow._download_image = self.timer.wrap("download", flow._download_image)
+        parser_module.detect_card_boxes = self.timer.wrap("detect", parser_module.detect_card_boxes)
+        parser_module.preprocess_image = self.timer.wrap("preprocess", parser_module.preprocess_image)
+        parser_module.preprocess_decoded = self.timer.wrap("preprocess", parser_module.preprocess_decoded)
+
+        # parse はリミッターの待ち・リトライを含めた Gemini 呼び出し1回分（まとめて解析なら数枚分）
+        limiter = create_limiter()
+        limiter.call = self.timer.wrap("parse", limiter.call)
+        parser_module.set_parser(parser_module.CardParser(backend=self.gemini, cache=None, limiter=limiter, ocr=None))
+
+        sheets.get_worksheet = lambda: self.worksheet
+        append = handlers.append_record_to_sheet
+
+        def timed_append(record, slack_user_label=""):
+            # シートへの書き込みは SheetWriter がまとめて行うので、追記の依頼から完了までを測る
+            start = time.perf_counter()
+            fut = append(record, slack_user_label=slack_user_label)
+            fut.add_done_callback(lambda _: self.timer.record("sheet_write", time.perf_counter() - start))
+            return fut
+
+        handlers.append_record_to_sheet = timed_append
+
+    def _make_files(self) -> dict:
+        """チャンネルごとのファイル（Slack の files[] と同じ形）を作り、フェイクのサーバに載せる。"""
+        args = self.args
+        per_image = 2 if args.multi_card else 1
+        images = [
+            make_card_image(args.image_width, args.image_height, cards=per_image, seed=i)
+            for i in range(min(8, max(1, args.cards)))
+        ]
+        channels = list(self.reviews)
+        files = {ch: [] for ch in channels}
+        for i in range(args.cards):
+            ch = channels[i % len(channels)]
+            file_id = f"F{i:06d}"
+            if self.random.random() < args.non_image_ratio:
+                data, mimetype, filetype = NOT_AN_IMAGE, "application/pdf", "pdf"
+            else:
+                data, mimetype, filetype = images[i % len(images)], "image/jpeg", "jpg"
+            url = self.slack.add_file(file_id, data, mimetype)
+            files[ch].append({
+                "id": file_id, "name": f"{file_id}.{filetype}", "mimetype": mimetype, "filetype": filetype,
+                "url_private": url, "url_private_download": url,
+            })
+        return files
+
+    def _count(self, action: str):
+        with self._actions_lock:
+            self.actions[action] += 1
+
+    def _review(self, channel: str, user: str, say):
+        """結果メッセージのボタンを押す（保存・編集して保存・キャンセルを割合で選ぶ）。"""
+        from slackApp import handlers
+
+        ack = lambda *a, **k: None
+
+        def body(action_id: str, **extra) -> dict:
+            return dict({
+                "type": "block_actions",
+                "team": {"id": TEAM_ID},
+                "user": {"id": user, "team_id": TEAM_ID},
+                "channel": {"id": channel},
+                "actions": [{"action_id": action_id}],
+            }, **extra)
+
+        roll = self.random.random()
+        if roll < self.args.edit_ratio:
+            handlers.handle_edit_text(ack, body("edit_text"), say)
+            values = {"edit_name": {"name": {"type": "plain_text_input", "value": "編集 太郎"}}}
+            handlers.handle_save_changes(ack, body("save_changes", state={"values": values}), say, self.client)
+            self._count("edit_text")
+        elif roll < self.args.edit_ratio + self.args.cancel_ratio:
+            handlers.handle_cancel_text(ack, body("cancel_text"), say)
+            self._count("cancel_text")
+        else:
+            handlers.handle_save_text(ack, body("save_text"), say, self.client)
+            self._count("save_text")
+
+    def _idle(self, channel: str) -> bool:
+        from slackApp.flow import state
+        # 待ち行列が空になると release で進捗が 0 に戻る
+        return (
+            self.reviews[channel].empty()
+            and state.queue_length(channel) == 0
+            and state.get_progress(channel)["total"] == 0
+        )
+
+    def _drive(self, channel: str, files: list):
+        """1チャンネル分：メッセージを投げ、結果が出るたびにボタンを押し、処理し終わるまで待つ。"""
+        from slackApp import handlers
+
+        say = Say(self.client, channel)
+        user = f"U{channel}"
+        step = max(1, self.args.files_per_message)
+        for start in range(0, len(files), step):
+            body = {
+                "team_id": TEAM_ID,
+                "event": {"type": "message", "channel": channel, "user": user, "files": files[start:start + step]},
+            }
+            handlers.handle_message_events(body, say, {"bot_token": BOT_TOKEN}, self.client)
+
+        deadline = time.monotonic() + self.args.timeout
+        while True:
+            try:
+                self.reviews[channel].get(timeout=0.05)
+            except queue.Empty:
+                if self._idle(channel):
+                    return
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"{channel}: {self.args.timeout}s 以内に処理が終わりませんでした")
+                continue
+            self._review(channel, user, say)
+
+    def run(self) -> dict:
+        self.slack.start()
+        self._instrument()
+        self.client = TimedWebClient(self.timer, token=BOT_TOKEN, base_url=self.slack.api_url)
+        files = self._make_files()
+
+        from google.sheets import get_sheet_writer
+        from slackApp.handlers import prefetcher
+        from slackApp.worker import scan_jobs
+
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=len(files), thread_name_prefix="bench-channel") as executor:
+                for fut in [executor.submit(self._drive, ch, fs) for ch, fs in files.items()]:
+                    fut.result()
+            elapsed = time.perf_counter() - start
+            get_sheet_writer().flush(timeout=self.args.timeout)
+        finally:
+            scan_jobs.shutdown(wait=True, timeout=10)
+            prefetcher.shutdown(wait=False)
+            get_sheet_writer().close(timeout=10)
+            self.slack.stop()
+        return self._report(elapsed)
+
+    def _report(self, elapsed: float) -> dict:
+        cards = sum(self.actions.values())
+        slack_calls = self.slack.calls.snapshot()
+        downloads = slack_calls.pop("files.download", 0)
+        gemini_calls = self.gemini.calls.snapshot()
+        sheets_calls = self.worksheet.calls.snapshot()
+        per_card = lambda n: n / cards if cards else 0.0
+        return {
+            "files": self.args.cards,
+            "cards": cards,
+            "seconds": elapsed,
+            "cards_per_second": cards / elapsed if elapsed else 0.0,
+            "actions": dict(self.actions),
+            "stages": self.timer.summary(),
+            "calls_per_card": {
+                "slack": per_card(sum(slack_calls.values())),
+                "download": per_card(downloads),
+                "gemini": per_card(gemini_calls.get("generate_content", 0)),
+                "sheets": per_card(sheets_calls.get("append_rows", 0)),
+            },
+            "calls": {"slack": slack_calls, "gemini": gemini_calls, "sheets": sheets_calls},
+            "rows_written": len(self.worksheet.rows),
+        }
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"{report['cards']} 件 / {report['files']} ファイル, {report['seconds']:.2f}s, "
+        f"{report['cards_per_second']:.2f} cards/s",
+        f"操作: {json.dumps(report['actions'])}",
+        "",
+        f"{'stage':<12} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9}",
+    ]
+    for stage in STAGES:
+        s = report["stages"].get(stage)
+        if s is None:
+            lines.append(f"{stage:<12} {0:>6} {'-':>9} {'-':>9} {'-':>9}")
+            continue
+        lines.append(
+            f"{stage:<12} {s['count']:>6} {s['p50'] * 1000:>7.1f}ms {s['p95'] * 1000:>7.1f}ms {s['p99'] * 1000:>7.1f}ms"
+        )
+    lines.append("")
+    lines.append("1件あたりの呼び出し: " + ", ".join(f"{k}={v:.2f}" for k, v in report["calls_per_card"].items()))
+    for name, calls in report["calls"].items():
+        lines.append(f"  {name}: {json.dumps(calls)}")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(prog="python -m bench.run", description=__doc__.splitlines()[0])
+    p.add_argument("--cards", type=int, default=100, help="投稿するファイル数")
+    p.add_argument("--channels", type=int, default=4, help="同時に使う DM チャンネル数")
+    p.add_argument("--files-per-message", type=int, default=5)
+    p.add_argument("--non-image-ratio", type=float, default=0.05, help="画像以外（スキップされる）ファイルの割合")
+    p.add_argument("--multi-card", action="store_true", help="1枚に名刺2枚の写真を使い MULTI_CARD_DETECTION を有効にする")
+    p.add_argument("--image-width", type=int, default=2400)
+    p.add_argument("--image-height", type=int, default=1600)
+    p.add_argument("--edit-ratio", type=float, default=0.1, help="edit_text → save_changes で終える割合")
+    p.add_argument("--cancel-ratio", type=float, default=0.05, help="cancel_text で終える割合")
+    p.add_argument("--slack-latency", type=float, default=0.02, help="Web API 1回あたりの秒数")
+    p.add_argument("--download-latency", type=float, default=0.03)
+    p.add_argument("--gemini-latency", type=float, default=0.8)
+    p.add_argument("--gemini-jitter", type=float, default=0.3)
+    p.add_argument("--gemini-per-image", type=float, default=0.1, help="画像1枚ごとに足す秒数")
+    p.add_argument("--gemini-error-rate", type=float, default=0.0, help="429 / 503 を返す割合")
+    p.add_argument("--gemini-malformed-rate", type=float, default=0.0, help="JSON でない応答を返す割合")
+    p.add_argument("--sheets-latency", type=float, default=0.3, help="append_rows 1回あたりの秒数")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--timeout", type=float, default=600, help="1チャンネルの処理を待つ上限（秒）")
+    p.add_argument("--json", metavar="PATH", help="結果を JSON で書き出す")
+    p.add_argument("--min-cards-per-second", type=float, default=0.0, help="下回ったら終了コード 1（CI 用）")
+    p.add_argument("--verbose", action="store_true", help="アプリのログ（INFO）も出す")
+    return p.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    _configure_env(args)
+    from config.logging import setup_logging
+    setup_logging(logging.INFO if args.verbose else logging.WARNING)
+
+    report = Bench(args).run()
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fp:
+            json.dump(report, fp, ensure_ascii=False, indent=2)
+    if report["cards_per_second"] < args.min_cards_per_second:
+        print(f"cards/s が下限 {args.min_cards_per_second} を下回りました", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
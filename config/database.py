@@ -0,0 +1,44 @@
+import os
+import logging
+import threading
+from sqlalchemy import create_engine
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """DATABASE_URL の SQLAlchemy Engine をプロセス内で1つだけ作って共有する。"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = _create_engine()
+    return _engine
+
+def _create_engine():
+    database_url = os.environ.get("DATABASE_URL")
+    try:
+        if database_url.startswith("sqlite"):
+            # ベンチマーク・ローカル確認用（接続プールの設定は PostgreSQL 向け）
+            engine = create_engine(database_url)
+        else:
+            engine = create_engine(
+                database_url,
+                pool_size=5,
+                max_overflow=10,
+                pool_timeout=30,
+                pool_recycle=1800,
+                pool_pre_ping=True,
+                connect_args={
+                    "connect_timeout": 30,
+                    "keepalives_idle": 120,
+                    "keepalives_interval": 30,
+                    "keepalives_count": 3,
+                }
+            )
+        with engine.connect():
+            logging.info("データベース接続テスト成功")
+    except Exception as e:
+        logging.exception(f"データベース接続エラー: {e}")
+        raise
+    return engine
@@ -1,19 +1,173 @@
+"""ログ設定。
+
+ロガーのハンドラは QueueHandler だけにし、stdout への書き出しは QueueListener のスレッドで行う
+（リクエスト・ワーカーのスレッドは stdout の書き込みを待たない）。
+1レコード1行の JSON で、contextvars に積んだ相関 ID（team_id / channel_id / file_id / job_id）を付ける。
+DEBUG の行は LOG_DEBUG_SAMPLE_RATE の割合だけ残す（大量に出る行でキューを膨らませない）。
+LOG_FORMAT=text で従来の1行テキストにする（ローカルで読む場合）。
+"""
+import atexit
+import contextvars
+import itertools
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
 import sys
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+CONTEXT_FIELDS = ("team_id", "channel_id", "file_id", "job_id")
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_log_context = contextvars.ContextVar("log_context", default={})
+_job_ids = itertools.count(1)
+
+
+def get_log_context() -> dict:
+    return _log_context.get()
+
+
+def bind_log_context(**fields):
+    """現在のコンテキスト（スレッド / タスク / ctx.run の中）に相関 ID を足す。空の値は無視する。"""
+    _log_context.set({**_log_context.get(), **{k: v for k, v in fields.items() if v}})
+
+
+@contextmanager
+def log_context(**fields):
+    """with の間だけ相関 ID を足す。"""
+    token = _log_context.set({**_log_context.get(), **{k: v for k, v in fields.items() if v}})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+def job_context(**fields) -> contextvars.Context:
+    """今の相関 ID を引き継いで fields を足した Context。別スレッドで ctx.run(fn, ...) して使う。"""
+    ctx = contextvars.copy_context()
+    ctx.run(bind_log_context, **fields)
+    return ctx
+
+
+def new_job_id() -> str:
+    return f"{os.getpid()}-{next(_job_ids)}"
+
+
+class ContextFilter(logging.Filter):
+    """呼び出し元のスレッドで相関 ID をレコードに写す（QueueHandler に入る前に実行される）。"""
+
+    def filter(self, record):
+        record.log_context = _log_context.get()
+        return True
+
+
+class DebugSampler(logging.Filter):
+    """DEBUG のレコードを rate の割合だけ通す。INFO 以上は常に通す。"""
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1.0 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        data.update(getattr(record, "log_context", None) or {})
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        context = getattr(record, "log_context", None)
+        if context:
+            text += " [" + " ".join(f"{k}={context[k]}" for k in CONTEXT_FIELDS if k in context) + "]"
+        return text
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """整形（相関 ID・例外のトレースバックを含む）は呼び出し元で済ませ、キューには文字列だけを積む。"""
+
+    def prepare(self, record):
+        msg = self.format(record)
+        record = logging.makeLogRecord({
+            "name": record.name, "levelno": record.levelno, "levelname": record.levelname, "created": record.created,
+        })
+        record.msg = msg
+        return record
+
+
+_handler = _QueueHandler(queue.SimpleQueue())
+_listener = None
+
+
+def _start_listener():
+    global _listener
+    # 書き出し側は整形済みの1行をそのまま出すだけ
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(message)s"))
+    _handler.queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(_handler.queue, stream)
+    _listener.start()
+
+
+def _restart_after_fork():
+    # gunicorn の preload 後の fork ではリスナーのスレッドが子に引き継がれないので作り直す
+    if _listener is not None:
+        _start_listener()
+
+
+def stop_logging():
+    """キューに残ったレコードを書き出してリスナーを止める（終了時）。"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
 
 def setup_logging(log_level=logging.INFO):
-    import sys
-    logging.basicConfig(
-        level=log_level,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        stream=sys.stdout,
-        force=True
-    )
+    stop_logging()
+    _start_listener()
+    if os.environ.get("LOG_FORMAT", "json").lower() == "text":
+        _handler.setFormatter(TextFormatter(TEXT_FORMAT))
+    else:
+        _handler.setFormatter(JsonFormatter())
+    for f in list(_handler.filters):
+        _handler.removeFilter(f)
+    _handler.addFilter(DebugSampler(float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "1"))))
+    _handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(_handler)
+    root.setLevel(log_level)
+
     logger = logging.getLogger(__name__)
+
+    # 既存の呼び出し側（main.py / wsgi.py など）との互換用。どちらもロガーに出すだけ
     def log_print(message, level="INFO"):
-        timestamp = __import__('datetime').datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        print(f"[{timestamp}] [{level}] {message}", flush=True)
+        logger.log(logging.getLevelName(level), message)
+
     def safe_log_info(message):
         logger.info(message)
-        log_print(message, "INFO")
     return logger, log_print, safe_log_info
+
+
+atexit.register(stop_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_after_fork)
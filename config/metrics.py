@@ -0,0 +1,243 @@
+"""処理のステージごとの所要時間・件数を集計し、Prometheus のテキスト形式で出す。
+
+METRICS_ENABLED=true のときだけ集計する。無効なら observe / inc / set はすぐ戻り、
+timed で包んだ関数は包まずにそのまま返すので、ほぼ負荷はかからない。
+既存の集計（download_stats などの snapshot）は register_snapshot で登録しておくと、
+/metrics を読んだときにその時点の値を出す。
+"""
+import os
+import time
+import threading
+from bisect import bisect_left
+from contextlib import nullcontext
+from functools import wraps
+
+PREFIX = "slack_image_bot"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 秒。Slack への投稿（数十 ms）から Gemini（数秒〜数十秒）までを1つのバケット列で見る
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    items = key + extra
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, registry: "Registry", name: str, help_text: str):
+        self._registry = registry
+        self.name = f"{PREFIX}_{name}"
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._values = {}   # ラベルの (name, value) のタプル -> 値
+
+    def _header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def collect(self) -> list:
+        with self._lock:
+            values = sorted(self._values.items())
+        return self._header() + [f"{self.name}{_format_labels(k)} {_format_value(v)}" for k, v in values]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if not self._registry.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        if not self._registry.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        if not self._registry.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            item[0][i] += 1
+            item[1] += value
+            item[2] += 1
+
+    def collect(self) -> list:
+        with self._lock:
+            values = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        lines = self._header()
+        for key, (counts, total, count) in values:
+            acc = 0
+            for le, n in zip(self.buckets + (float("inf"),), counts):
+                acc += n
+                lines.append(f"{self.name}_bucket{_format_labels(key, (('le', _format_value(le)),))} {acc}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._snapshots = {}   # name -> (snapshot_fn, help, counters)
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._add(Counter(self, name, help_text))
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._add(Gauge(self, name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(self, name, help_text, buckets))
+
+    def _add(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_snapshot(self, name: str, snapshot_fn, help_text: str, counters=()):
+        """snapshot_fn() が返す {key: 数値} を name_key として出す。counters のキーは累計（_total）。
+        同じ name で登録し直すと置き換える（パーサ・リミッターを作り直した場合など）。"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._snapshots[name] = (snapshot_fn, help_text, frozenset(counters))
+
+    def _collect_snapshot(self, name: str, snapshot_fn, help_text: str, counters) -> list:
+        lines = []
+        for key, value in snapshot_fn().items():
+            if not isinstance(value, (int, float)):
+                continue
+            counter = key in counters
+            suffix = "_total" if counter and not key.endswith("_total") else ""
+            metric = f"{PREFIX}_{name}_{key}{suffix}"
+            lines += [
+                f"# HELP {metric} {help_text}（{key}）",
+                f"# TYPE {metric} {'counter' if counter else 'gauge'}",
+                f"{metric} {_format_value(value)}",
+            ]
+        return lines
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+            snapshots = sorted(self._snapshots.items())
+        lines = []
+        for metric in metrics:
+            lines += metric.collect()
+        for name, (snapshot_fn, help_text, counters) in snapshots:
+            try:
+                lines += self._collect_snapshot(name, snapshot_fn, help_text, counters)
+            except Exception as e:
+                lines.append(f"# {name}: snapshot failed: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry(os.environ.get("METRICS_ENABLED", "").lower() in ("1", "true", "yes"))
+
+# 処理のステージ（stage ラベル）ごとの所要時間と失敗数
+stage_seconds = registry.histogram("stage_seconds", "処理ステージごとの所要時間（秒）")
+stage_errors = registry.counter("stage_errors_total", "処理ステージごとの失敗数")
+# 待ち行列の残り件数（チャンネル数に比例して系列が増えないよう、ラベルなしの集計だけを出す）
+queue_depth = registry.gauge("queue_depth", "全チャンネルの待ち行列の残り件数の合計")
+queue_depth_max = registry.gauge("queue_depth_max", "待ち行列が最も長いチャンネルの残り件数")
+queue_channels_nonempty = registry.gauge("queue_channels_nonempty", "待ち行列が空でないチャンネルの数")
+
+
+def enabled() -> bool:
+    return registry.enabled
+
+
+def observe_stage(stage: str, seconds: float, ok: bool = True):
+    if not registry.enabled:
+        return
+    stage_seconds.observe(seconds, stage=stage)
+    if not ok:
+        stage_errors.inc(stage=stage)
+
+
+class _StageTimer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe_stage(self.name, time.perf_counter() - self.start, exc_type is None)
+
+
+_NOOP = nullcontext()
+
+
+def stage(name: str):
+    """with stage("slack_post"): ... で囲んだ処理の所要時間を記録する。"""
+    return _StageTimer(name) if registry.enabled else _NOOP
+
+
+def timed(name: str):
+    """関数の所要時間を name のステージとして記録するデコレータ。無効なら関数をそのまま返す。"""
+    def decorator(fn):
+        if not registry.enabled:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            ok = False
+            try:
+                result = fn(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                observe_stage(name, time.perf_counter() - start, ok)
+        return wrapper
+    return decorator
+
+
+def register_snapshot(name: str, snapshot_fn, help_text: str, counters=()):
+    registry.register_snapshot(name, snapshot_fn, help_text, counters)
+
+
+def render() -> str:
+    return registry.render()
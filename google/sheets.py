@@ -1,7 +1,14 @@
 import os
 import json
+import time
+import atexit
+import random
+import logging
+import threading
+from concurrent.futures import Future
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
+from config import metrics
 from datetime import datetime, timezone, timedelta
 
 SCOPES = [
@@ -45,11 +52,145 @@ def ensure_header(ws):
     if len(existing) < len(HEADER) or existing[:len(HEADER)] != HEADER:
         ws.update("A1", [HEADER])
 
-def append_record_to_sheet(record: dict, slack_user_label: str = ""):
-    """名刺情報1件を1行追記。"""
-    ws = get_worksheet()
-    ensure_header(ws)
+def _is_retryable(e: Exception) -> bool:
+    """429（クォータ超過）と 5xx だけをリトライ対象にする。
+    タイムアウト・接続断は追記が済んでいる場合があり、やり直すと行が重複するのでリトライしない。"""
+    if isinstance(e, gspread.exceptions.APIError):
+        status = getattr(e.response, "status_code", None)
+        return status == 429 or (status is not None and status >= 500)
+    return False
 
+
+class SheetWriter:
+    """認証済みクライアントとワークシートを保持し、行をまとめて append_rows する。
+
+    append() は行をバッファに積んで Future を返す。バッファが batch_size 件に達するか、
+    最初の行から flush_interval 秒経つとバックグラウンドスレッドが書き込む。
+    """
+
+    def __init__(self, batch_size: int = 20, flush_interval: float = 2.0,
+                 max_retries: int = 5, backoff_base: float = 1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self._cond = threading.Condition()
+        self._rows = []            # [(row, Future), ...]
+        self._first_row_at = None
+        self._writing = False
+        self._closed = False
+        self._thread = None
+        self._ws = None
+
+    def _worksheet(self):
+        # 認証・シート取得・ヘッダ確認は初回（またはエラーでリセットした後）だけ
+        if self._ws is None:
+            ws = get_worksheet()
+            ensure_header(ws)
+            self._ws = ws
+        return self._ws
+
+    def append(self, row: list) -> Future:
+        fut = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("SheetWriter is closed")
+            if self._thread is None:
+                # gunicorn の preload 後に fork しても動くよう、スレッドは初回利用時に起動
+                self._thread = threading.Thread(target=self._run, name="sheet-writer", daemon=True)
+                self._thread.start()
+            if not self._rows:
+                self._first_row_at = time.monotonic()
+            self._rows.append((row, fut))
+            self._cond.notify_all()
+        return fut
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._rows and (
+                        self._closed
+                        or len(self._rows) >= self.batch_size
+                        or time.monotonic() - self._first_row_at >= self.flush_interval
+                    ):
+                        break
+                    if self._closed:
+                        return
+                    timeout = None
+                    if self._rows:
+                        timeout = self.flush_interval - (time.monotonic() - self._first_row_at)
+                    self._cond.wait(timeout)
+                batch = self._rows[:self.batch_size]
+                del self._rows[:self.batch_size]
+                if self._rows:
+                    self._first_row_at = time.monotonic()
+                self._writing = True
+            try:
+                self._write_batch(batch)
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def _write_batch(self, batch):
+        rows = [row for row, _ in batch]
+        for attempt in range(self.max_retries + 1):
+            try:
+                with metrics.stage("append_rows"):
+                    self._worksheet().append_rows(rows, value_input_option="USER_ENTERED")
+                logging.info(f"スプレッドシートに {len(rows)} 行追記しました")
+                for _, fut in batch:
+                    fut.set_result(None)
+                return
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_retryable(e):
+                    logging.exception(f"スプレッドシートへの追記に失敗（{len(rows)} 行）: {e}")
+                    # 次回は認証からやり直す
+                    self._ws = None
+                    for _, fut in batch:
+                        fut.set_exception(e)
+                    return
+                delay = self.backoff_base * (2 ** attempt) + random.uniform(0, self.backoff_base)
+                logging.warning(f"スプレッドシート API エラーのため {delay:.1f} 秒後にリトライ（{attempt + 1}/{self.max_retries}）: {e}")
+                time.sleep(delay)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """バッファが空になり書き込みが終わるまで待つ。"""
+        with self._cond:
+            if self._rows:
+                self._first_row_at = time.monotonic() - self.flush_interval
+                self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._rows and not self._writing, timeout=timeout)
+
+    def close(self, timeout: float | None = 30):
+        """残りを書き出してスレッドを止める（シャットダウン時）。"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_sheet_writer() -> SheetWriter:
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = SheetWriter(
+                    batch_size=int(os.environ.get("SHEETS_BATCH_SIZE", "20")),
+                    flush_interval=float(os.environ.get("SHEETS_FLUSH_INTERVAL", "2")),
+                )
+                atexit.register(_writer.close)
+    return _writer
+
+def append_record_to_sheet(record: dict, slack_user_label: str = "") -> Future:
+    """名刺情報1件を1行追記（SheetWriter でまとめて書き込む）。
+    書き込み完了（または失敗）は戻り値の Future で受け取れる。"""
     # JST タイムスタンプ
     jst = timezone(timedelta(hours=9))
     ts = datetime.now(jst).strftime("%Y-%m-%d %H:%M:%S")
@@ -66,4 +207,4 @@ def append_record_to_sheet(record: dict, slack_user_label: str = ""):
         record.get("website", ""),
         record.get("phone", ""),
     ]
-    ws.append_row(row, value_input_option="USER_ENTERED")
\ No newline at end of file
+    return get_sheet_writer().append(row)
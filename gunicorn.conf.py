@@ -0,0 +1,49 @@
+# gunicorn 設定（Procfile: gunicorn -c gunicorn.conf.py wsgi:flask_app）
+#
+# 並行数について:
+#   SCAN_STATE_BACKEND=memory（既定）ではチャンネルの待ち行列がプロセス内にあるため、
+#   ワーカープロセスは必ず1つにする（WEB_CONCURRENCY は 1 に固定される）。
+#   スレッド数（GUNICORN_THREADS）は増やしてよい。
+#   SCAN_STATE_BACKEND=sql なら状態は DB で共有されるので WEB_CONCURRENCY を増やせる。
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '3000')}"
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+# SIGTERM 後、処理中のリクエストとスキャンを待つ秒数
+graceful_timeout = int(os.environ.get("SHUTDOWN_GRACE_SECONDS", "30"))
+# Slack App・OAuth 設定をマスターで1回だけ読み込んでから fork する
+# （Gemini クライアントは gRPC の接続が fork を越えられないため、ワーカーごとに post_worker_init で作る）
+preload_app = True
+accesslog = "-"
+
+if workers > 1 and os.environ.get("SCAN_STATE_BACKEND", "memory") != "sql":
+    print("SCAN_STATE_BACKEND=memory では複数プロセスで状態を共有できないため、WEB_CONCURRENCY=1 で起動します", flush=True)
+    workers = 1
+
+
+def post_fork(server, worker):
+    # マスターで張った DB 接続を子プロセスで使い回さない
+    from config import database
+    if database._engine is not None:
+        database._engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    # Gemini クライアントを fork 後に作っておき、初回の解析で設定コストを払わない
+    from AIParcer.parser import get_parser
+    get_parser().warm_up()
+    # 前のプロセスが終えられなかったスキャン（SCAN_JOURNAL）を引き取って再開する（スレッドは fork 後に作る）
+    from slackApp.handlers import recover_jobs
+    recover_jobs()
+
+
+# graceful_timeout はマスターが SIGTERM を送った時点から数えるので、後片付けはそれより短く切り上げる
+shutdown_margin = int(os.environ.get("SHUTDOWN_MARGIN_SECONDS", "5"))
+
+
+def worker_exit(server, worker):
+    import wsgi
+    wsgi.shutdown(timeout=max(1, graceful_timeout - shutdown_margin))
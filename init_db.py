@@ -9,6 +9,11 @@ from slack_sdk.oauth.installation_store.sqlalchemy import SQLAlchemyInstallation
 from slack_sdk.oauth.state_store.sqlalchemy import SQLAlchemyOAuthStateStore
 from sqlalchemy import create_engine, MetaData, Table, Column, String, DateTime, Text, Integer, text
 from sqlalchemy.sql import func
+from AIParcer import cache as parse_cache
+from AIParcer import limiter as gemini_limiter
+from slackApp import dedup as event_dedup
+from slackApp import journal as scan_journal
+from slackApp import state as scan_state
 
 load_dotenv()
 
@@ -102,6 +107,12 @@ def init_database():
         print("既存テーブルを削除して新しいテーブルを作成中...")
         metadata.drop_all(engine)
         metadata.create_all(engine)
+        # アプリ側で定義しているテーブル（既存データは残す）
+        parse_cache.create_tables(engine)
+        scan_state.create_tables(engine)
+        gemini_limiter.create_tables(engine)
+        event_dedup.create_tables(engine)
+        scan_journal.create_tables(engine)
 
         # 作成されたテーブルを確認
         with engine.connect() as conn:
@@ -10,7 +10,14 @@ logger, log_print, safe_log_info = setup_logging(log_level)
 
 if __name__ == "__main__":
     from slackApp.app import flask_app
+    from AIParcer.parser import get_parser
+    # Gemini クライアントを起動時に作っておき、初回の解析で設定コストを払わない
+    get_parser().warm_up()
     port = int(os.environ.get("PORT", 3000))
     safe_log_info(f"Starting Flask app on port {port}")
     debug_mode = os.environ.get('ENVIRONMENT') == 'development'
+    # 未完了のスキャンを再開（debug のリローダーでは、実際に動く子プロセスだけで行う）
+    if not debug_mode or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        from slackApp.handlers import recover_jobs
+        recover_jobs()
     flask_app.run(host="0.0.0.0", port=port, debug=debug_mode)
\ No newline at end of file
@@ -2,6 +2,7 @@ from slack_bolt import App
 from slack_bolt.adapter.flask import SlackRequestHandler
 from flask import Flask, request
 from .oauth import create_oauth_settings
+from config import metrics
 import os
 import logging
 from dotenv import load_dotenv
@@ -11,6 +12,8 @@ app = App(
     signing_secret=os.environ["SLACK_SIGNING_SECRET"],
     oauth_settings=create_oauth_settings(),
 )
+# tokens_revoked / app_uninstalled でインストール情報を削除（キャッシュもここで破棄される）
+app.enable_token_revocation_listeners()
 
 flask_app = Flask(__name__)
 handler = SlackRequestHandler(app)
@@ -93,3 +96,10 @@ def oauth_redirect():
 @flask_app.route("/health", methods=["GET"])
 def health_check():
     return {"status": "ok", "message": "Application is running"}
+
+@flask_app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    # METRICS_ENABLED=true のときだけ公開する
+    if not metrics.enabled():
+        return {"error": "Not Found", "message": "metrics are disabled"}, 404
+    return metrics.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
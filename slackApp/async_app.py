@@ -0,0 +1,56 @@
+# asyncio 版（Bolt AsyncApp + aiohttp）。起動は async_main.py から
+from slack_bolt.async_app import AsyncApp
+from aiohttp import web
+from .oauth import create_async_oauth_settings
+from config import metrics
+import os
+import logging
+import asyncio
+from dotenv import load_dotenv
+load_dotenv()
+
+app = AsyncApp(
+    signing_secret=os.environ["SLACK_SIGNING_SECRET"],
+    oauth_settings=create_async_oauth_settings(),
+)
+# tokens_revoked / app_uninstalled でインストール情報を削除（キャッシュもここで破棄される）
+app.enable_token_revocation_listeners()
+
+# ハンドラ登録
+import slackApp.async_handlers
+
+
+async def health_check(request):
+    return web.json_response({"status": "ok", "message": "Application is running"})
+
+
+async def metrics_endpoint(request):
+    if not metrics.enabled():
+        return web.json_response({"error": "Not Found", "message": "metrics are disabled"}, status=404)
+    return web.Response(body=metrics.render().encode("utf-8"), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+async def _drain(web_app):
+    """終了時に処理中のスキャンとシートへの書き込みを処理し切る。"""
+    from google.sheets import get_sheet_writer
+    timeout = float(os.environ.get("SHUTDOWN_GRACE_SECONDS", "30"))
+    logging.info("シャットダウン: 処理中のスキャンを待機しています")
+    await slackApp.async_handlers.scan_jobs.join(timeout)
+    await asyncio.to_thread(slackApp.async_handlers.journal.release)
+    await asyncio.to_thread(get_sheet_writer().close, timeout)
+    logging.info("シャットダウン: 完了")
+
+
+async def _recover(web_app):
+    """未完了のスキャン（SCAN_JOURNAL）を引き取って再開する。"""
+    await slackApp.async_handlers.recover_jobs()
+
+
+def create_web_app() -> web.Application:
+    # /slack/events と OAuth（/slack/install, /slack/oauth_redirect）のルートは Bolt が登録する
+    web_app = app.web_app(path="/slack/events")
+    web_app.router.add_get("/health", health_check)
+    web_app.router.add_get("/metrics", metrics_endpoint)
+    web_app.on_startup.append(_recover)
+    web_app.on_shutdown.append(_drain)
+    return web_app
@@ -0,0 +1,283 @@
+"""slackApp/handlers.py の asyncio 版。
+
+判定・状態遷移・メッセージ組み立ては slackApp/flow.py と slackApp/render.py を同期版と共有し、
+ここではダウンロード・Gemini・Slack API を await で呼ぶ。
+状態の保存先（SQL の場合はブロッキング I/O）はスレッドで実行する。
+"""
+from slackApp.async_app import app
+from slackApp.worker import AsyncChannelWorkerPool
+from slackApp.prefetch import create_async_prefetcher
+from slackApp.render import AsyncStatusMessage, build_edit_blocks, build_result_blocks, mail_link_message, progress_text, result_fallback_text
+from slackApp.flow import (
+    BOT_TOKEN_MISSING_MESSAGE, SCAN_STATUS_MESSAGES, MAX_AUTO_ADVANCE, RECOVERED_REVIEW_MESSAGE,
+    state, dedup, journal, queue_stats, scan_file_async, scan_files_async,
+    card_position, queue_extra_cards, store_parsed, restore_channel,
+    apply_form_changes, finish_card, get_team_id,
+    get_channel_id_from_event_body, get_channel_id_from_action_body, get_user_id_from_action_body,
+)
+from slackApp.users import get_user_label_async, prefetch_user_async, refresh_from_user_change
+import asyncio
+import logging
+import os
+from slack_bolt.context.say.async_say import AsyncSay
+from slack_sdk.web.async_client import AsyncWebClient
+from config import metrics
+from config.logging import bind_log_context, log_context
+from google.sheets import append_record_to_sheet
+
+scan_jobs = AsyncChannelWorkerPool(max_workers=int(os.environ.get("SCAN_WORKERS", "16")))
+prefetcher = create_async_prefetcher(scan_file_async, batch_fn=scan_files_async)
+
+
+def _in_thread(fn, *args):
+    return asyncio.to_thread(fn, *args)
+
+
+async def _record(fn, *args):
+    """ジョブの記録（journal のメソッド）をスレッドで呼ぶ。SCAN_JOURNAL が無効なら何もしない。"""
+    if journal.enabled:
+        await _in_thread(fn, *args)
+
+
+def _schedule_next_file(channel_id: str, say, team_id: str = ""):
+    """次の1件の処理をタスクとして積む。呼び出し側がチャンネルの処理権を持っていること。
+    タスクは作成時のコンテキストを引き継ぐので、team_id がログの相関 ID になる。"""
+    with log_context(team_id=team_id):
+        scan_jobs.submit(channel_id, _process_next_file_for_channel, channel_id, say)
+
+
+async def _process_next_file_for_channel(channel_id: str, say):
+    """同期版 _process_next_file_for_channel と同じ流れ。"""
+    for _ in range(MAX_AUTO_ADVANCE):
+        if not await _process_one_file(channel_id, say):
+            return
+    # 上限に達したら積み直して、他のチャンネルのタスクに順番を譲る
+    _schedule_next_file(channel_id, say)
+
+
+async def _process_one_file(channel_id: str, say) -> bool:
+    f = None
+    try:
+        # トークンは取り出す前に確かめる（同期版と同じ）
+        bot_token = await _in_thread(state.get_token, channel_id) or os.environ.get("SLACK_BOT_TOKEN")
+        if not bot_token:
+            if await _in_thread(state.queue_length, channel_id):
+                await say(BOT_TOKEN_MISSING_MESSAGE)
+            await _in_thread(state.release, channel_id)
+            return False
+
+        f = await _in_thread(state.pop_file, channel_id)
+        if f is None:
+            await _in_thread(state.release, channel_id)
+            return bool(await _in_thread(state.queue_length, channel_id)) and await _in_thread(state.try_claim, channel_id)
+        bind_log_context(file_id=f.get("id"))
+        await _record(journal.mark_active, channel_id, f)
+        queue_stats.observe(channel_id, f, await _in_thread(state.queue_length, channel_id))
+
+        idx, total = await _in_thread(card_position, channel_id)
+        status_msg = AsyncStatusMessage(say)
+        try:
+            await status_msg.show(progress_text(idx, total))
+        except Exception:
+            pass
+
+        if prefetcher.enabled:
+            prefetcher.schedule(channel_id, await _in_thread(state.peek_files, channel_id, prefetcher.lookahead), bot_token, current=f)
+        status, parsed = await prefetcher.take(channel_id, f, bot_token)
+
+        if status == "ok":
+            parsed, extra = await _in_thread(queue_extra_cards, channel_id, f, parsed)
+            if extra:
+                idx, total = await _in_thread(card_position, channel_id)
+            if parsed is None:
+                status = "parse_failed"
+
+        if status != "ok":
+            await status_msg.show(f"{SCAN_STATUS_MESSAGES[status]}({idx}/{total})")
+            await _in_thread(state.advance_progress, channel_id)
+            await _record(journal.done, channel_id, f)
+            return True
+
+        ch_data = await _in_thread(store_parsed, channel_id, parsed)
+        await status_msg.show(result_fallback_text(ch_data), blocks=build_result_blocks(ch_data, idx, total))
+        await _record(journal.mark_review, channel_id, f, ch_data, idx, total, status_msg)
+        await _in_thread(state.await_review, channel_id)
+        return False
+    except Exception as e:
+        logging.exception(f"キュー処理でエラー: {e}")
+        await _in_thread(state.advance_progress, channel_id)
+        if f is not None:
+            await _record(journal.done, channel_id, f)
+        return True
+
+
+async def recover_jobs(follow_up: bool = True):
+    """同期版 recover_jobs と同じ。イベントループの起動時（web_app.on_startup）に呼ぶ。"""
+    stale = float(os.environ.get("SCAN_JOB_STALE_SECONDS", "600"))
+    if follow_up and journal.enabled:
+        asyncio.get_running_loop().call_later(stale, lambda: asyncio.ensure_future(recover_jobs(follow_up=False)))
+    try:
+        recovered = await _in_thread(journal.claim_orphans, stale, state.durable)
+    except Exception:
+        logging.exception("未完了のジョブの読み込みに失敗しました")
+        return
+    for rc in recovered:
+        with log_context(team_id=rc.team_id, channel_id=rc.channel_id):
+            try:
+                claimed = await _in_thread(restore_channel, rc)
+                token = rc.bot_token or await _in_thread(state.get_token, rc.channel_id)
+                say = AsyncSay(client=AsyncWebClient(token=token), channel=rc.channel_id)
+                if rc.review is not None:
+                    await _repost_review(rc, say)
+                elif claimed:
+                    _schedule_next_file(rc.channel_id, say, rc.team_id)
+                logging.info(
+                    f"未完了のジョブを再開: 待ち {len(rc.queued) + len(rc.in_flight)} 件"
+                    f"{'、レビュー待ち 1 件' if rc.review is not None else ''}"
+                )
+            except Exception:
+                logging.exception("未完了のジョブの再開に失敗しました")
+
+
+async def _repost_review(rc, say):
+    review = rc.review
+    if review.get("ts"):
+        try:
+            await say.client.chat_update(channel=review["channel"] or rc.channel_id, ts=review["ts"], text=RECOVERED_REVIEW_MESSAGE, blocks=[])
+        except Exception:
+            logging.exception("前の結果メッセージの更新に失敗しました")
+    ch_data = await _in_thread(state.get_scan_data, rc.channel_id)
+    status_msg = AsyncStatusMessage(say)
+    await status_msg.show(result_fallback_text(ch_data), blocks=build_result_blocks(ch_data, review["idx"], review["total"]))
+    await _record(journal.mark_review, rc.channel_id, rc.review_file, ch_data, review["idx"], review["total"], status_msg)
+
+
+async def _save_record(ch_data: dict, body: dict, client, say, saved_message: str):
+    loop = asyncio.get_running_loop()
+    user_label = await get_user_label_async(client, get_team_id(body), get_user_id_from_action_body(body))
+
+    def notify_result(fut):
+        # 書き込みが終わってから通知する。SheetWriter のスレッドから呼ばれるので、イベントループに戻して行う
+        e = fut.exception()
+        asyncio.run_coroutine_threadsafe(say(saved_message if e is None else f"保存に失敗しました: {e}"), loop)
+
+    try:
+        fut = append_record_to_sheet(ch_data, slack_user_label=user_label)
+        fut.add_done_callback(notify_result)
+    except Exception as e:
+        logging.exception("Sheets への保存に失敗しました")
+        await say(f"保存に失敗しました: {e}")
+
+    if not ch_data.get('email'):
+        await say("メールアドレスが読み取れなかったため、Gmail作成リンクを生成できません。")
+        return
+
+    await say(**mail_link_message(ch_data))
+
+
+async def _finish_and_advance(channel_id: str, say, team_id: str = ""):
+    await _in_thread(finish_card, channel_id)
+    _schedule_next_file(channel_id, say, team_id)
+
+
+@app.action("save_text")
+async def handle_save_text(ack, body, say, client):
+    try:
+        await ack()
+        channel_id = get_channel_id_from_action_body(body)
+        ch_data = await _in_thread(state.get_scan_data, channel_id)
+        await _save_record(ch_data, body, client, say, "スプレッドシートに保存しました。")
+    except Exception as e:
+        logging.exception(f"save_text ハンドラーでエラーが発生: {e}")
+        try:
+            await say(f"❌ エラーが発生しました: {str(e)}")
+        except Exception as say_error:
+            logging.exception(f"エラーメッセージの送信にも失敗: {say_error}")
+    finally:
+        await _finish_and_advance(get_channel_id_from_action_body(body), say, get_team_id(body))
+
+
+@app.action("edit_text")
+async def handle_edit_text(ack, body, say):
+    try:
+        await ack()
+        channel_id = get_channel_id_from_action_body(body)
+        ch_data = await _in_thread(state.get_scan_data, channel_id)
+        await say("該当項目を変更してください。")
+        await say(blocks=build_edit_blocks(ch_data), text="変更したい項目を選んでください")
+    except Exception as e:
+        logging.exception(f"edit_text ハンドラーでエラーが発生: {e}")
+        try:
+            await say(f"❌ エラーが発生しました: {str(e)}")
+        except Exception as say_error:
+            logging.exception(f"エラーメッセージの送信にも失敗: {say_error}")
+
+
+@app.action("save_changes")
+async def handle_save_changes(ack, body, say, client):
+    try:
+        await ack()
+        channel_id = get_channel_id_from_action_body(body)
+        ch_data = await _in_thread(state.get_scan_data, channel_id)
+        state_values = body.get("state", {}).get("values", {})
+        if not state_values:
+            logging.warning("state.values が空です")
+            await say("❌ フォームデータが取得できませんでした。もう一度お試しください。")
+            return
+        apply_form_changes(ch_data, state_values)
+        await _save_record(ch_data, body, client, say, "スプレッドシートにも追記しました。")
+    except Exception as e:
+        logging.exception(f"save_changes ハンドラーでエラーが発生: {e}")
+        try:
+            await say(f"❌ エラーが発生しました: {str(e)}")
+        except Exception as say_error:
+            logging.exception(f"エラーメッセージの送信にも失敗: {say_error}")
+    finally:
+        await _finish_and_advance(get_channel_id_from_action_body(body), say, get_team_id(body))
+
+
+@app.action("cancel_text")
+async def handle_cancel_text(ack, body, say):
+    try:
+        await ack()
+        await say("変更がキャンセルされました。")
+    except Exception as e:
+        logging.exception(f"cancel_text ハンドラーでエラーが発生: {e}")
+    finally:
+        await _finish_and_advance(get_channel_id_from_action_body(body), say, get_team_id(body))
+
+
+@app.event("message")
+async def handle_message_events(body, say, context, client):
+    event = body.get("event", {})
+    if "files" in event:
+        channel_id = get_channel_id_from_event_body(body)
+        team_id = get_team_id(body)
+        files = await _in_thread(dedup.new_files, body)
+        if not files:
+            return
+        bot_token = context.get("bot_token") or os.environ.get("SLACK_BOT_TOKEN")
+        if not bot_token:
+            await _in_thread(dedup.forget, body, files)
+            await say(BOT_TOKEN_MISSING_MESSAGE)
+            return
+
+        try:
+            await _record(journal.record_queued, channel_id, team_id, files, bot_token)
+            await _in_thread(state.enqueue_files, channel_id, files, bot_token)
+        except Exception:
+            # 積めなかったファイルは受付済みにしない（Slack の再送で受け付け直す）
+            await _in_thread(dedup.forget, body, files)
+            raise
+        if metrics.enabled():
+            queue_stats.set_depth(channel_id, await _in_thread(state.queue_length, channel_id))
+        prefetch_user_async(client, team_id, event.get("user", ""))
+        if await _in_thread(state.try_claim, channel_id):
+            _schedule_next_file(channel_id, say, team_id)
+    else:
+        logging.info("通常メッセージ: " + event.get("text", "（テキストなし）"))
+
+
+@app.event("user_change")
+async def handle_user_change(event):
+    refresh_from_user_change(event)
@@ -0,0 +1,189 @@
+"""Slack の再送（X-Slack-Retry-Num）や同じファイルの二重配信を、待ち行列に積む前に落とす。
+
+event_id と（チャンネル, ファイル ID）を「処理済みの印」として記録し、2回目以降は捨てる。
+メモリ上の LRU を1段目、DATABASE_URL の DB を2段目（任意）として使う。DB を使うと、
+再送が別のプロセス・別の dyno に届いても重複として落とせる。
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import MetaData, Table, Column, String, Float, insert, delete
+from sqlalchemy.exc import IntegrityError
+from config import metrics
+from slackApp.prefetch import file_key
+
+
+class MemoryDedup:
+    """TTL 付きの LRU。max_entries を超えたら最も古い印から捨てる。"""
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()  # key -> 記録した時刻
+
+    def seen(self, key: str) -> bool:
+        with self._lock:
+            stored_at = self._seen.get(key)
+            if stored_at is None:
+                return False
+            if time.time() - stored_at > self.ttl_seconds:
+                del self._seen[key]
+                return False
+            return True
+
+    def add(self, key: str):
+        with self._lock:
+            self._seen[key] = time.time()
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+
+    def discard(self, key: str):
+        with self._lock:
+            self._seen.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._seen)
+
+
+metadata = MetaData()
+
+dedup_table = Table(
+    "slack_event_dedup",
+    metadata,
+    Column("key", String(128), primary_key=True),
+    Column("created_at", Float, nullable=False, index=True),
+)
+
+
+def create_tables(engine):
+    metadata.create_all(engine, checkfirst=True)
+
+
+class SQLDedup:
+    """DB 上の印。主キーへの INSERT が通った側だけを初回とする（プロセス間でも1回だけ）。"""
+
+    def __init__(self, engine, ttl_seconds: float = 24 * 3600):
+        self.engine = engine
+        self.ttl_seconds = ttl_seconds
+        self._writes = 0
+        create_tables(engine)
+
+    def claim(self, keys: list) -> list:
+        """keys のうち初めて記録できたものを返す（既にあるものは重複）。"""
+        now = time.time()
+        claimed = []
+        with self.engine.begin() as conn:
+            for key in keys:
+                try:
+                    with conn.begin_nested():
+                        conn.execute(insert(dedup_table).values(key=key, created_at=now))
+                    claimed.append(key)
+                except IntegrityError:
+                    pass
+        self._writes += 1
+        # 書き込み100回に1回、期限切れの印をまとめて削除
+        if self._writes % 100 == 1:
+            self.evict()
+        return claimed
+
+    def release(self, keys: list):
+        with self.engine.begin() as conn:
+            conn.execute(delete(dedup_table).where(dedup_table.c.key.in_(keys)))
+
+    def evict(self):
+        with self.engine.begin() as conn:
+            conn.execute(delete(dedup_table).where(dedup_table.c.created_at < time.time() - self.ttl_seconds))
+
+
+class EventDeduplicator:
+    def __init__(self, memory: MemoryDedup, sql: SQLDedup | None = None):
+        self.memory = memory
+        self.sql = sql
+        self._lock = threading.Lock()
+        self.stats = {"events": 0, "duplicate_events": 0, "duplicate_files": 0}
+
+    def _count(self, name: str, n: int = 1):
+        with self._lock:
+            self.stats[name] += n
+
+    def _claim(self, keys: list) -> set:
+        """keys のうち初めて見たものの集合を返し、すべてを処理済みとして記録する。"""
+        with self._lock:
+            # 同じプロセスに同時に届いた再送どうしは、このロックで1回だけにする
+            fresh = [k for k in keys if not self.memory.seen(k)]
+            for k in fresh:
+                self.memory.add(k)
+        if fresh and self.sql is not None:
+            try:
+                fresh = self.sql.claim(fresh)
+            except Exception as e:
+                logging.warning(f"重複排除（DB）の記録に失敗、このプロセス内だけで判定します: {e}")
+        return set(fresh)
+
+    @staticmethod
+    def _file_keys(body: dict, files: list) -> list:
+        event = body.get("event", {})
+        channel_id = event.get("channel") or event.get("channel_id") or ""
+        return [f"file:{channel_id}:{file_key(f)}" for f in files]
+
+    def new_files(self, body: dict) -> list:
+        """message イベントの files のうち、まだ受け付けていないものを返す。
+        同じ event_id の再送なら空。受け付けたファイルを積めなかったら forget で印を消すこと。"""
+        event = body.get("event", {})
+        files = event.get("files", [])
+        self._count("events")
+        event_id = body.get("event_id")
+        if event_id and not self._claim([f"event:{event_id}"]):
+            self._count("duplicate_events")
+            logging.info(f"再送されたイベントを無視: event_id={event_id}")
+            return []
+
+        channel_id = event.get("channel") or event.get("channel_id") or ""
+        keys = self._file_keys(body, files)
+        fresh = self._claim(list(dict.fromkeys(keys)))
+        result = []
+        for key, f in zip(keys, files):
+            if key in fresh:
+                result.append(f)
+                fresh.discard(key)   # 同じイベント内の重複も1件にする
+        if len(result) < len(files):
+            self._count("duplicate_files", len(files) - len(result))
+            logging.info(f"受付済みのファイルを {len(files) - len(result)} 件スキップ: channel={channel_id}")
+        return result
+
+    def forget(self, body: dict, files: list):
+        """new_files で付けた印を消す。待ち行列に積めなかったとき、Slack の再送で受け付け直せるようにする。"""
+        keys = self._file_keys(body, files)
+        if body.get("event_id"):
+            keys.append(f"event:{body['event_id']}")
+        for k in keys:
+            self.memory.discard(k)
+        if keys and self.sql is not None:
+            try:
+                self.sql.release(keys)
+            except Exception as e:
+                logging.warning(f"重複排除（DB）の印を消せませんでした: {e}")
+
+
+def create_deduplicator() -> EventDeduplicator:
+    """環境変数から組み立てる。EVENT_DEDUP_SQL の既定は SCAN_STATE_BACKEND=sql のとき有効。"""
+    ttl = float(os.environ.get("EVENT_DEDUP_TTL", str(24 * 3600)))
+    memory = MemoryDedup(max_entries=int(os.environ.get("EVENT_DEDUP_SIZE", "10000")), ttl_seconds=ttl)
+
+    sql = None
+    default_sql = "true" if os.environ.get("SCAN_STATE_BACKEND", "memory") == "sql" else ""
+    if os.environ.get("EVENT_DEDUP_SQL", default_sql).lower() in ("1", "true", "yes"):
+        from config.database import get_engine
+        sql = SQLDedup(get_engine(), ttl_seconds=ttl)
+
+    dedup = EventDeduplicator(memory, sql)
+    metrics.register_snapshot(
+        "event_dedup", lambda: dict(dedup.stats), "Slack イベントの重複排除",
+        counters=("events", "duplicate_events", "duplicate_files"),
+    )
+    return dedup
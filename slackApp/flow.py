@@ -0,0 +1,371 @@
+"""同期版（slackApp/handlers.py）と asyncio 版（slackApp/async_handlers.py）で共有する処理。
+
+Bolt の App に依存しない部分（状態の保存先、1ファイルの解析、読み取り結果の更新、
+フォーム入力の反映など）をここに置き、各ハンドラは I/O の呼び方だけを持つ。
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import metrics
+from AIParcer.parser import extract_batch_from_bytes, extract_cards_from_bytes, extract_from_bytes, get_parser
+from slackApp.dedup import create_deduplicator
+from slackApp.journal import RecoveredChannel, create_job_journal
+from slackApp.prefetch import file_key
+from slackApp.state import create_state_store
+from slackApp.utils import DOWNLOAD_POOL_SIZE, NotAnImageError, fetch_slack_private_file, fetch_slack_private_file_async, is_probably_image
+
+# チャンネルごとに画像処理を直列化するための待ち行列と状態（SCAN_STATE_BACKEND で保存先を選ぶ）
+state = create_state_store()
+# Slack の再送・同じファイルの二重配信を待ち行列に積む前に落とす
+dedup = create_deduplicator()
+# ジョブと解析結果の先書き（SCAN_JOURNAL=true のとき。再起動後に続きから再開する）
+journal = create_job_journal()
+
+BOT_TOKEN_MISSING_MESSAGE = "内部設定エラー（Bot token 未設定）。インストール設定を確認してください。"
+
+# scan_file の status ごとの通知文（"ok" 以外）
+SCAN_STATUS_MESSAGES = {
+    "skipped": "画像ファイル以外の形式で入力されたため、スキップします。",
+    "download_failed": "画像のダウンロードに失敗しました。もう一度お試しください。",
+    "parse_failed": "画像の解析に失敗しました。もう一度お試しください。",
+}
+
+# 画像以外・失敗のファイルを、1回のジョブで続けて読み飛ばす上限。
+# 超えたら残りは新しいジョブとして積み直し、他のチャンネルに順番を譲る
+MAX_AUTO_ADVANCE = max(1, int(os.environ.get("SCAN_MAX_AUTO_ADVANCE", "10")))
+
+# 1枚の写真に並んだ複数の名刺を検出し、1枚ずつレビューに回す
+MULTI_CARD_DETECTION = os.environ.get("MULTI_CARD_DETECTION", "").lower() in ("1", "true", "yes")
+
+# 編集フォームの action_id -> 表示名
+EDITABLE_FIELDS = {
+    "name": "名前",
+    "company": "会社名",
+    "postal_code": "郵便番号",
+    "address": "会社住所",
+    "email": "Email",
+    "website": "ウェブサイト",
+    "phone": "電話番号",
+}
+
+
+def get_channel_id_from_event_body(body: dict) -> str:
+    event = body.get("event", {})
+    return event.get("channel") or event.get("channel_id") or ""
+
+
+def get_channel_id_from_action_body(body: dict) -> str:
+    # actions の payload から頑健に channel_id を抜き出す
+    ch = body.get("channel", {}).get("id")
+    if ch:
+        return ch
+    container = body.get("container", {})
+    if container.get("channel_id"):
+        return container.get("channel_id")
+    # fallback（まれ）
+    return body.get("team", {}).get("id", "")
+
+
+def get_user_id_from_action_body(body: dict) -> str:
+    return body.get("user", {}).get("id") or body.get("user", "")
+
+
+def get_team_id(body: dict) -> str:
+    # events は team_id、actions は team.id（Enterprise Grid では user.team_id）
+    return body.get("team_id") or (body.get("team") or {}).get("id") or body.get("user", {}).get("team_id", "")
+
+
+class QueueStats:
+    """待ち行列の深さと、積まれてから処理が始まるまでの待ち時間の集計。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = 0
+        self.last_depth = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._depths = {}  # channel_id -> 残り件数（空になったチャンネルは消す）
+
+    def observe(self, channel_id: str, f: dict, depth: int):
+        """pop_file で取り出した直後に呼ぶ。depth は取り出した後の残り件数。"""
+        enqueued_at = f.get("enqueued_at")
+        wait = max(0.0, time.time() - enqueued_at) if enqueued_at else 0.0
+        with self._lock:
+            self.started += 1
+            self.last_depth = depth
+            self.max_depth = max(self.max_depth, depth)
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        self.set_depth(channel_id, depth)
+        logging.info(f"キューから取り出し: channel={channel_id} 残り={depth}件 待ち時間={wait:.1f}s")
+
+    def set_depth(self, channel_id: str, depth: int):
+        """/metrics の待ち行列のゲージ（合計・最大・空でないチャンネル数）を更新する。"""
+        with self._lock:
+            if depth > 0:
+                self._depths[channel_id] = depth
+            else:
+                self._depths.pop(channel_id, None)
+            depths = list(self._depths.values())
+        metrics.queue_depth.set(sum(depths))
+        metrics.queue_depth_max.set(max(depths, default=0))
+        metrics.queue_channels_nonempty.set(len(depths))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "started": self.started,
+                "last_depth": self.last_depth,
+                "max_depth": self.max_depth,
+                "avg_wait_seconds": self.total_wait / self.started if self.started else 0.0,
+                "max_wait_seconds": self.max_wait,
+            }
+
+
+queue_stats = QueueStats()
+metrics.register_snapshot("queue", queue_stats.snapshot, "スキャンの待ち行列", counters=("started",))
+
+
+def _download_image(f: dict, bot_token: str):
+    """(status, image_bytes)。status は "ok" / "skipped" / "download_failed"。"""
+    # ファイル情報で判定できなければ、ダウンロードの先頭バイトで判定する（追加の通信なし）
+    looks_like_image = is_probably_image(f)
+    url_private = f.get("url_private_download") or f.get("url_private")
+    try:
+        return "ok", fetch_slack_private_file(url_private, bot_token, require_image=not looks_like_image)
+    except NotAnImageError:
+        logging.info(f"画像以外のためスキップ: {f.get('name')} ({f.get('mimetype')}/{f.get('filetype')})")
+        return "skipped", None
+    except Exception:
+        logging.exception("画像ダウンロードに失敗しました")
+        return "download_failed", None
+
+
+async def _download_image_async(f: dict, bot_token: str):
+    looks_like_image = is_probably_image(f)
+    url_private = f.get("url_private_download") or f.get("url_private")
+    try:
+        return "ok", await fetch_slack_private_file_async(url_private, bot_token, require_image=not looks_like_image)
+    except NotAnImageError:
+        logging.info(f"画像以外のためスキップ: {f.get('name')} ({f.get('mimetype')}/{f.get('filetype')})")
+        return "skipped", None
+    except Exception:
+        logging.exception("画像ダウンロードに失敗しました")
+        return "download_failed", None
+
+
+def _parsed_card_result(f: dict):
+    return ("ok", f["parsed_card"]) if f["parsed_card"] is not None else ("parse_failed", None)
+
+
+def scan_file(f: dict, bot_token: str):
+    """1ファイル分の 取得（先頭バイトで画像判定）→ 解析 を行う。先読みワーカーからも呼ばれる。
+    戻り値は (status, parsed)。status は "ok" / "skipped" / "download_failed" / "parse_failed"。
+    MULTI_CARD_DETECTION が有効なら parsed は名刺ごとの結果のリスト（queue_extra_cards で分ける）。"""
+    # 複数名刺の2枚目以降は、解析済みの結果を持って待ち行列に入っている（解析できなかった名刺は None）
+    if "parsed_card" in f:
+        return _parsed_card_result(f)
+    status, image_bytes = _download_image(f, bot_token)
+    if status != "ok":
+        return status, None
+
+    try:
+        parsed = extract_cards_from_bytes(image_bytes) if MULTI_CARD_DETECTION else extract_from_bytes(image_bytes)
+        logging.info(f"Gemini解析結果: {parsed}")
+        journal.save_result(f, parsed)
+        return "ok", parsed
+    except Exception:
+        logging.exception("Gemini 解析に失敗")
+        return "parse_failed", None
+
+
+async def scan_file_async(f: dict, bot_token: str):
+    """scan_file の asyncio 版。ダウンロードと Gemini 呼び出しはイベントループを塞がない。"""
+    if "parsed_card" in f:
+        return _parsed_card_result(f)
+    status, image_bytes = await _download_image_async(f, bot_token)
+    if status != "ok":
+        return status, None
+
+    try:
+        if MULTI_CARD_DETECTION:
+            parsed = await get_parser().extract_cards_async(image_bytes)
+        else:
+            parsed = await get_parser().extract_async(image_bytes)
+        logging.info(f"Gemini解析結果: {parsed}")
+        if journal.enabled:
+            await asyncio.to_thread(journal.save_result, f, parsed)
+        return "ok", parsed
+    except Exception:
+        logging.exception("Gemini 解析に失敗")
+        return "parse_failed", None
+
+
+def _batch_results(files: list, downloads: list, parsed_list: list) -> list:
+    """ダウンロード結果とまとめた解析結果を、files と同じ順の (status, parsed) に組み立てる。"""
+    parsed_iter = iter(parsed_list)
+    results = []
+    for f, (status, _) in zip(files, downloads):
+        if status != "ok":
+            results.append((status, None))
+            continue
+        parsed = next(parsed_iter)
+        if parsed is None:
+            results.append(("parse_failed", None))
+        else:
+            logging.info(f"Gemini解析結果: {parsed}")
+            results.append(("ok", parsed))
+    return results
+
+
+def _save_results(files: list, results: list):
+    for f, (status, parsed) in zip(files, results):
+        if status == "ok":
+            journal.save_result(f, parsed)
+
+
+# まとめて解析するファイルを並行にダウンロードする（先読みのスレッドから使うので、先読みとは別のプール）
+_download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_POOL_SIZE, thread_name_prefix="scan-download")
+
+
+def _download_all(files: list, bot_token: str) -> list:
+    """files を並行にダウンロードし、同じ順の (status, bytes) を返す。
+    先頭（今レビューを待っている1件）が後続のダウンロードを待たされないようにする。"""
+    if len(files) <= 1:
+        return [_download_image(f, bot_token) for f in files]
+    futures = [
+        _download_pool.submit(contextvars.copy_context().run, _download_image, f, bot_token)
+        for f in files
+    ]
+    return [fut.result() for fut in futures]
+
+
+def scan_files(files: list, bot_token: str) -> list:
+    """複数ファイルをまとめて解析する（Gemini の呼び出しを PARSE_BATCH_SIZE 枚ずつ1回にまとめる）。
+    戻り値は files と同じ順の (status, parsed)。先読みワーカーから呼ばれる。"""
+    if MULTI_CARD_DETECTION or any("parsed_card" in f for f in files):
+        return [scan_file(f, bot_token) for f in files]
+    downloads = _download_all(files, bot_token)
+    images = [b for status, b in downloads if status == "ok"]
+    try:
+        parsed_list = extract_batch_from_bytes(images) if images else []
+    except Exception:
+        logging.exception("Gemini 解析に失敗")
+        parsed_list = [None] * len(images)
+    results = _batch_results(files, downloads, parsed_list)
+    _save_results(files, results)
+    return results
+
+
+async def scan_files_async(files: list, bot_token: str) -> list:
+    """scan_files の asyncio 版。ダウンロードは並行に行う。"""
+    if MULTI_CARD_DETECTION or any("parsed_card" in f for f in files):
+        return [await scan_file_async(f, bot_token) for f in files]
+    downloads = await asyncio.gather(*(_download_image_async(f, bot_token) for f in files))
+    images = [b for status, b in downloads if status == "ok"]
+    try:
+        parsed_list = await get_parser().extract_batch_async(images) if images else []
+    except Exception:
+        logging.exception("Gemini 解析に失敗")
+        parsed_list = [None] * len(images)
+    results = _batch_results(files, downloads, parsed_list)
+    if journal.enabled:
+        await asyncio.to_thread(_save_results, files, results)
+    return results
+
+
+def card_position(channel_id: str) -> tuple[int, int]:
+    """現在のファイルが何件目か (idx, total)。pop_file の後に呼ぶ。"""
+    prog = state.get_progress(channel_id)
+    idx = prog.get("processed", 0) + 1
+    total = prog.get("total", 0) or (idx + state.queue_length(channel_id))
+    return idx, total
+
+
+def queue_extra_cards(channel_id: str, f: dict, parsed) -> tuple[dict, int]:
+    """parsed が名刺ごとのリストなら、2枚目以降を待ち行列の先頭に戻して1枚目を返す。
+    戻り値は (今レビューする1件, 戻した件数)。解析できなかった名刺は None（1枚目なら呼び出し側で失敗として扱う）。"""
+    if not isinstance(parsed, list):
+        return parsed, 0
+    first, rest = parsed[0], parsed[1:]
+    if rest:
+        count = len(parsed)
+        extras = [
+            {"id": f"{file_key(f)}#{i}", "name": f"{f.get('name', '')} ({i}/{count}枚目)", "parsed_card": card}
+            for i, card in enumerate(rest, start=2)
+        ]
+        journal.record_queued(channel_id, "", extras, None, front=True)
+        state.push_front(channel_id, extras)
+    return first, len(rest)
+
+
+def store_parsed(channel_id: str, parsed: dict) -> dict:
+    """解析結果をチャンネルの読み取り結果に反映して保存し、それを返す。"""
+    ch_data = state.get_scan_data(channel_id)
+    ch_data.update({
+        # 単一の name に統一
+        "name":       (parsed.get("name", "") or ch_data.get("name", "")),
+        "company":     parsed.get("company", "")     or ch_data.get("company", ""),
+        "postal_code": parsed.get("postal_code", "") or ch_data.get("postal_code", ""),
+        "address":     parsed.get("address", "")     or ch_data.get("address", ""),
+        "email":       parsed.get("email", "")       or ch_data.get("email", ""),
+        "website":     parsed.get("website", "")     or ch_data.get("website", ""),
+        "phone":       parsed.get("phone", "")       or ch_data.get("phone", ""),
+    })
+    state.set_scan_data(channel_id, ch_data)
+    return ch_data
+
+
+def apply_form_changes(ch_data: dict, state_values: dict) -> list:
+    """編集フォームの入力を ch_data に反映し、変更内容の表示用リストを返す。"""
+    changes = []
+    for block in state_values:
+        block_data = state_values[block]
+        for key, value in block_data.items():
+            display_key = EDITABLE_FIELDS.get(key, "")
+            if display_key:
+                new_value = value.get("value", "")
+                ch_data[key] = new_value
+                changes.append(f"{display_key}: {new_value}")
+                logging.info(f"{display_key} を {new_value} に更新")
+    return changes
+
+
+def finish_card(channel_id: str):
+    """ボタン操作で1件のレビューを終えたとき：読み取り結果を初期化し、processed を進める。"""
+    state.clear_scan_data(channel_id)
+    state.advance_progress(channel_id)
+    journal.finish(channel_id)
+
+
+# 再起動後に投稿し直すレビュー待ちのメッセージ
+RECOVERED_REVIEW_MESSAGE = "再起動のため、読み取り結果を下に表示し直しました。"
+
+
+def restore_channel(rc: RecoveredChannel) -> bool:
+    """引き取った未完了のジョブをチャンネルの状態に戻す。処理権（state.try_claim）を取れたら True。
+    レビュー待ちの1件があれば、処理権は前のプロセスから引き継いだものとして扱う。"""
+    channel_id = rc.channel_id
+    bot_token = rc.bot_token or state.get_token(channel_id) or os.environ.get("SLACK_BOT_TOKEN")
+    if not state.durable and rc.queued:
+        state.enqueue_files(channel_id, rc.queued, bot_token)
+    in_flight = rc.in_flight
+    if in_flight and state.durable:
+        # state.try_claim のリース切れの引き取りで、既に待ち行列に戻っている分は除く
+        queued = {file_key(f) for f in state.peek_files(channel_id, state.queue_length(channel_id))}
+        in_flight = [f for f in in_flight if file_key(f) not in queued]
+    if in_flight:
+        # 取り出してから結果を表示する前に落ちた分は、待ち行列の先頭に戻して処理し直す
+        state.push_front(channel_id, in_flight)
+    if rc.review is not None:
+        state.set_scan_data(channel_id, rc.review["scan_data"])
+        state.await_review(channel_id)
+    elif state.durable:
+        # 解析中に落ちたプロセスの処理中フラグが残っているので下ろす
+        state.release(channel_id)
+    return state.try_claim(channel_id)
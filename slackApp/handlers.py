@@ -1,209 +1,197 @@
 from slackApp.app import app
-from slackApp.utils import fetch_slack_private_file, is_probably_image, send_mail_link
-from AIParcer.parser import extract_from_bytes
+from slackApp.utils import send_mail_link
+from slackApp.worker import scan_jobs
+from slackApp.prefetch import create_prefetcher
+from slackApp.render import StatusMessage, build_edit_blocks, build_result_blocks, progress_text, result_fallback_text
+from slackApp.flow import (
+    BOT_TOKEN_MISSING_MESSAGE, SCAN_STATUS_MESSAGES, MAX_AUTO_ADVANCE, RECOVERED_REVIEW_MESSAGE,
+    state, dedup, journal, queue_stats, scan_file, scan_files,
+    card_position, queue_extra_cards, store_parsed, restore_channel,
+    apply_form_changes, finish_card, get_team_id,
+    get_channel_id_from_event_body, get_channel_id_from_action_body, get_user_id_from_action_body,
+)
+from slackApp.users import get_user_label, prefetch_user, refresh_from_user_change
 import logging
 import os
-from collections import deque
+import threading
+from slack_bolt.context.say import Say
+from slack_sdk import WebClient
+from config import metrics
+from config.logging import bind_log_context, log_context
 from google.sheets import append_record_to_sheet
 
-# 旧 scanData の後継（チャンネル単位で使うテンプレート）
-SCAN_DATA_TEMPLATE = {
-    "name": "",       # 表示用・保存用の名前（単一）
-    "company": "",
-    "postal_code": "",
-    "address": "",
-    "email": "",
-    "website": "",
-    "phone": "",
-}
-
-# チャンネルごとに画像処理を直列化するための簡易キューと状態
-channel_queues = {}        # channel_id -> deque([file_obj, ...])
-channel_processing = {}    # channel_id -> bool (処理中か)
-channel_tokens = {}        # channel_id -> bot_token（ファイル取得に使用）
-channel_progress = {}      # channel_id -> {"processed": int, "total": int}
-channel_scan_data = {}     # channel_id -> dict(scanData)
-
-
-def _get_scan_data(channel_id: str) -> dict:
-    data = channel_scan_data.get(channel_id)
-    if data is None:
-        data = dict(SCAN_DATA_TEMPLATE)
-        channel_scan_data[channel_id] = data
-    return data
-
-def _clear_scan_data(channel_id: str):
-    data = channel_scan_data.get(channel_id)
-    if data is None:
-        channel_scan_data[channel_id] = dict(SCAN_DATA_TEMPLATE)
-        return
-    for k in list(data.keys()):
-        data[k] = ""
-
 
-def _get_channel_id_from_event_body(body: dict) -> str:
-    event = body.get("event", {})
-    return event.get("channel") or event.get("channel_id") or ""
+def _schedule_next_file(channel_id: str, say, team_id: str = ""):
+    """次の1件の処理をワーカーに積む（Slack への応答をブロックしない）。
+    呼び出し側がチャンネルの処理権（state.try_claim）を持っていること。
+    team_id はジョブのログの相関 ID になる（ジョブの中から積み直す場合は引き継がれる）。"""
+    with log_context(team_id=team_id):
+        if not scan_jobs.submit(channel_id, _process_next_file_for_channel, channel_id, say):
+            # シャットダウン中で積めなかった。処理権を持ったままにせず、次のプロセスが引き取れるようにする
+            state.release(channel_id)
+            journal.release()
 
 
-def _get_channel_id_from_action_body(body: dict) -> str:
-    # actions の payload から頑健に channel_id を抜き出す
-    ch = body.get("channel", {}).get("id")
-    if ch:
-        return ch
-    container = body.get("container", {})
-    if container.get("channel_id"):
-        return container.get("channel_id")
-    # fallback（まれ）
-    return body.get("team", {}).get("id", "")
+prefetcher = create_prefetcher(scan_file, batch_fn=scan_files)
 
 
 def _process_next_file_for_channel(channel_id: str, say):
-    """チャンネルの待ち行列から次の1件だけ処理。失敗・成功に関わらず、
-    ボタン押下の完了、または失敗通知後に次を進める設計のため、ここでは1件だけ解析し、
-    アクションハンドラ側で次を起動する。"""
-    try:
-        q = channel_queues.get(channel_id)
-        if not q or len(q) == 0:
-            channel_processing[channel_id] = False
-            # 進捗リセット
-            if channel_id in channel_progress:
-                channel_progress[channel_id]["processed"] = 0
-                channel_progress[channel_id]["total"] = 0
+    """チャンネルの待ち行列から次の1件を処理。失敗・成功に関わらず、
+    ボタン押下の完了、または失敗通知後に次を進める設計のため、レビュー待ちになる1件まで解析し、
+    アクションハンドラ側で次を起動する。
+    画像以外・失敗のファイルはループで読み飛ばすが、MAX_AUTO_ADVANCE 件を超えたら
+    残りをジョブとして積み直し、他のチャンネルに順番を譲る。
+    先読みが有効なら、後続の数件はレビュー待ちの間に並列で解析しておく。"""
+    for _ in range(MAX_AUTO_ADVANCE):
+        if not _process_one_file(channel_id, say):
             return
+    _schedule_next_file(channel_id, say)
+
 
-        # 処理中フラグを立てる
-        channel_processing[channel_id] = True
-        bot_token = channel_tokens.get(channel_id) or os.environ.get("SLACK_BOT_TOKEN")
+def _process_one_file(channel_id: str, say) -> bool:
+    """1件処理する。続けて次のファイルへ進むべきとき（スキップ・失敗）に True を返す。"""
+    f = None
+    try:
+        # トークンは取り出す前に確かめる（取り出してから諦めると、その1件が待ち行列から消える）
+        bot_token = state.get_token(channel_id) or os.environ.get("SLACK_BOT_TOKEN")
         if not bot_token:
-            say("内部設定エラー（Bot token 未設定）。インストール設定を確認してください。")
-            channel_processing[channel_id] = False
-            return
+            if state.queue_length(channel_id):
+                say(BOT_TOKEN_MISSING_MESSAGE)
+            state.release(channel_id)
+            return False
+
+        f = state.pop_file(channel_id)
+        if f is None:
+            # 処理中フラグを下ろして進捗リセット
+            state.release(channel_id)
+            # 下ろす直前に積まれたファイルを取りこぼさないよう、もう一度確認
+            return bool(state.queue_length(channel_id)) and state.try_claim(channel_id)
+        bind_log_context(file_id=f.get("id"))
+        journal.mark_active(channel_id, f)
+        queue_stats.observe(channel_id, f, state.queue_length(channel_id))
 
         # 進捗の案内（現在のファイルが何件目か）
-        prog = channel_progress.setdefault(channel_id, {"processed": 0, "total": 0})
-        idx = prog.get("processed", 0) + 1
-        total = prog.get("total", 0) or (prog.get("processed", 0) + len(q) + 1)
+        idx, total = card_position(channel_id)
+        status_msg = StatusMessage(say)
         try:
-            say(f"読み込んでいます...({idx}/{total})")
+            status_msg.show(progress_text(idx, total))
         except Exception:
             pass
 
-        f = q.popleft()
-        if not is_probably_image(f, bot_token):
-            logging.info(f"画像以外（に見える）のでスキップ: {f.get('name')} ({f.get('mimetype')}/{f.get('filetype')})")
-            say("画像ファイル以外の形式で入力されたため、スキップします。")
-            # 次のファイルへ（スキップも1件として進捗を進める）
-            channel_progress[channel_id]["processed"] = channel_progress[channel_id].get("processed", 0) + 1
-            _process_next_file_for_channel(channel_id, say)
-            return
-
-        url_private = f.get("url_private_download") or f.get("url_private")
-        try:
-            image_bytes = fetch_slack_private_file(url_private, bot_token)
-        except Exception:
-            logging.exception("画像ダウンロードに失敗しました")
-            say("画像のダウンロードに失敗しました。もう一度お試しください。")
-            # 次のファイルへ（失敗も1件として進捗を進める）
-            channel_progress[channel_id]["processed"] = channel_progress[channel_id].get("processed", 0) + 1
-            _process_next_file_for_channel(channel_id, say)
-            return
-
-        try:
-            parsed = extract_from_bytes(image_bytes)
-            logging.info(f"Gemini解析結果: {parsed}")
-            ch_data = _get_scan_data(channel_id)
-            ch_data.update({
-                # 単一の name に統一
-                "name":       (parsed.get("name", "") or ch_data.get("name", "")),
-                "company":     parsed.get("company", "")     or ch_data.get("company", ""),
-                "postal_code": parsed.get("postal_code", "") or ch_data.get("postal_code", ""),
-                "address":     parsed.get("address", "")     or ch_data.get("address", ""),
-                "email":       parsed.get("email", "")       or ch_data.get("email", ""),
-                "website":     parsed.get("website", "")     or ch_data.get("website", ""),
-                "phone":       parsed.get("phone", "")       or ch_data.get("phone", ""),
-            })
-            say("読み取り完了。\n")
-            display_name = ch_data.get("name")
-            say(f"名前: {display_name}")
-            say(f"会社名: {ch_data['company']}")
-            say(f"郵便番号: {ch_data['postal_code']}")
-            say(f"会社住所: {ch_data['address']}")
-            say(f"Email: {ch_data['email']}")
-            say(f"ウェブサイト: {ch_data['website']}")
-            say(f"電話番号: {ch_data['phone']}")
-            blocks = [
-                {
-                    "type": "actions",
-                    "elements": [
-                        {
-                            "type": "button",
-                            "text": {"type": "plain_text", "text": "保存する"},
-                            "style": "primary",
-                            "action_id": "save_text"
-                        },
-                        {
-                            "type": "button",
-                            "text": {"type": "plain_text", "text": "変更する"},
-                            "action_id": "edit_text"
-                        },
-                        {
-                            "type": "button",
-                            "text": {"type": "plain_text", "text": "キャンセル"},
-                            "action_id": "cancel_text"
-                        },
-                    ],
-                }
-            ]
-            say(blocks=blocks, text="読み取り結果に対してアクションを選んでください")
-            # ここでは待機。ボタン押下ハンドラの finally で次へ進む
-        except Exception:
-            logging.exception("Gemini 解析に失敗")
-            say("画像の解析に失敗しました。もう一度お試しください。")
-            # 次のファイルへ（失敗も1件として進捗を進める）
-            channel_progress[channel_id]["processed"] = channel_progress[channel_id].get("processed", 0) + 1
-            _process_next_file_for_channel(channel_id, say)
-            return
+        # 現在の1件と並行して、後続を先読み（まとめて解析する場合は現在の1件も同じバッチに入れる）
+        if prefetcher.enabled:
+            prefetcher.schedule(channel_id, state.peek_files(channel_id, prefetcher.lookahead), bot_token, current=f)
+        status, parsed = prefetcher.take(channel_id, f, bot_token)
+
+        if status == "ok":
+            # 1枚の写真に複数の名刺があれば、2枚目以降は待ち行列の先頭に戻して続けてレビューする
+            parsed, extra = queue_extra_cards(channel_id, f, parsed)
+            if extra:
+                idx, total = card_position(channel_id)
+            if parsed is None:
+                # 1枚目の名刺を解析できなかった（2枚目以降は待ち行列で同じように失敗として数える）
+                status = "parse_failed"
+
+        if status != "ok":
+            status_msg.show(f"{SCAN_STATUS_MESSAGES[status]}({idx}/{total})")
+            # 次のファイルへ（スキップ・失敗も1件として進捗を進める）
+            state.advance_progress(channel_id)
+            journal.done(channel_id, f)
+            return True
+
+        ch_data = store_parsed(channel_id, parsed)
+        # 進捗メッセージを、項目とボタンをまとめた結果メッセージに書き換える
+        status_msg.show(result_fallback_text(ch_data), blocks=build_result_blocks(ch_data, idx, total))
+        journal.mark_review(channel_id, f, ch_data, idx, total, status_msg)
+        state.await_review(channel_id)
+        # ここでは待機。ボタン押下ハンドラの finally で次へ進む
+        return False
     except Exception as e:
         logging.exception(f"キュー処理でエラー: {e}")
         # 失敗しても次に進める（進捗を進める）
-        channel_progress.setdefault(channel_id, {"processed": 0, "total": 0})
-        channel_progress[channel_id]["processed"] += 1
-        _process_next_file_for_channel(channel_id, say)
-
-
-@app.action("save_text")
-def handle_save_text(ack, body, say):
+        state.advance_progress(channel_id)
+        if f is not None:
+            journal.done(channel_id, f)
+        return True
+
+
+def recover_jobs(follow_up: bool = True):
+    """前のプロセスが終えられなかったジョブ（SCAN_JOURNAL）を引き取って再開する。ワーカーの起動時に1回呼ぶ。
+    待ち行列は処理を再開し、レビュー待ちだった1件は結果メッセージを投稿し直す。
+    落ちたプロセスの行は SCAN_JOB_STALE_SECONDS 経つまで引き取らないので、follow_up なら経ってからもう一度呼ぶ。"""
+    stale = float(os.environ.get("SCAN_JOB_STALE_SECONDS", "600"))
+    if follow_up and journal.enabled:
+        timer = threading.Timer(stale, recover_jobs, kwargs={"follow_up": False})
+        timer.daemon = True
+        timer.start()
     try:
-        ack()
-        channel_id = _get_channel_id_from_action_body(body)
-        ch_data = _get_scan_data(channel_id)
-        # Slackユーザ表記（display_name があれば優先）
-        user_id = body.get("user", {}).get("id") or body.get("user", "")
-        user_label = user_id
+        recovered = journal.claim_orphans(stale, state.durable)
+    except Exception:
+        logging.exception("未完了のジョブの読み込みに失敗しました")
+        return
+    for rc in recovered:
+        with log_context(team_id=rc.team_id, channel_id=rc.channel_id):
+            try:
+                claimed = restore_channel(rc)
+                say = Say(client=WebClient(token=rc.bot_token or state.get_token(rc.channel_id)), channel=rc.channel_id)
+                if rc.review is not None:
+                    _repost_review(rc, say)
+                elif claimed:
+                    _schedule_next_file(rc.channel_id, say, rc.team_id)
+                logging.info(
+                    f"未完了のジョブを再開: 待ち {len(rc.queued) + len(rc.in_flight)} 件"
+                    f"{'、レビュー待ち 1 件' if rc.review is not None else ''}"
+                )
+            except Exception:
+                logging.exception("未完了のジョブの再開に失敗しました")
+
+
+def _repost_review(rc, say):
+    review = rc.review
+    # 前の結果メッセージのボタンは消しておく（押しても同じ1件を二重に終えないように）
+    if review.get("ts"):
         try:
-            if user_id:
-                prof = app.client.users_info(user=user_id).get("user", {}).get("profile", {})
-                display = prof.get("display_name") or prof.get("real_name")
-                if display:
-                    user_label = f"{display} ({user_id})"
+            say.client.chat_update(channel=review["channel"] or rc.channel_id, ts=review["ts"], text=RECOVERED_REVIEW_MESSAGE, blocks=[])
         except Exception:
-            pass
+            logging.exception("前の結果メッセージの更新に失敗しました")
+    ch_data = state.get_scan_data(rc.channel_id)
+    status_msg = StatusMessage(say)
+    status_msg.show(result_fallback_text(ch_data), blocks=build_result_blocks(ch_data, review["idx"], review["total"]))
+    journal.mark_review(rc.channel_id, rc.review_file, ch_data, review["idx"], review["total"], status_msg)
 
-        try:
-            append_record_to_sheet(ch_data, slack_user_label=user_label)
-            say("スプレッドシートに保存しました。")
-        except Exception as e:
-            logging.exception("Sheets への保存に失敗しました")
-            say(f"保存に失敗しました: {e}")
-
-        if not ch_data.get('email'):
-            say("メールアドレスが読み取れなかったため、Gmail作成リンクを生成できません。")
-            # 次のファイルへ
-            return
 
-        send_mail_link(ch_data, say)
+def _notify_sheet_result(fut, say, saved_message: str):
+    """まとめ書き込みが終わってから、保存できたか失敗したかを通知する。"""
+    e = fut.exception()
+    try:
+        say(saved_message if e is None else f"保存に失敗しました: {e}")
+    except Exception:
+        logging.exception("保存結果の通知に失敗しました")
+
+
+def _save_record(ch_data: dict, body: dict, client, say, saved_message: str):
+    user_label = get_user_label(client, get_team_id(body), get_user_id_from_action_body(body))
+    try:
+        fut = append_record_to_sheet(ch_data, slack_user_label=user_label)
+        fut.add_done_callback(lambda fut: _notify_sheet_result(fut, say, saved_message))
+    except Exception as e:
+        logging.exception("Sheets への保存に失敗しました")
+        say(f"保存に失敗しました: {e}")
+
+    if not ch_data.get('email'):
+        say("メールアドレスが読み取れなかったため、Gmail作成リンクを生成できません。")
+        return
+
+    send_mail_link(ch_data, say)
+
 
+@app.action("save_text")
+def handle_save_text(ack, body, say, client):
+    try:
+        ack()
+        channel_id = get_channel_id_from_action_body(body)
+        ch_data = state.get_scan_data(channel_id)
+        _save_record(ch_data, body, client, say, "スプレッドシートに保存しました。")
     except Exception as e:
         logging.exception(f"save_text ハンドラーでエラーが発生: {e}")
         try:
@@ -211,78 +199,20 @@ def handle_save_text(ack, body, say):
         except Exception as say_error:
             logging.exception(f"エラーメッセージの送信にも失敗: {say_error}")
     finally:
-        # 5) 必ず初期化（return ルートでも確実に実行）
-        channel_id = _get_channel_id_from_action_body(body)
-        _clear_scan_data(channel_id)
-        # 次のファイルへ（processed を進める）
-        channel_progress.setdefault(channel_id, {"processed": 0, "total": 0})
-        channel_progress[channel_id]["processed"] += 1
-        _process_next_file_for_channel(channel_id, say)
+        # 5) 必ず初期化（return ルートでも確実に実行）し、次のファイルへ（processed を進める）
+        channel_id = get_channel_id_from_action_body(body)
+        finish_card(channel_id)
+        _schedule_next_file(channel_id, say, get_team_id(body))
 
 
 @app.action("edit_text")
 def handle_edit_text(ack, body, say):
     try:
         ack()
-        channel_id = _get_channel_id_from_action_body(body)
-        ch_data = _get_scan_data(channel_id)
+        channel_id = get_channel_id_from_action_body(body)
+        ch_data = state.get_scan_data(channel_id)
         say("該当項目を変更してください。")
-        editBlocks = [
-            {
-                "type": "input",
-                "block_id": "edit_name",
-                "label": {"type": "plain_text", "text": "名前"},
-                "element": {"type": "plain_text_input", "action_id": "name", "initial_value": f"{ch_data['name']}"},
-            },
-            {
-                "type": "input",
-                "block_id": "edit_company",
-                "label": {"type": "plain_text", "text": "会社名"},
-                "element": {"type": "plain_text_input", "action_id": "company", "initial_value": f"{ch_data['company']}"},
-            },
-            {
-                "type": "input",
-                "block_id": "edit_postal_code",
-                "label": {"type": "plain_text", "text": "郵便番号"},
-                "element": {"type": "plain_text_input", "action_id": "postal_code", "initial_value": f"{ch_data['postal_code']}"},
-            },
-            {
-                "type": "input",
-                "block_id": "edit_address",
-                "label": {"type": "plain_text", "text": "会社住所"},
-                "element": {"type": "plain_text_input", "action_id": "address", "initial_value": f"{ch_data['address']}"},
-            },
-            {
-                "type": "input",
-                "block_id": "edit_email",
-                "label": {"type": "plain_text", "text": "Email"},
-                "element": {"type": "plain_text_input", "action_id": "email", "initial_value": f"{ch_data['email']}"},
-            },
-            {
-                "type": "input",
-                "block_id": "edit_website",
-                "label": {"type": "plain_text", "text": "ウェブサイト"},
-                "element": {"type": "plain_text_input", "action_id": "website", "initial_value": f"{ch_data['website']}"},
-            },
-            {
-                "type": "input",
-                "block_id": "edit_phone",
-                "label": {"type": "plain_text", "text": "電話番号"},
-                "element": {"type": "plain_text_input", "action_id": "phone", "initial_value": f"{ch_data['phone']}"},
-            },
-            {
-                "type": "actions",
-                "elements": [
-                    {
-                        "type": "button",
-                        "text": {"type": "plain_text", "text": "変更を保存"},
-                        "style": "primary",
-                        "action_id": "save_changes"
-                    }
-                ],
-            },
-        ]
-        say(blocks=editBlocks, text="変更したい項目を選んでください")
+        say(blocks=build_edit_blocks(ch_data), text="変更したい項目を選んでください")
     except Exception as e:
         logging.exception(f"edit_text ハンドラーでエラーが発生: {e}")
         try:
@@ -291,71 +221,19 @@ def handle_edit_text(ack, body, say):
             logging.exception(f"エラーメッセージの送信にも失敗: {say_error}")
 
 @app.action("save_changes")
-def handle_save_changes(ack, body, say):
+def handle_save_changes(ack, body, say, client):
     try:
         ack()
-        channel_id = _get_channel_id_from_action_body(body)
-        ch_data = _get_scan_data(channel_id)
-        changes = []
+        channel_id = get_channel_id_from_action_body(body)
+        ch_data = state.get_scan_data(channel_id)
         state_values = body.get("state", {}).get("values", {})
         if not state_values:
             logging.warning("state.values が空です")
             say("❌ フォームデータが取得できませんでした。もう一度お試しください。")
             return
-        for block in state_values:
-            block_data = state_values[block]
-            for key, value in block_data.items():
-                display_key = ""
-                new_value = value.get("value", "")
-                if key == "name":
-                    display_key = "名前"
-                    ch_data["name"] = new_value
-                elif key == "company":
-                    display_key = "会社名"
-                    ch_data["company"] = new_value
-                elif key == "postal_code":
-                    display_key = "郵便番号"
-                    ch_data["postal_code"] = new_value
-                elif key == "address":
-                    display_key = "会社住所"
-                    ch_data["address"] = new_value
-                elif key == "email":
-                    display_key = "Email"
-                    ch_data["email"] = new_value
-                elif key == "website":
-                    display_key = "ウェブサイト"
-                    ch_data["website"] = new_value
-                elif key == "phone":
-                    display_key = "電話番号"
-                    ch_data["phone"] = new_value
-                if display_key:
-                    changes.append(f"{display_key}: {new_value}")
-                    logging.info(f"{display_key} を {new_value} に更新")
+        apply_form_changes(ch_data, state_values)
         # 変更後の内容でシートへ追記（編集のたびに履歴が残る運用）
-        user_id = body.get("user", {}).get("id") or body.get("user", "")
-        user_label = user_id
-        try:
-            if user_id:
-                prof = app.client.users_info(user=user_id).get("user", {}).get("profile", {})
-                display = prof.get("display_name") or prof.get("real_name")
-                if display:
-                    user_label = f"{display} ({user_id})"
-        except Exception:
-            pass
-        try:
-            append_record_to_sheet(ch_data, slack_user_label=user_label)
-            say("スプレッドシートにも追記しました。")
-        except Exception as e:
-            logging.exception("Sheets への保存に失敗しました")
-            say(f"保存に失敗しました: {e}")
-
-        if not ch_data.get('email'):
-            say("メールアドレスが読み取れなかったため、Gmail作成リンクを生成できません。")
-            # 次のファイルへ
-            return
-
-        send_mail_link(ch_data, say)
-
+        _save_record(ch_data, body, client, say, "スプレッドシートにも追記しました。")
     except Exception as e:
         logging.exception(f"save_changes ハンドラーでエラーが発生: {e}")
         try:
@@ -364,55 +242,58 @@ def handle_save_changes(ack, body, say):
             logging.exception(f"エラーメッセージの送信にも失敗: {say_error}")
 
     finally:
-        # 5) 必ず初期化（return ルートでも確実に実行）
-        channel_id = _get_channel_id_from_action_body(body)
-        _clear_scan_data(channel_id)
-        # 次のファイルへ（processed を進める）
-        channel_progress.setdefault(channel_id, {"processed": 0, "total": 0})
-        channel_progress[channel_id]["processed"] += 1
-        _process_next_file_for_channel(channel_id, say)
+        # 5) 必ず初期化（return ルートでも確実に実行）し、次のファイルへ（processed を進める）
+        channel_id = get_channel_id_from_action_body(body)
+        finish_card(channel_id)
+        _schedule_next_file(channel_id, say, get_team_id(body))
 
 @app.action("cancel_text")
 def handle_cancel_text(ack, body, say):
     try:
         ack()
-        channel_id = _get_channel_id_from_action_body(body)
-        _clear_scan_data(channel_id)
         say("変更がキャンセルされました。")
     except Exception as e:
         logging.exception(f"cancel_text ハンドラーでエラーが発生: {e}")
     finally:
-        channel_id = _get_channel_id_from_action_body(body)
-        channel_progress.setdefault(channel_id, {"processed": 0, "total": 0})
-        channel_progress[channel_id]["processed"] += 1
-        _process_next_file_for_channel(channel_id, say)
+        channel_id = get_channel_id_from_action_body(body)
+        finish_card(channel_id)
+        _schedule_next_file(channel_id, say, get_team_id(body))
 
 @app.event("message")
-def handle_message_events(body, say, context):
+def handle_message_events(body, say, context, client):
     event = body.get("event", {})
     if "files" in event:
-        channel_id = _get_channel_id_from_event_body(body)
+        channel_id = get_channel_id_from_event_body(body)
+        team_id = get_team_id(body)
+        # 再送（同じ event_id）や受付済みのファイルは積まない
+        files = dedup.new_files(body)
+        if not files:
+            return
         bot_token = context.get("bot_token") or os.environ.get("SLACK_BOT_TOKEN")
         if not bot_token:
-            say("内部設定エラー（Bot token 未設定）。インストール設定を確認してください。")
+            dedup.forget(body, files)
+            say(BOT_TOKEN_MISSING_MESSAGE)
             return
 
-        # キューへ投入
-        q = channel_queues.get(channel_id)
-        if q is None:
-            q = deque()
-            channel_queues[channel_id] = q
-
-        # 進捗 total を加算
-        channel_progress.setdefault(channel_id, {"processed": 0, "total": 0})
-        channel_progress[channel_id]["total"] += len(event.get("files", []))
-
-        for f in event.get("files", []):
-            q.append(f)
-            # token を保持
-            channel_tokens[channel_id] = bot_token
-            # 進行中でなければ最初の1件だけ処理開始
-            if not channel_processing.get(channel_id):
-                _process_next_file_for_channel(channel_id, say)
+        # 再起動しても失わないよう先に記録してから、キューへ投入（進捗 total の加算と token の保持もまとめて）
+        try:
+            journal.record_queued(channel_id, team_id, files, bot_token)
+            state.enqueue_files(channel_id, files, bot_token)
+        except Exception:
+            # 積めなかったファイルは受付済みにしない（Slack の再送で受け付け直す）
+            dedup.forget(body, files)
+            raise
+        if metrics.enabled():
+            queue_stats.set_depth(channel_id, state.queue_length(channel_id))
+        # 保存時に使う投稿者のプロフィールを先読み
+        prefetch_user(client, team_id, event.get("user", ""))
+
+        # 進行中でなければ最初の1件だけ処理開始（ワーカーに積んで即 ack）
+        if state.try_claim(channel_id):
+            _schedule_next_file(channel_id, say, team_id)
     else:
         logging.info("通常メッセージ: " + event.get("text", "（テキストなし）"))
+
+@app.event("user_change")
+def handle_user_change(event):
+    refresh_from_user_change(event)
@@ -0,0 +1,206 @@
+"""スキャンのジョブを DB に先書きし、再起動（クラッシュ・デプロイ）後に続きから再開する。
+
+1ファイル1行で、待ち行列に積む前に queued、取り出したら active、解析結果を表示したら review にし、
+ボタン操作やスキップでレビューを終えたら削除する。解析結果（result）も残すので、
+再起動後に Gemini を呼び直さない。
+
+起動時の recover で、持ち主のいない行（終了時に手放された行・一定時間更新のない行）を引き取り、
+待ち行列に戻してレビュー待ちのメッセージを投稿し直す。SCAN_JOURNAL=true で有効。
+"""
+import json
+import logging
+import os
+import time
+from sqlalchemy import (
+    MetaData, Table, Column, Integer, String, Text, Float,
+    select, update, delete, insert, func, or_, and_,
+)
+from slackApp.prefetch import file_key
+from slackApp.state import process_owner as _owner
+
+QUEUED, ACTIVE, REVIEW = "queued", "active", "review"
+
+metadata = MetaData()
+
+job_table = Table(
+    "scan_jobs",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel_id", String(32), nullable=False, index=True),
+    Column("file_key", String(255), nullable=False, index=True),
+    Column("team_id", String(32)),
+    Column("file_json", Text, nullable=False),
+    Column("bot_token", Text),
+    Column("status", String(16), nullable=False),
+    Column("result", Text),      # 解析結果（Gemini の応答を正規化したもの）
+    Column("review", Text),      # レビュー中の読み取り結果と表示位置・メッセージ
+    Column("position", Float, nullable=False),   # 待ち行列での順番
+    Column("owner", String(128)),                # 処理中のプロセス（手放したら NULL）
+    Column("updated_at", Float, nullable=False),
+)
+
+
+def create_tables(engine):
+    metadata.create_all(engine, checkfirst=True)
+
+
+class RecoveredChannel:
+    """recover で引き取ったチャンネルの未完了ジョブ。"""
+
+    def __init__(self, channel_id: str, rows: list):
+        self.channel_id = channel_id
+        self.team_id = next((r.team_id for r in rows if r.team_id), "")
+        self.bot_token = next((r.bot_token for r in rows if r.bot_token), None)
+        self.review = None       # {"scan_data", "idx", "total", "channel", "ts"}
+        self.review_file = None  # レビュー待ちだったファイル
+        self.in_flight = []      # 取り出し済みで結果を表示する前だったファイル
+        self.queued = []         # 待ち行列にあったファイル
+        for r in rows:
+            f = json.loads(r.file_json)
+            if r.result and "parsed_card" not in f:
+                # 解析済みなら結果を持たせて戻す（scan_file が Gemini を呼ばずに返す）
+                f["parsed_card"] = json.loads(r.result)
+            if r.status == REVIEW and r.review and self.review is None:
+                self.review = json.loads(r.review)
+                self.review_file = f
+            elif r.status == QUEUED:
+                self.queued.append(f)
+            else:
+                self.in_flight.append(f)
+
+
+class JobJournal:
+    """engine が None なら何もしない（SCAN_JOURNAL 無効時）。"""
+
+    def __init__(self, engine=None):
+        self.engine = engine
+        if engine is not None:
+            create_tables(engine)
+
+    @property
+    def enabled(self) -> bool:
+        return self.engine is not None
+
+    def record_queued(self, channel_id: str, team_id: str, files: list, bot_token: str | None, front: bool = False):
+        """待ち行列に積む前に記録する。front=True なら先頭に積む分（複数名刺の2枚目以降）。"""
+        if not self.enabled or not files:
+            return
+        t = job_table
+        now = time.time()
+        with self.engine.begin() as conn:
+            if front:
+                # 今ある最小の position より前に並べる（state.push_front と同じ順）
+                lowest = conn.execute(select(func.min(t.c.position)).where(t.c.channel_id == channel_id)).scalar()
+                positions = [(lowest if lowest is not None else now) - len(files) + i for i in range(len(files))]
+            else:
+                positions = [now + i * 1e-6 for i in range(len(files))]
+            conn.execute(insert(t), [
+                {"channel_id": channel_id, "file_key": file_key(f), "team_id": team_id or None,
+                 "file_json": json.dumps(f, ensure_ascii=False), "bot_token": bot_token, "status": QUEUED,
+                 "position": position, "owner": _owner(), "updated_at": now}
+                for f, position in zip(files, positions)
+            ])
+
+    def _update(self, channel_id: str, f: dict, **values):
+        t = job_table
+        with self.engine.begin() as conn:
+            conn.execute(
+                update(t).where(t.c.channel_id == channel_id, t.c.file_key == file_key(f))
+                .values(owner=_owner(), updated_at=time.time(), **values)
+            )
+
+    def mark_active(self, channel_id: str, f: dict):
+        if self.enabled:
+            self._update(channel_id, f, status=ACTIVE)
+
+    def save_result(self, f: dict, parsed):
+        """解析結果を残す（先読みで解析した分も含む）。file_key は Slack のファイル ID なのでチャンネルは問わない。"""
+        if not self.enabled or parsed is None:
+            return
+        t = job_table
+        with self.engine.begin() as conn:
+            conn.execute(
+                update(t).where(t.c.file_key == file_key(f))
+                .values(result=json.dumps(parsed, ensure_ascii=False), updated_at=time.time())
+            )
+
+    def mark_review(self, channel_id: str, f: dict, scan_data: dict, idx: int, total: int, message=None):
+        """結果メッセージを表示した。message（StatusMessage）があれば、再投稿時に古いボタンを消すため ts を残す。"""
+        if not self.enabled:
+            return
+        review = {"scan_data": scan_data, "idx": idx, "total": total,
+                  "channel": getattr(message, "channel", None), "ts": getattr(message, "ts", None)}
+        self._update(channel_id, f, status=REVIEW, review=json.dumps(review, ensure_ascii=False))
+
+    def done(self, channel_id: str, f: dict):
+        """スキップ・失敗で終えた1件を消す。"""
+        if not self.enabled:
+            return
+        t = job_table
+        with self.engine.begin() as conn:
+            conn.execute(delete(t).where(t.c.channel_id == channel_id, t.c.file_key == file_key(f)))
+
+    def finish(self, channel_id: str):
+        """ボタン操作でレビューを終えた1件を消す。"""
+        if not self.enabled:
+            return
+        t = job_table
+        with self.engine.begin() as conn:
+            conn.execute(delete(t).where(t.c.channel_id == channel_id, t.c.status == REVIEW))
+
+    def release(self):
+        """終了時に、このプロセスの行を手放す（次に起動したプロセスがすぐ引き取れる）。"""
+        if not self.enabled:
+            return
+        t = job_table
+        with self.engine.begin() as conn:
+            conn.execute(update(t).where(t.c.owner == _owner()).values(owner=None))
+
+    def claim_orphans(self, stale_seconds: float, durable_state: bool) -> list:
+        """持ち主のいない行をチャンネルごとに引き取り、RecoveredChannel のリストを返す。
+
+        引き取るのは、終了時に手放された行（owner が NULL）と、他のプロセスの行で stale_seconds 以上
+        更新のないもの（落ちたプロセスの行）だけ。Heroku の preboot や重なったローリング再起動で
+        まだ動いている前のプロセスの行は取らない（同じ名刺を二重に処理・投稿しないように）。
+        durable_state=False（SCAN_STATE_BACKEND=memory）: 待ち行列もレビュー待ちもプロセス内にしかないので全ての状態を引き取る。
+        durable_state=True（sql）: 待ち行列とレビュー中の結果は DB に残り、結果メッセージのボタンもどのプロセスでも
+        処理できる。取り出したまま結果を表示できなかった active の行だけを引き取る。"""
+        if not self.enabled:
+            return []
+        t = job_table
+        me = _owner()
+        statuses = (ACTIVE,) if durable_state else (QUEUED, ACTIVE, REVIEW)
+        orphan = or_(t.c.owner.is_(None), and_(t.c.owner != me, t.c.updated_at < time.time() - stale_seconds))
+        with self.engine.connect() as conn:
+            channels = [r.channel_id for r in conn.execute(
+                select(t.c.channel_id).where(orphan, t.c.status.in_(statuses)).distinct()
+            )]
+        recovered = []
+        for channel_id in channels:
+            with self.engine.begin() as conn:
+                # 同時に起動した他のプロセスと取り合っても、UPDATE が通った側だけが引き取る
+                claimed = conn.execute(
+                    update(t).where(t.c.channel_id == channel_id, t.c.status.in_(statuses), orphan)
+                    .values(owner=me, updated_at=time.time())
+                ).rowcount
+                if not claimed:
+                    continue
+                rows = conn.execute(
+                    select(t).where(t.c.channel_id == channel_id, t.c.owner == me, t.c.status.in_(statuses))
+                    .order_by(t.c.position, t.c.id)
+                ).all()
+                # 待ち行列に戻す分はまた queued として扱う（レビュー中の1件はそのまま）
+                conn.execute(
+                    update(t).where(t.c.channel_id == channel_id, t.c.owner == me, t.c.status == ACTIVE)
+                    .values(status=QUEUED)
+                )
+            recovered.append(RecoveredChannel(channel_id, rows))
+        return recovered
+
+
+def create_job_journal() -> JobJournal:
+    if os.environ.get("SCAN_JOURNAL", "").lower() not in ("1", "true", "yes"):
+        return JobJournal()
+    from config.database import get_engine
+    logging.info("スキャンのジョブを DB に記録します（SCAN_JOURNAL=true）")
+    return JobJournal(get_engine())
@@ -1,53 +1,245 @@
 from slack_bolt.oauth.oauth_settings import OAuthSettings
+from slack_bolt.oauth.async_oauth_settings import AsyncOAuthSettings
+from slack_sdk.oauth.installation_store import InstallationStore
+from slack_sdk.oauth.installation_store.async_installation_store import AsyncInstallationStore
 from slack_sdk.oauth.installation_store.sqlalchemy import SQLAlchemyInstallationStore
+from slack_sdk.oauth.state_store.async_state_store import AsyncOAuthStateStore
 from slack_sdk.oauth.state_store.sqlalchemy import SQLAlchemyOAuthStateStore
-from sqlalchemy import create_engine
+from config.database import get_engine
+from config import metrics
+import asyncio
 import os
 import logging
+import threading
+import time
+from collections import OrderedDict
 
-def create_oauth_settings():
-    database_url = os.environ.get("DATABASE_URL")
-    try:
-        engine = create_engine(
-            database_url,
-            pool_size=5,
-            max_overflow=10,
-            pool_timeout=30,
-            pool_recycle=1800,
-            pool_pre_ping=True,
-            connect_args={
-                "connect_timeout": 30,
-                "keepalives_idle": 120,
-                "keepalives_interval": 30,
-                "keepalives_count": 3,
-            }
-        )
-        with engine.connect():
-            logging.info("データベース接続テスト成功")
-    except Exception as e:
-        logging.exception(f"データベース接続エラー: {e}")
-        raise
+SCOPES = [
+    "chat:write",
+    "files:read",
+    "im:history",
+    "im:read",
+    "users:read",
+]
+
+_MISSING = object()
+
+
+class CachedInstallationStore(InstallationStore):
+    """InstallationStore の前段に置く TTL 付きの LRU キャッシュ。
+
+    Bolt はイベント・アクションのたびに authorize で find_installation / find_bot を呼ぶため、
+    一度引いたワークスペースは TTL の間 DB に問い合わせずに返す。max_entries を超えたら最も古いものから捨てる。
+    見つからなかった結果（None）はキャッシュしない（インストール直後に別のプロセスで引いても見つかるように）。
+    save / delete（新規インストール、tokens_revoked / app_uninstalled）で該当ワークスペースの分を捨てる。
+
+    キャッシュはプロセスごと。save / delete を処理したのと別のワーカープロセスは、
+    TTL が切れるまで古いトークン（再インストール前・アンインストール後）を使い続けることがある。
+    """
+
+    def __init__(self, store: InstallationStore, ttl_seconds: float = 300, max_entries: int = 1000):
+        self._store = store
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._items = OrderedDict()   # (kind, enterprise_id, team_id, user_id, is_enterprise_install) -> (stored_at, value)
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    @property
+    def logger(self):
+        return self._store.logger
+
+    def hit_rate(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+    def lookup(self, key, count_miss: bool = True):
+        """キャッシュにあれば値、なければ _MISSING を返す。"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or time.monotonic() - item[0] > self.ttl_seconds:
+                self._items.pop(key, None)
+                if count_miss:
+                    self.stats["misses"] += 1
+                return _MISSING
+            self._items.move_to_end(key)
+            self.stats["hits"] += 1
+            return item[1]
+
+    def remember(self, key, value):
+        if value is None:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def invalidate(self, enterprise_id=None, team_id=None):
+        """ワークスペース（Enterprise Grid なら org 全体）のキャッシュを捨てる。"""
+        with self._lock:
+            stale = [
+                k for k in self._items
+                if k[1] == enterprise_id and (team_id is None or k[2] is None or k[2] == team_id)
+            ]
+            for k in stale:
+                del self._items[k]
+            self.stats["invalidations"] += len(stale)
+
+    @staticmethod
+    def bot_key(enterprise_id=None, team_id=None, is_enterprise_install=False):
+        return ("bot", enterprise_id, team_id, None, bool(is_enterprise_install))
+
+    @staticmethod
+    def installation_key(enterprise_id=None, team_id=None, user_id=None, is_enterprise_install=False):
+        return ("installation", enterprise_id, team_id, user_id, bool(is_enterprise_install))
+
+    def save(self, installation):
+        self._store.save(installation)
+        self.invalidate(installation.enterprise_id, installation.team_id)
+
+    def save_bot(self, bot):
+        self._store.save_bot(bot)
+        self.invalidate(bot.enterprise_id, bot.team_id)
+
+    def find_bot(self, *, enterprise_id, team_id, is_enterprise_install=False):
+        key = self.bot_key(enterprise_id, team_id, is_enterprise_install)
+        value = self.lookup(key)
+        if value is _MISSING:
+            value = self._store.find_bot(
+                enterprise_id=enterprise_id, team_id=team_id, is_enterprise_install=is_enterprise_install,
+            )
+            self.remember(key, value)
+        return value
+
+    def find_installation(self, *, enterprise_id, team_id, user_id=None, is_enterprise_install=False):
+        key = self.installation_key(enterprise_id, team_id, user_id, is_enterprise_install)
+        value = self.lookup(key)
+        if value is _MISSING:
+            value = self._store.find_installation(
+                enterprise_id=enterprise_id, team_id=team_id, user_id=user_id,
+                is_enterprise_install=is_enterprise_install,
+            )
+            self.remember(key, value)
+        return value
+
+    def delete_bot(self, *, enterprise_id, team_id):
+        self._store.delete_bot(enterprise_id=enterprise_id, team_id=team_id)
+        self.invalidate(enterprise_id, team_id)
+
+    def delete_installation(self, *, enterprise_id, team_id, user_id=None):
+        self._store.delete_installation(enterprise_id=enterprise_id, team_id=team_id, user_id=user_id)
+        self.invalidate(enterprise_id, team_id)
+
+    def delete_all(self, *, enterprise_id, team_id):
+        self._store.delete_all(enterprise_id=enterprise_id, team_id=team_id)
+        self.invalidate(enterprise_id, team_id)
+
+
+def create_stores():
+    engine = get_engine()
 
     installation_store = SQLAlchemyInstallationStore(
         client_id=os.environ["SLACK_CLIENT_ID"],
         engine=engine,
         logger=logging.getLogger(__name__),
     )
+    # INSTALLATION_CACHE_TTL=0 でキャッシュなし
+    cache_ttl = float(os.environ.get("INSTALLATION_CACHE_TTL", "300"))
+    if cache_ttl > 0:
+        installation_store = CachedInstallationStore(
+            installation_store, ttl_seconds=cache_ttl,
+            max_entries=int(os.environ.get("INSTALLATION_CACHE_SIZE", "1000")),
+        )
+        cache = installation_store
+        metrics.register_snapshot(
+            "installation_cache", lambda: dict(cache.stats, hit_rate=cache.hit_rate()),
+            "インストール情報キャッシュ", counters=("hits", "misses", "invalidations"),
+        )
     state_store = SQLAlchemyOAuthStateStore(
         engine=engine,
         expiration_seconds=600,
         logger=logging.getLogger(__name__),
     )
+    return installation_store, state_store
+
+def create_oauth_settings():
+    installation_store, state_store = create_stores()
 
     return OAuthSettings(
         client_id=os.environ["SLACK_CLIENT_ID"],
         client_secret=os.environ["SLACK_CLIENT_SECRET"],
-        scopes=[
-            "chat:write",
-            "files:read",
-            "im:history",
-            "im:read",
-        ],
+        scopes=SCOPES,
         installation_store=installation_store,
         state_store=state_store,
     )
+
+
+class ThreadedInstallationStore(AsyncInstallationStore):
+    """同期の InstallationStore を AsyncApp から使うためのラッパー（DB アクセスはスレッドで実行）。"""
+
+    def __init__(self, store):
+        self._store = store
+
+    @property
+    def logger(self):
+        return self._store.logger
+
+    async def async_save(self, installation):
+        await asyncio.to_thread(self._store.save, installation)
+
+    async def async_save_bot(self, bot):
+        await asyncio.to_thread(self._store.save_bot, bot)
+
+    async def async_find_bot(self, **kwargs):
+        # キャッシュに載っていればスレッドに回さずその場で返す
+        if isinstance(self._store, CachedInstallationStore):
+            value = self._store.lookup(CachedInstallationStore.bot_key(**kwargs), count_miss=False)
+            if value is not _MISSING:
+                return value
+        return await asyncio.to_thread(self._store.find_bot, **kwargs)
+
+    async def async_find_installation(self, **kwargs):
+        if isinstance(self._store, CachedInstallationStore):
+            value = self._store.lookup(CachedInstallationStore.installation_key(**kwargs), count_miss=False)
+            if value is not _MISSING:
+                return value
+        return await asyncio.to_thread(self._store.find_installation, **kwargs)
+
+    async def async_delete_bot(self, **kwargs):
+        await asyncio.to_thread(self._store.delete_bot, **kwargs)
+
+    async def async_delete_installation(self, **kwargs):
+        await asyncio.to_thread(self._store.delete_installation, **kwargs)
+
+    async def async_delete_all(self, **kwargs):
+        await asyncio.to_thread(self._store.delete_all, **kwargs)
+
+
+class ThreadedOAuthStateStore(AsyncOAuthStateStore):
+    """同期の OAuthStateStore を AsyncApp から使うためのラッパー。"""
+
+    def __init__(self, store):
+        self._store = store
+
+    @property
+    def logger(self):
+        return self._store.logger
+
+    async def async_issue(self, *args, **kwargs):
+        return await asyncio.to_thread(self._store.issue, *args, **kwargs)
+
+    async def async_consume(self, state):
+        return await asyncio.to_thread(self._store.consume, state)
+
+
+def create_async_oauth_settings():
+    installation_store, state_store = create_stores()
+
+    return AsyncOAuthSettings(
+        client_id=os.environ["SLACK_CLIENT_ID"],
+        client_secret=os.environ["SLACK_CLIENT_SECRET"],
+        scopes=SCOPES,
+        installation_store=ThreadedInstallationStore(installation_store),
+        state_store=ThreadedOAuthStateStore(state_store),
+    )
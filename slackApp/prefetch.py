@@ -0,0 +1,233 @@
+"""キュー先読み（look-ahead）。
+
+ユーザーが現在の名刺を確認している間に、キューの先頭から N 件を並列に
+ダウンロード・解析してバッファしておく。レビュー順はキューの順序のままで、
+ここは結果を先に用意しておくだけ。
+batch_fn を渡すと、まだ投入していないファイルを batch_size 件ずつまとめて解析する
+（Gemini の呼び出しを1回にまとめる）。先読みの範囲を depth + batch_size - 1 件に広げ、
+batch_size 件に満たない端数は、待ち行列の末尾まで見えているときを除いて次の schedule まで持ち越す。
+
+take は先読みの結果を timeout 秒まで待ち、間に合わなければその場で処理し直す。取り出されないまま
+max_age 秒経った結果（SCAN_STATE_BACKEND=sql で他のプロセスが取り出したファイルなど）は schedule のたびに捨てる。
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from config.logging import job_context
+
+
+def file_key(slack_file: dict) -> str:
+    return slack_file.get("id") or slack_file.get("url_private_download") or slack_file.get("url_private") or str(id(slack_file))
+
+
+def _plan_batches(new: list, current_key, batch_size: int, at_end: bool) -> list:
+    """未投入の (key, file) を batch_size 件ずつに分ける。
+    最後の端数は、current（今すぐ必要な1件）を含むか待ち行列の末尾まで見えている場合だけ投入し、
+    それ以外は後続が積み上がるまで持ち越す（1枚ずつの呼び出しにしない）。"""
+    groups = [new[i:i + batch_size] for i in range(0, len(new), batch_size)]
+    if groups and len(groups[-1]) < batch_size and not at_end and all(key != current_key for key, _ in groups[-1]):
+        groups.pop()
+    return groups
+
+
+def _evict_stale(entries: dict, max_age: float) -> int:
+    """投入から max_age 秒経って終わっている先読みを捨て、捨てた件数を返す（まだ走っているものは残す）。"""
+    now = time.monotonic()
+    stale = [key for key, (fut, at) in entries.items() if fut.done() and now - at > max_age]
+    for key in stale:
+        del entries[key]
+    if stale:
+        logging.info(f"取り出されなかった先読み結果を {len(stale)} 件捨てました")
+    return len(stale)
+
+
+class Prefetcher:
+    def __init__(self, scan_fn, depth: int = 3, max_workers: int = 4, batch_fn=None, batch_size: int = 1,
+                 timeout: float = 120, max_age: float = 1800):
+        self._scan_fn = scan_fn          # (slack_file, bot_token) -> 結果
+        self._batch_fn = batch_fn        # ([slack_file, ...], bot_token) -> [結果, ...]
+        self.depth = depth
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scan-prefetch") if depth > 0 else None
+        self._lock = threading.Lock()
+        self._futures = {}               # (channel_id, file_key) -> (Future, 投入時刻)
+
+    @property
+    def enabled(self) -> bool:
+        return self._executor is not None
+
+    @property
+    def batching(self) -> bool:
+        return self.enabled and self._batch_fn is not None and self.batch_size > 1
+
+    @property
+    def lookahead(self) -> int:
+        """schedule に渡す待ち行列の先頭からの件数。まとめる場合は batch_size 件の新規が揃うよう広げる。"""
+        return self.depth + self.batch_size - 1 if self.batching else self.depth
+
+    def schedule(self, channel_id: str, upcoming_files, bot_token: str, current: dict | None = None):
+        """upcoming_files（キュー先頭から lookahead 件）を先読み対象として投入（投入済みは無視）。
+        まとめて解析する場合は、current（今から処理する1件）も同じバッチに入れる。"""
+        if not self.enabled:
+            return
+        upcoming = list(upcoming_files)
+        files = upcoming[: self.lookahead]
+        if current is not None and self.batching:
+            files.insert(0, current)
+        with self._lock:
+            _evict_stale(self._futures, self.max_age)
+            now = time.monotonic()
+            new = []
+            for f in files:
+                key = (channel_id, file_key(f))
+                if key not in self._futures:
+                    new.append((key, f))
+            if not self.batching:
+                for key, f in new:
+                    ctx = job_context(file_id=key[1])
+                    self._futures[key] = (self._executor.submit(ctx.run, self._scan_fn, f, bot_token), now)
+                return
+            current_key = (channel_id, file_key(current)) if current is not None else None
+            for group in _plan_batches(new, current_key, self.batch_size, len(upcoming) < self.lookahead):
+                futures = []
+                for key, _ in group:
+                    fut = Future()
+                    self._futures[key] = (fut, now)
+                    futures.append(fut)
+                ctx = job_context(file_id=",".join(key[1] for key, _ in group))
+                self._executor.submit(ctx.run, self._run_batch, [f for _, f in group], futures, bot_token)
+
+    def _run_batch(self, files, futures, bot_token):
+        try:
+            results = self._batch_fn(files, bot_token)
+        except Exception as e:
+            for fut in futures:
+                fut.set_exception(e)
+            return
+        for fut, result in zip(futures, results):
+            fut.set_result(result)
+
+    def take(self, channel_id: str, slack_file: dict, bot_token: str):
+        """先読み結果を取り出す。未投入・timeout 秒で終わらない・まとめた解析が失敗、ならその場で処理する。"""
+        with self._lock:
+            fut, _ = self._futures.pop((channel_id, file_key(slack_file)), (None, None))
+        if fut is None:
+            return self._scan_fn(slack_file, bot_token)
+        try:
+            return fut.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            logging.warning(f"先読みの解析が {self.timeout:g} 秒で終わらないため、この1件を解析し直します")
+            return self._scan_fn(slack_file, bot_token)
+        except Exception:
+            logging.exception("先読みの解析に失敗、この1件を解析し直します")
+            return self._scan_fn(slack_file, bot_token)
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+def create_prefetcher(scan_fn, batch_fn=None) -> Prefetcher:
+    return Prefetcher(
+        scan_fn,
+        depth=int(os.environ.get("PREFETCH_DEPTH", "3")),
+        max_workers=int(os.environ.get("PREFETCH_WORKERS", "4")),
+        batch_fn=batch_fn,
+        batch_size=int(os.environ.get("PARSE_BATCH_SIZE", "4")),
+        timeout=float(os.environ.get("PREFETCH_TIMEOUT", "120")),
+        max_age=float(os.environ.get("PREFETCH_MAX_AGE", "1800")),
+    )
+
+
+class AsyncPrefetcher:
+    """Prefetcher の asyncio 版。scan_fn / batch_fn はコルーチン関数で、先読みはタスクとして走らせる。"""
+
+    def __init__(self, scan_fn, depth: int = 3, batch_fn=None, batch_size: int = 1,
+                 timeout: float = 120, max_age: float = 1800):
+        self._scan_fn = scan_fn
+        self._batch_fn = batch_fn
+        self.depth = depth
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self._tasks = {}                 # (channel_id, file_key) -> (asyncio.Task / Future, 投入時刻)
+        self._batch_tasks = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.depth > 0
+
+    @property
+    def batching(self) -> bool:
+        return self.enabled and self._batch_fn is not None and self.batch_size > 1
+
+    @property
+    def lookahead(self) -> int:
+        """schedule に渡す待ち行列の先頭からの件数。まとめる場合は batch_size 件の新規が揃うよう広げる。"""
+        return self.depth + self.batch_size - 1 if self.batching else self.depth
+
+    def schedule(self, channel_id: str, upcoming_files, bot_token: str, current: dict | None = None):
+        loop = asyncio.get_running_loop()
+        upcoming = list(upcoming_files)
+        files = upcoming[: self.lookahead]
+        if current is not None and self.batching:
+            files.insert(0, current)
+        _evict_stale(self._tasks, self.max_age)
+        now = time.monotonic()
+        new = [(key, f) for key, f in (((channel_id, file_key(f)), f) for f in files) if key not in self._tasks]
+        if not self.batching:
+            for key, f in new:
+                # タスクは作成時のコンテキストを写すので、先読みするファイルの file_id を付けて作る
+                self._tasks[key] = (job_context(file_id=key[1]).run(loop.create_task, self._scan_fn(f, bot_token)), now)
+            return
+        current_key = (channel_id, file_key(current)) if current is not None else None
+        for group in _plan_batches(new, current_key, self.batch_size, len(upcoming) < self.lookahead):
+            futures = []
+            for key, _ in group:
+                fut = loop.create_future()
+                self._tasks[key] = (fut, now)
+                futures.append(fut)
+            ctx = job_context(file_id=",".join(key[1] for key, _ in group))
+            task = ctx.run(loop.create_task, self._run_batch([f for _, f in group], futures, bot_token))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, files, futures, bot_token):
+        try:
+            results = await self._batch_fn(files, bot_token)
+        except Exception as e:
+            for fut in futures:
+                fut.set_exception(e)
+            return
+        for fut, result in zip(futures, results):
+            fut.set_result(result)
+
+    async def take(self, channel_id: str, slack_file: dict, bot_token: str):
+        task, _ = self._tasks.pop((channel_id, file_key(slack_file)), (None, None))
+        if task is None:
+            return await self._scan_fn(slack_file, bot_token)
+        try:
+            # まとめた解析の Future を取り消さないよう shield して待つ
+            return await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"先読みの解析が {self.timeout:g} 秒で終わらないため、この1件を解析し直します")
+            return await self._scan_fn(slack_file, bot_token)
+        except Exception:
+            logging.exception("先読みの解析に失敗、この1件を解析し直します")
+            return await self._scan_fn(slack_file, bot_token)
+
+
+def create_async_prefetcher(scan_fn, batch_fn=None) -> AsyncPrefetcher:
+    return AsyncPrefetcher(
+        scan_fn,
+        depth=int(os.environ.get("PREFETCH_DEPTH", "3")),
+        batch_fn=batch_fn,
+        batch_size=int(os.environ.get("PARSE_BATCH_SIZE", "4")),
+        timeout=float(os.environ.get("PREFETCH_TIMEOUT", "120")),
+        max_age=float(os.environ.get("PREFETCH_MAX_AGE", "1800")),
+    )
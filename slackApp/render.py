@@ -0,0 +1,164 @@
+"""読み取り結果メッセージの組み立て。
+
+1枚の名刺につき投稿は1回だけにし、進捗 → 結果（またはスキップ・失敗の通知）は
+同じメッセージを chat.update で書き換えて表示する。
+"""
+import logging
+from config import metrics
+from helpers.gmail import gmail_compose_url_PC, gmail_compose_url_mobile
+
+# 表示順のラベル
+FIELD_LABELS = [
+    ("name", "名前"),
+    ("company", "会社名"),
+    ("postal_code", "郵便番号"),
+    ("address", "会社住所"),
+    ("email", "Email"),
+    ("website", "ウェブサイト"),
+    ("phone", "電話番号"),
+]
+
+
+def progress_text(idx: int, total: int) -> str:
+    return f"読み込んでいます...({idx}/{total})"
+
+
+def build_result_blocks(scan_data: dict, idx: int, total: int) -> list:
+    fields = "\n".join(f"*{label}:* {scan_data.get(key, '')}" for key, label in FIELD_LABELS)
+    return [
+        {"type": "section", "text": {"type": "mrkdwn", "text": f"読み取り完了。({idx}/{total})"}},
+        {"type": "section", "text": {"type": "mrkdwn", "text": fields}},
+        {
+            "type": "actions",
+            "elements": [
+                {
+                    "type": "button",
+                    "text": {"type": "plain_text", "text": "保存する"},
+                    "style": "primary",
+                    "action_id": "save_text"
+                },
+                {
+                    "type": "button",
+                    "text": {"type": "plain_text", "text": "変更する"},
+                    "action_id": "edit_text"
+                },
+                {
+                    "type": "button",
+                    "text": {"type": "plain_text", "text": "キャンセル"},
+                    "action_id": "cancel_text"
+                },
+            ],
+        },
+    ]
+
+
+def result_fallback_text(scan_data: dict) -> str:
+    """通知やブロック非対応クライアント向けの text。"""
+    return "読み取り完了。" + " / ".join(f"{label}: {scan_data.get(key, '')}" for key, label in FIELD_LABELS)
+
+
+def build_edit_blocks(scan_data: dict) -> list:
+    blocks = [
+        {
+            "type": "input",
+            "block_id": f"edit_{key}",
+            "label": {"type": "plain_text", "text": label},
+            "element": {"type": "plain_text_input", "action_id": key, "initial_value": f"{scan_data[key]}"},
+        }
+        for key, label in FIELD_LABELS
+    ]
+    blocks.append({
+        "type": "actions",
+        "elements": [
+            {
+                "type": "button",
+                "text": {"type": "plain_text", "text": "変更を保存"},
+                "style": "primary",
+                "action_id": "save_changes"
+            }
+        ],
+    })
+    return blocks
+
+
+def mail_link_message(scanData: dict) -> dict:
+    """Gmail 作成ボタンのメッセージ（say にそのまま渡す kwargs）。"""
+    display_name = scanData.get('name', '')
+    body_template = (
+            f"こんにちは、{display_name}さん。\n"
+            f"会社名: {scanData['company']}\n"
+            f"郵便番号: {scanData['postal_code']}\n"
+            f"会社住所: {scanData['address']}\n"
+            f"Email: {scanData['email']}\n"
+            f"ウェブサイト: {scanData['website']}\n"
+            f"電話番号: {scanData['phone']}"
+    )
+    url_mobile = gmail_compose_url_mobile(
+        to=scanData["email"],
+        subject=f"{display_name}さんの名刺情報",
+        body=body_template,
+    )
+    url_PC = gmail_compose_url_PC(
+        to=scanData["email"],
+        subject=f"{display_name}さんの名刺情報",
+        body=body_template,
+    )
+    return dict(
+        blocks=[
+            {"type": "section", "text": {"type": "mrkdwn", "text": "保存した内容をもとにGmailを送信:"}},
+            {"type": "actions", "elements": [
+                {"type": "button", "style": "primary", "text": {"type": "plain_text", "text": "メールを作成(モバイル)"}, "url": url_mobile}
+            ]},
+            {"type": "actions", "elements": [
+                {"type": "button", "style": "primary", "text": {"type": "plain_text", "text": "メールを作成(PC)"}, "url": url_PC}
+            ]},
+        ],
+        text=f"Gmail作成リンク: {url_mobile}",
+    )
+
+
+class StatusMessage:
+    """最初の show で投稿し、以降の show は同じメッセージを chat.update で書き換える。"""
+
+    def __init__(self, say):
+        self._say = say
+        self.channel = None
+        self.ts = None
+
+    def show(self, text: str, blocks: list | None = None):
+        if self.ts is None:
+            with metrics.stage("slack_post"):
+                resp = self._say(text=text, blocks=blocks)
+            self.channel, self.ts = resp.get("channel"), resp.get("ts")
+            return
+        try:
+            with metrics.stage("slack_update"):
+                self._say.client.chat_update(channel=self.channel, ts=self.ts, text=text, blocks=blocks or [])
+        except Exception:
+            # 更新できなければ新規投稿にフォールバック
+            logging.exception("メッセージの更新に失敗したため新規投稿します")
+            self.ts = None
+            self.show(text, blocks)
+
+
+class AsyncStatusMessage:
+    """StatusMessage の asyncio 版（AsyncSay を受け取る）。"""
+
+    def __init__(self, say):
+        self._say = say
+        self.channel = None
+        self.ts = None
+
+    async def show(self, text: str, blocks: list | None = None):
+        if self.ts is None:
+            with metrics.stage("slack_post"):
+                resp = await self._say(text=text, blocks=blocks)
+            self.channel, self.ts = resp.get("channel"), resp.get("ts")
+            return
+        try:
+            with metrics.stage("slack_update"):
+                await self._say.client.chat_update(channel=self.channel, ts=self.ts, text=text, blocks=blocks or [])
+        except Exception:
+            logging.exception("メッセージの更新に失敗したため新規投稿します")
+            self.ts = None
+            await self.show(text, blocks)
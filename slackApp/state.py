@@ -0,0 +1,396 @@
+"""チャンネルごとの処理状態（待ち行列・処理中フラグ・進捗・読み取り結果）の保存先。
+
+メモリ（1プロセス用）と SQL（複数プロセス・再起動をまたいで共有）の2種類。
+SCAN_STATE_BACKEND=sql で SQL 版を使う。
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
+from sqlalchemy import (
+    MetaData, Table, Column, Integer, String, Text, Float, Boolean,
+    select, update, delete, insert, func, inspect, text, or_, and_,
+)
+from sqlalchemy.exc import IntegrityError
+
+# 旧 scanData の後継（チャンネル単位で使うテンプレート）
+SCAN_DATA_TEMPLATE = {
+    "name": "",       # 表示用・保存用の名前（単一）
+    "company": "",
+    "postal_code": "",
+    "address": "",
+    "email": "",
+    "website": "",
+    "phone": "",
+}
+
+
+_instance = (None, "")   # (pid, owner)
+
+
+def process_owner() -> str:
+    """このプロセスの識別子。コンテナの再起動で pid とホスト名が同じでも別物になるよう乱数を付ける。"""
+    global _instance
+    # fork 後は pid が変わるので作り直す
+    if _instance[0] != os.getpid():
+        _instance = (os.getpid(), f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}")
+    return _instance[1]
+
+
+class StateStore(ABC):
+    # 再起動しても待ち行列・読み取り結果が残るか（ジョブの再開で使う）
+    durable = False
+
+    @abstractmethod
+    def enqueue_files(self, channel_id: str, files: list, bot_token: str):
+        """ファイルを待ち行列の末尾に積み、進捗の total を加算し、token を保持する。
+        取り出したファイルには待ち時間の計測用に enqueued_at（UNIX 秒）が付く。"""
+
+    @abstractmethod
+    def push_front(self, channel_id: str, files: list):
+        """ファイルを待ち行列の先頭に（files の順で）積み、進捗の total を加算する。"""
+
+    @abstractmethod
+    def pop_file(self, channel_id: str) -> dict | None:
+        """先頭の1件を取り出す。複数プロセスから同時に呼んでも同じ1件を二重に取り出さない。"""
+
+    @abstractmethod
+    def peek_files(self, channel_id: str, limit: int) -> list:
+        """先頭から limit 件を取り出さずに返す（先読み用）。"""
+
+    @abstractmethod
+    def queue_length(self, channel_id: str) -> int: ...
+
+    @abstractmethod
+    def try_claim(self, channel_id: str) -> bool:
+        """処理中でなければ処理中にして True。既に処理中なら False（他のワーカーが担当中）。"""
+
+    @abstractmethod
+    def release(self, channel_id: str):
+        """処理中フラグを下ろし、進捗をリセットする（待ち行列が空になったとき）。"""
+
+    @abstractmethod
+    def get_token(self, channel_id: str) -> str | None: ...
+
+    @abstractmethod
+    def get_progress(self, channel_id: str) -> dict:
+        """{"processed": int, "total": int}"""
+
+    @abstractmethod
+    def advance_progress(self, channel_id: str):
+        """processed を1進める（取り出した1件を終えたことにする）。"""
+
+    def await_review(self, channel_id: str):
+        """結果を表示してボタン待ちになった。処理権はどのプロセスのボタン操作でも進められるので、
+        プロセスの持ち物ではなくなる（SQL 版でリースの対象から外す）。"""
+
+    @abstractmethod
+    def get_scan_data(self, channel_id: str) -> dict:
+        """現在レビュー中の読み取り結果のコピー。"""
+
+    @abstractmethod
+    def set_scan_data(self, channel_id: str, data: dict): ...
+
+    def clear_scan_data(self, channel_id: str):
+        self.set_scan_data(channel_id, dict(SCAN_DATA_TEMPLATE))
+
+
+class MemoryStateStore(StateStore):
+    """プロセス内の dict に持つ。Web ワーカーが1プロセスのときだけ使える。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = {}      # channel_id -> deque([file_obj, ...])
+        self._processing = {}  # channel_id -> bool (処理中か)
+        self._tokens = {}      # channel_id -> bot_token（ファイル取得に使用）
+        self._progress = {}    # channel_id -> {"processed": int, "total": int}
+        self._scan_data = {}   # channel_id -> dict(scanData)
+
+    def enqueue_files(self, channel_id, files, bot_token):
+        now = time.time()
+        with self._lock:
+            self._queues.setdefault(channel_id, deque()).extend(dict(f, enqueued_at=now) for f in files)
+            prog = self._progress.setdefault(channel_id, {"processed": 0, "total": 0})
+            prog["total"] += len(files)
+            self._tokens[channel_id] = bot_token
+
+    def push_front(self, channel_id, files):
+        now = time.time()
+        with self._lock:
+            self._queues.setdefault(channel_id, deque()).extendleft(dict(f, enqueued_at=now) for f in reversed(files))
+            prog = self._progress.setdefault(channel_id, {"processed": 0, "total": 0})
+            prog["total"] += len(files)
+
+    def pop_file(self, channel_id):
+        with self._lock:
+            q = self._queues.get(channel_id)
+            return q.popleft() if q else None
+
+    def peek_files(self, channel_id, limit):
+        with self._lock:
+            return list(self._queues.get(channel_id, ()))[:limit]
+
+    def queue_length(self, channel_id):
+        with self._lock:
+            return len(self._queues.get(channel_id, ()))
+
+    def try_claim(self, channel_id):
+        with self._lock:
+            if self._processing.get(channel_id):
+                return False
+            self._processing[channel_id] = True
+            return True
+
+    def release(self, channel_id):
+        with self._lock:
+            self._processing[channel_id] = False
+            self._progress[channel_id] = {"processed": 0, "total": 0}
+
+    def get_token(self, channel_id):
+        with self._lock:
+            return self._tokens.get(channel_id)
+
+    def get_progress(self, channel_id):
+        with self._lock:
+            return dict(self._progress.get(channel_id, {"processed": 0, "total": 0}))
+
+    def advance_progress(self, channel_id):
+        with self._lock:
+            prog = self._progress.setdefault(channel_id, {"processed": 0, "total": 0})
+            prog["processed"] += 1
+
+    def get_scan_data(self, channel_id):
+        with self._lock:
+            return dict(self._scan_data.get(channel_id) or SCAN_DATA_TEMPLATE)
+
+    def set_scan_data(self, channel_id, data):
+        with self._lock:
+            self._scan_data[channel_id] = dict(data)
+
+
+metadata = MetaData()
+
+queue_table = Table(
+    "scan_queue",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel_id", String(32), nullable=False, index=True),
+    Column("file_json", Text, nullable=False),
+    Column("enqueued_at", Float, nullable=False),
+)
+
+channel_table = Table(
+    "scan_channels",
+    metadata,
+    Column("channel_id", String(32), primary_key=True),
+    Column("processing", Boolean, nullable=False, default=False),
+    Column("bot_token", Text),
+    Column("processed", Integer, nullable=False, default=0),
+    Column("total", Integer, nullable=False, default=0),
+    Column("scan_data", Text),
+    Column("owner", String(128)),   # 処理権を持つプロセス（ボタン待ちの間は NULL）
+    Column("in_flight", Text),      # 取り出して結果を表示する前の1件（処理中に落ちたら待ち行列に戻す）
+    Column("updated_at", Float),    # 処理中は取り出し・進捗のたびに更新され、リースの起点になる
+)
+
+
+# push_front で他のプロセスと id が衝突したときに取り直す回数
+PUSH_FRONT_RETRIES = 5
+
+
+def create_tables(engine):
+    metadata.create_all(engine, checkfirst=True)
+    # 以前の版で作った scan_channels に後から足した列を追加する
+    existing = {c["name"] for c in inspect(engine).get_columns(channel_table.name)}
+    missing = [c for c in ("owner", "in_flight") if c not in existing]
+    if missing:
+        with engine.begin() as conn:
+            for name in missing:
+                col = channel_table.c[name]
+                conn.execute(text(f"ALTER TABLE {channel_table.name} ADD COLUMN {name} {col.type.compile(engine.dialect)}"))
+
+
+class SQLStateStore(StateStore):
+    """DATABASE_URL の DB に持つ。複数プロセス・複数 dyno で状態を共有できる。"""
+
+    durable = True
+
+    def __init__(self, engine, lease_seconds: float = 600):
+        self.engine = engine
+        # 処理中のまま lease_seconds 以上更新のないチャンネルは、持ち主のプロセスが落ちたものとみなして引き取る
+        self.lease_seconds = lease_seconds
+        create_tables(engine)
+
+    def _ensure_channel(self, conn, channel_id):
+        exists = conn.execute(
+            select(channel_table.c.channel_id).where(channel_table.c.channel_id == channel_id)
+        ).first()
+        if exists:
+            return
+        try:
+            with conn.begin_nested():
+                conn.execute(insert(channel_table).values(
+                    channel_id=channel_id, processing=False, processed=0, total=0, updated_at=time.time()
+                ))
+        except IntegrityError:
+            # 他のプロセスが先に作った
+            pass
+
+    def _update_channel(self, conn, channel_id, **values):
+        self._ensure_channel(conn, channel_id)
+        return conn.execute(
+            update(channel_table).where(channel_table.c.channel_id == channel_id).values(updated_at=time.time(), **values)
+        )
+
+    def enqueue_files(self, channel_id, files, bot_token):
+        now = time.time()
+        with self.engine.begin() as conn:
+            if files:
+                conn.execute(insert(queue_table), [
+                    {"channel_id": channel_id, "file_json": json.dumps(dict(f, enqueued_at=now), ensure_ascii=False), "enqueued_at": now}
+                    for f in files
+                ])
+            self._update_channel(conn, channel_id, bot_token=bot_token, total=channel_table.c.total + len(files))
+
+    @staticmethod
+    def _insert_front(conn, channel_id, files_json: list, now: float):
+        # 取り出しは id 順なので、今ある最小の id より小さい id を振って先頭に入れる
+        lowest = conn.execute(select(func.min(queue_table.c.id))).scalar()
+        start = (lowest if lowest is not None else 1) - len(files_json)
+        conn.execute(insert(queue_table), [
+            {"id": start + i, "channel_id": channel_id, "file_json": file_json, "enqueued_at": now}
+            for i, file_json in enumerate(files_json)
+        ])
+
+    def push_front(self, channel_id, files):
+        if not files:
+            return
+        now = time.time()
+        for attempt in range(PUSH_FRONT_RETRIES):
+            try:
+                with self.engine.begin() as conn:
+                    self._insert_front(conn, channel_id, [
+                        json.dumps(dict(f, enqueued_at=now), ensure_ascii=False) for f in files
+                    ], now)
+                    self._update_channel(conn, channel_id, total=channel_table.c.total + len(files))
+                return
+            except IntegrityError:
+                # 他のプロセスと id が衝突した
+                if attempt == PUSH_FRONT_RETRIES - 1:
+                    raise
+
+    def pop_file(self, channel_id):
+        t = queue_table
+        while True:
+            with self.engine.begin() as conn:
+                row = conn.execute(
+                    select(t.c.id, t.c.file_json)
+                    .where(t.c.channel_id == channel_id)
+                    .order_by(t.c.id)
+                    .limit(1)
+                    .with_for_update(skip_locked=True)
+                ).first()
+                if row is None:
+                    return None
+                # SQLite など FOR UPDATE が効かない DB でも、削除できた側だけが取り出したことにする
+                if conn.execute(delete(t).where(t.c.id == row.id)).rowcount == 1:
+                    # 結果を表示するまでは in_flight に残す（updated_at がリースの起点になる）
+                    self._update_channel(conn, channel_id, owner=process_owner(), in_flight=row.file_json)
+                    return json.loads(row.file_json)
+
+    def peek_files(self, channel_id, limit):
+        t = queue_table
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(t.c.file_json).where(t.c.channel_id == channel_id).order_by(t.c.id).limit(limit)
+            ).all()
+        return [json.loads(r.file_json) for r in rows]
+
+    def queue_length(self, channel_id):
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(func.count()).select_from(queue_table).where(queue_table.c.channel_id == channel_id)
+            ).scalar()
+
+    def try_claim(self, channel_id):
+        """処理中でなければ処理権を取る。処理中でも、持ち主のプロセスが lease_seconds 以上更新していなければ
+        落ちたものとみなして引き取り、取り出したまま終えていなかった1件を待ち行列の先頭に戻す。"""
+        c = channel_table.c
+        for attempt in range(PUSH_FRONT_RETRIES):
+            now = time.time()
+            try:
+                with self.engine.begin() as conn:
+                    self._ensure_channel(conn, channel_id)
+                    prev = conn.execute(select(c.processing, c.owner, c.in_flight).where(c.channel_id == channel_id)).first()
+                    claimable = or_(
+                        c.processing == False,  # noqa: E712
+                        and_(c.owner.isnot(None), c.updated_at < now - self.lease_seconds),
+                    )
+                    result = conn.execute(
+                        update(channel_table).where(c.channel_id == channel_id, claimable)
+                        .values(processing=True, owner=process_owner(), in_flight=None, updated_at=now)
+                    )
+                    if result.rowcount != 1:
+                        return False
+                    if prev.processing:
+                        logging.warning(f"処理中のまま止まっていたチャンネルを引き取りました（前の持ち主: {prev.owner}）")
+                        if prev.in_flight:
+                            self._insert_front(conn, channel_id, [prev.in_flight], now)
+                    return True
+            except IntegrityError:
+                # 戻した1件の id が他のプロセスと衝突した
+                if attempt == PUSH_FRONT_RETRIES - 1:
+                    raise
+
+    def release(self, channel_id):
+        with self.engine.begin() as conn:
+            self._update_channel(conn, channel_id, processing=False, owner=None, in_flight=None, processed=0, total=0)
+
+    def await_review(self, channel_id):
+        with self.engine.begin() as conn:
+            self._update_channel(conn, channel_id, owner=None, in_flight=None)
+
+    def _channel_row(self, channel_id):
+        with self.engine.connect() as conn:
+            return conn.execute(select(channel_table).where(channel_table.c.channel_id == channel_id)).first()
+
+    def get_token(self, channel_id):
+        row = self._channel_row(channel_id)
+        return row.bot_token if row else None
+
+    def get_progress(self, channel_id):
+        row = self._channel_row(channel_id)
+        if row is None:
+            return {"processed": 0, "total": 0}
+        return {"processed": row.processed, "total": row.total}
+
+    def advance_progress(self, channel_id):
+        # 進めたプロセスが次の1件を処理する（ボタン操作なら、それを受けたプロセスが処理権を持つ）
+        with self.engine.begin() as conn:
+            self._update_channel(
+                conn, channel_id, processed=channel_table.c.processed + 1, owner=process_owner(), in_flight=None,
+            )
+
+    def get_scan_data(self, channel_id):
+        row = self._channel_row(channel_id)
+        if row is None or not row.scan_data:
+            return dict(SCAN_DATA_TEMPLATE)
+        return {**SCAN_DATA_TEMPLATE, **json.loads(row.scan_data)}
+
+    def set_scan_data(self, channel_id, data):
+        with self.engine.begin() as conn:
+            self._update_channel(conn, channel_id, scan_data=json.dumps(data, ensure_ascii=False))
+
+
+def create_state_store() -> StateStore:
+    backend = os.environ.get("SCAN_STATE_BACKEND", "memory")
+    if backend == "sql":
+        from config.database import get_engine
+        logging.info("チャンネル状態を DB に保存します（SCAN_STATE_BACKEND=sql）")
+        return SQLStateStore(get_engine(), lease_seconds=float(os.environ.get("SCAN_CLAIM_LEASE_SECONDS", "600")))
+    return MemoryStateStore()
@@ -0,0 +1,128 @@
+"""シートに記録するユーザー表記用の Slack プロフィールキャッシュ。
+
+保存のたびに users.info を呼ばないよう、(team_id, user_id) ごとにプロフィールを TTL 付きで保持する。
+ファイル投稿時に投稿者のプロフィールを先読みし、user_change イベントで最新化する。
+"""
+import os
+import asyncio
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from config import metrics
+
+
+class UserProfileCache:
+    def __init__(self, ttl_seconds: float = 3600, max_entries: int = 1000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._items = OrderedDict()   # (team_id, user_id) -> (stored_at, profile)
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, team_id: str, user_id: str) -> dict | None:
+        key = (team_id, user_id)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or time.monotonic() - item[0] > self.ttl_seconds:
+                self._items.pop(key, None)
+                self.stats["misses"] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats["hits"] += 1
+            return item[1]
+
+    def set(self, team_id: str, user_id: str, profile: dict):
+        key = (team_id, user_id)
+        with self._lock:
+            self._items[key] = (time.monotonic(), profile)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+
+profile_cache = UserProfileCache(
+    ttl_seconds=float(os.environ.get("USER_PROFILE_CACHE_TTL", "3600")),
+    max_entries=int(os.environ.get("USER_PROFILE_CACHE_SIZE", "1000")),
+)
+metrics.register_snapshot(
+    "user_profile_cache", lambda: dict(profile_cache.stats), "Slack プロフィールキャッシュ", counters=("hits", "misses"),
+)
+_prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="user-prefetch")
+
+
+def user_label_from_profile(user_id: str, profile: dict) -> str:
+    # Slackユーザ表記（display_name があれば優先）
+    display = profile.get("display_name") or profile.get("real_name")
+    if display:
+        return f"{display} ({user_id})"
+    return user_id
+
+
+def _fetch_profile(client, team_id: str, user_id: str) -> dict:
+    profile = client.users_info(user=user_id).get("user", {}).get("profile", {})
+    profile_cache.set(team_id, user_id, profile)
+    return profile
+
+
+def get_user_label(client, team_id: str, user_id: str) -> str:
+    if not user_id:
+        return user_id
+    profile = profile_cache.get(team_id, user_id)
+    if profile is None:
+        try:
+            profile = _fetch_profile(client, team_id, user_id)
+        except Exception as e:
+            logging.warning(f"ユーザー情報の取得に失敗: {user_id}: {e}")
+            return user_id
+    return user_label_from_profile(user_id, profile)
+
+
+async def get_user_label_async(client, team_id: str, user_id: str) -> str:
+    """get_user_label の asyncio 版（client は AsyncWebClient）。"""
+    if not user_id:
+        return user_id
+    profile = profile_cache.get(team_id, user_id)
+    if profile is None:
+        try:
+            resp = await client.users_info(user=user_id)
+            profile = resp.get("user", {}).get("profile", {})
+            profile_cache.set(team_id, user_id, profile)
+        except Exception as e:
+            logging.warning(f"ユーザー情報の取得に失敗: {user_id}: {e}")
+            return user_id
+    return user_label_from_profile(user_id, profile)
+
+
+def prefetch_user(client, team_id: str, user_id: str):
+    """未キャッシュならバックグラウンドでプロフィールを取得しておく（保存時に待たない）。"""
+    if not user_id or profile_cache.get(team_id, user_id) is not None:
+        return
+
+    def fetch():
+        try:
+            _fetch_profile(client, team_id, user_id)
+        except Exception as e:
+            logging.debug(f"ユーザー情報の先読みに失敗: {user_id}: {e}")
+
+    _prefetch_executor.submit(fetch)
+
+
+_prefetch_tasks = set()
+
+
+def prefetch_user_async(client, team_id: str, user_id: str):
+    """prefetch_user の asyncio 版。"""
+    if not user_id or profile_cache.get(team_id, user_id) is not None:
+        return
+    task = asyncio.get_running_loop().create_task(get_user_label_async(client, team_id, user_id))
+    _prefetch_tasks.add(task)
+    task.add_done_callback(_prefetch_tasks.discard)
+
+
+def refresh_from_user_change(event: dict):
+    """user_change イベントのユーザー情報でキャッシュを更新する。"""
+    user = event.get("user", {})
+    if user.get("id") and user.get("team_id"):
+        profile_cache.set(user["team_id"], user["id"], user.get("profile", {}))
@@ -1,68 +1,233 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
 import requests
-from helpers.gmail import gmail_compose_url_PC, gmail_compose_url_mobile
+from requests.adapters import HTTPAdapter
+from slackApp.render import mail_link_message
+from config import metrics
 IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp", ".heic", ".heif", ".tif", ".tiff")
+IMAGE_FILETYPES = frozenset(ext.lstrip(".") for ext in IMAGE_EXTS)
 
-def fetch_slack_private_file(url_private: str, bot_token: str) -> bytes:
-    headers = {"Authorization": f"Bearer {bot_token}"}
-    resp = requests.get(url_private, headers=headers, timeout=30)
-    resp.raise_for_status()
-    return resp.content
+# HEIF 系コンテナ（ftyp ボックス）のうち画像として扱うブランド
+HEIF_BRANDS = frozenset((b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1", b"avif"))
+# BMP の DIB ヘッダ（オフセット 14 のサイズ）として有効な値: CORE / INFO / V2 / V3 / V4 / V5
+BMP_DIB_HEADER_SIZES = frozenset((12, 40, 52, 56, 108, 124))
+# 判定に必要な先頭バイト数（BMP の DIB ヘッダサイズまで読む）
+SNIFF_BYTES = 18
 
-def is_probably_image(slack_file: dict, bot_token: str) -> bool:
+# 巨大な TIFF などを途中で打ち切る上限
+MAX_DOWNLOAD_BYTES = int(os.environ.get("MAX_DOWNLOAD_BYTES", str(20 * 1024 * 1024)))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_POOL_SIZE = int(os.environ.get("DOWNLOAD_POOL_SIZE", "8"))
+_MAX_SESSIONS = 64
+
+
+class FileTooLargeError(ValueError):
+    pass
+
+
+class NotAnImageError(ValueError):
+    pass
+
+
+def sniff_image_type(head: bytes) -> str | None:
+    """先頭バイトのシグネチャから画像形式を返す。画像でなければ None。"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp" and head[8:12] in HEIF_BRANDS:
+        return "heic"
+    if head.startswith((b"II*\x00", b"MM\x00*")):
+        return "tiff"
+    # "BM" だけでは文字列で始まるテキストも通るので、予約領域（6〜9）が 0 で DIB ヘッダサイズが既知のものに限る
+    if (head[:2] == b"BM" and head[6:10] == b"\0\0\0\0"
+            and int.from_bytes(head[14:18], "little") in BMP_DIB_HEADER_SIZES):
+        return "bmp"
+    return None
+
+
+class DownloadStats:
+    """ダウンロードの件数・バイト数・所要時間の累計。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.failures = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def record(self, nbytes: int, seconds: float, ok: bool):
+        with self._lock:
+            self.count += 1
+            self.failures += 0 if ok else 1
+            self.bytes += nbytes
+            self.seconds += seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"count": self.count, "failures": self.failures, "bytes": self.bytes, "seconds": self.seconds}
+
+
+download_stats = DownloadStats()
+metrics.register_snapshot(
+    "download", download_stats.snapshot, "Slack からのファイル取得の累計",
+    counters=("count", "failures", "bytes", "seconds"),
+)
+
+# bot token ごとに keep-alive の接続プールを持つ Session を使い回す
+_sessions = OrderedDict()   # bot_token -> requests.Session
+_sessions_lock = threading.Lock()
+
+
+def _session_for(bot_token: str) -> requests.Session:
+    with _sessions_lock:
+        session = _sessions.get(bot_token)
+        if session is not None:
+            _sessions.move_to_end(bot_token)
+            return session
+        session = requests.Session()
+        session.headers["Authorization"] = f"Bearer {bot_token}"
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=DOWNLOAD_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _sessions[bot_token] = session
+        while len(_sessions) > _MAX_SESSIONS:
+            # 他のスレッドがダウンロード中かもしれないので close せず、参照が切れたら GC に任せる
+            _sessions.popitem(last=False)
+        return session
+
+
+class _HeadSniffer:
+    """チャンクの先頭 SNIFF_BYTES バイトがそろった時点で画像かどうかを判定する。"""
+
+    def __init__(self):
+        self._head = b""
+        self.done = False
+
+    def feed(self, chunk: bytes):
+        if self.done:
+            return
+        self._head += chunk[:SNIFF_BYTES - len(self._head)]
+        if len(self._head) >= SNIFF_BYTES:
+            self.finish()
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+        if sniff_image_type(self._head) is None:
+            raise NotAnImageError(f"not an image: {self._head[:SNIFF_BYTES]!r}")
+
+
+def iter_slack_private_file(url_private: str, bot_token: str, max_bytes: int = MAX_DOWNLOAD_BYTES,
+                            chunk_size: int = DOWNLOAD_CHUNK_SIZE, require_image: bool = False):
+    """ファイルをチャンクごとに返す。max_bytes を超えた時点で FileTooLargeError。
+    require_image=True なら先頭バイトが画像のシグネチャでない時点で NotAnImageError（残りは読まない）。"""
+    start = time.perf_counter()
+    received = 0
+    ok = False
+    sniffer = _HeadSniffer() if require_image else None
+    try:
+        with _session_for(bot_token).get(url_private, stream=True, timeout=(10, 30)) as resp:
+            resp.raise_for_status()
+            length = resp.headers.get("Content-Length")
+            if length and length.isdigit() and int(length) > max_bytes:
+                raise FileTooLargeError(f"file too large: {length} bytes (max {max_bytes})")
+            for chunk in resp.iter_content(chunk_size):
+                received += len(chunk)
+                if received > max_bytes:
+                    raise FileTooLargeError(f"file too large: over {max_bytes} bytes")
+                if sniffer is not None:
+                    sniffer.feed(chunk)
+                yield chunk
+            if sniffer is not None:
+                sniffer.finish()
+        ok = True
+    finally:
+        elapsed = time.perf_counter() - start
+        download_stats.record(received, elapsed, ok)
+        metrics.observe_stage("fetch_slack_private_file", elapsed, ok)
+        logging.debug(f"ダウンロード{'完了' if ok else '中断'}: {received} bytes, {elapsed * 1000:.0f}ms")
+
+
+def fetch_slack_private_file(url_private: str, bot_token: str, max_bytes: int = MAX_DOWNLOAD_BYTES,
+                             require_image: bool = False) -> bytes:
+    return b"".join(iter_slack_private_file(url_private, bot_token, max_bytes, require_image=require_image))
+
+
+_async_sessions = OrderedDict()   # (event loop, bot_token) -> aiohttp.ClientSession
+# 追い出したセッションを閉じるまでの秒数（ClientTimeout の total より長くし、使用中のリクエストを待つ）
+_ASYNC_CLOSE_DELAY = 60
+
+
+async def fetch_slack_private_file_async(url_private: str, bot_token: str, max_bytes: int = MAX_DOWNLOAD_BYTES,
+                                         require_image: bool = False) -> bytes:
+    """fetch_slack_private_file の asyncio 版（aiohttp は asyncio モードでのみ必要）。"""
+    import asyncio
+    import aiohttp
+    loop = asyncio.get_running_loop()
+    key = (loop, bot_token)
+    session = _async_sessions.get(key)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            headers={"Authorization": f"Bearer {bot_token}"},
+            timeout=aiohttp.ClientTimeout(total=30),
+            connector=aiohttp.TCPConnector(limit_per_host=DOWNLOAD_POOL_SIZE),
+        )
+        _async_sessions[key] = session
+        while len(_async_sessions) > _MAX_SESSIONS:
+            (old_loop, _), old = _async_sessions.popitem(last=False)
+            # 使用中のリクエストが終わる（タイムアウトする）まで待ってから閉じる
+            if old_loop is loop:
+                loop.call_later(_ASYNC_CLOSE_DELAY, lambda old=old: asyncio.ensure_future(old.close()))
+    _async_sessions.move_to_end(key)
+
+    start = time.perf_counter()
+    chunks, received, ok = [], 0, False
+    sniffer = _HeadSniffer() if require_image else None
+    try:
+        async with session.get(url_private) as resp:
+            resp.raise_for_status()
+            if resp.content_length and resp.content_length > max_bytes:
+                raise FileTooLargeError(f"file too large: {resp.content_length} bytes (max {max_bytes})")
+            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                received += len(chunk)
+                if received > max_bytes:
+                    raise FileTooLargeError(f"file too large: over {max_bytes} bytes")
+                if sniffer is not None:
+                    sniffer.feed(chunk)
+                chunks.append(chunk)
+            if sniffer is not None:
+                sniffer.finish()
+        ok = True
+        return b"".join(chunks)
+    finally:
+        elapsed = time.perf_counter() - start
+        download_stats.record(received, elapsed, ok)
+        metrics.observe_stage("fetch_slack_private_file", elapsed, ok)
+
+@metrics.timed("is_probably_image")
+def is_probably_image(slack_file: dict) -> bool:
+    """Slack のファイル情報（mimetype / 名前 / filetype）だけで画像か判定する（通信なし）。
+    False でも画像の可能性はあるので、その場合はダウンロードの先頭バイトで判定する
+    （fetch_slack_private_file(..., require_image=True)）。"""
     mt = (slack_file.get("mimetype") or "").lower()
     if mt.startswith("image/"):
         return True
 
     name = (slack_file.get("name") or "").lower()
-    if any(name.endswith(ext) for ext in IMAGE_EXTS):
+    if name.endswith(IMAGE_EXTS):
         return True
 
     ft = (slack_file.get("filetype") or "").lower()
-    if ft in [ext.lstrip(".") for ext in IMAGE_EXTS]:
-        return True
-
-    try:
-        url = slack_file.get("url_private") or slack_file.get("url_private_download")
-        if url:
-            headers = {"Authorization": f"Bearer {bot_token}"}
-            r = requests.head(url, headers=headers, timeout=10)
-            ct = (r.headers.get("Content-Type") or "").lower()
-            if ct.startswith("image/"):
-                return True
-    except Exception:
-        pass
-    return False
+    return ft in IMAGE_FILETYPES
 
 def send_mail_link(scanData, say):
-    display_name = scanData.get('name', '')
-    body_template = (
-            f"こんにちは、{display_name}さん。\n"
-            f"会社名: {scanData['company']}\n"
-            f"郵便番号: {scanData['postal_code']}\n"
-            f"会社住所: {scanData['address']}\n"
-            f"Email: {scanData['email']}\n"
-            f"ウェブサイト: {scanData['website']}\n"
-            f"電話番号: {scanData['phone']}"
-    )
-    url_mobile = gmail_compose_url_mobile(
-        to=scanData["email"],
-        subject=f"{display_name}さんの名刺情報",
-        body=body_template,
-    )
-    url_PC = gmail_compose_url_PC(
-        to=scanData["email"],
-        subject=f"{display_name}さんの名刺情報",
-        body=body_template,
-    )
-    say(
-        blocks=[
-            {"type": "section", "text": {"type": "mrkdwn", "text": "保存した内容をもとにGmailを送信:"}},
-            {"type": "actions", "elements": [
-                {"type": "button", "style": "primary", "text": {"type": "plain_text", "text": "メールを作成(モバイル)"}, "url": url_mobile}
-            ]},
-            {"type": "actions", "elements": [
-                {"type": "button", "style": "primary", "text": {"type": "plain_text", "text": "メールを作成(PC)"}, "url": url_PC}
-            ]},
-        ],
-        text=f"Gmail作成リンク: {url_mobile}",
-    )
\ No newline at end of file
+    say(**mail_link_message(scanData))
@@ -0,0 +1,155 @@
+"""名刺スキャンのジョブ実行基盤。
+
+Slack のイベントハンドラはジョブを積むだけで即座に ack し、
+取得 → 判定 → 解析 → 投稿 はここのワーカーで実行する。
+同じチャンネルのジョブは投入順に1件ずつ、チャンネルをまたいでは並列に処理する。
+"""
+import asyncio
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config.logging import bind_log_context, job_context, new_job_id
+
+
+class InlineExecutor:
+    """submit されたジョブをその場で実行するバックエンド（テスト・デバッグ用）。"""
+
+    def submit(self, fn, *args, **kwargs):
+        fn(*args, **kwargs)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class ChannelWorkerPool:
+    """チャンネル単位で順序を保証するワーカープール。
+
+    同時に動くワーカー数は max_workers で上限を設ける。
+    1チャンネルにつき同時に走るのは1ワーカーだけなので、
+    同じチャンネルのジョブが追い越すことはない。
+    """
+
+    def __init__(self, max_workers: int = 4, backend: str = "thread"):
+        if backend == "inline":
+            self._executor = InlineExecutor()
+        else:
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="scan-worker"
+            )
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = {}   # channel_id -> deque([(fn, args, kwargs), ...])
+        self._active = set()  # ワーカーが割り当て済みの channel_id
+        self._closed = False
+        self._running = threading.local()   # このスレッドで実行中のジョブの channel_id
+
+    def submit(self, channel_id: str, fn, *args, **kwargs) -> bool:
+        """ジョブを積む。シャットダウン後は False を返して破棄する。
+        ただし実行中のジョブが自分のチャンネルに積み直す分は受け付ける（shutdown はそれも処理し切るまで待つ）。"""
+        with self._lock:
+            if self._closed and getattr(self._running, "channel_id", None) != channel_id:
+                logging.warning(f"シャットダウン中のためジョブを破棄: channel={channel_id}")
+                return False
+            # ログの相関 ID（呼び出し元の team_id などと、channel_id・job_id）をジョブに引き継ぐ
+            ctx = job_context(channel_id=channel_id, job_id=new_job_id())
+            self._pending.setdefault(channel_id, deque()).append((ctx, fn, args, kwargs))
+            if channel_id in self._active:
+                return True
+            self._active.add(channel_id)
+        self._executor.submit(self._drain, channel_id)
+        return True
+
+    def _drain(self, channel_id: str):
+        while True:
+            with self._lock:
+                q = self._pending.get(channel_id)
+                if not q:
+                    self._pending.pop(channel_id, None)
+                    self._active.discard(channel_id)
+                    self._idle.notify_all()
+                    return
+                ctx, fn, args, kwargs = q.popleft()
+            self._running.channel_id = channel_id
+            try:
+                ctx.run(fn, *args, **kwargs)
+            except Exception as e:
+                logging.exception(f"ジョブ実行でエラー: channel={channel_id}: {e}")
+            finally:
+                self._running.channel_id = None
+            if not isinstance(self._executor, InlineExecutor):
+                # 1ジョブごとにスレッドを手放し、待っている他のチャンネルに順番を回す
+                # （チャンネルは active のままなので順序は崩れない）
+                with self._lock:
+                    more = bool(self._pending.get(channel_id))
+                if more:
+                    self._executor.submit(self._drain, channel_id)
+                    return
+
+    def join(self, timeout: float | None = None) -> bool:
+        """積まれているジョブが全て終わるまで待つ。タイムアウトしたら False。"""
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._active, timeout=timeout)
+
+    def shutdown(self, wait: bool = True, timeout: float | None = None):
+        """新規ジョブの受付を止め、wait=True なら実行中・待機中のジョブを処理し切る。"""
+        with self._lock:
+            self._closed = True
+        if wait and not self.join(timeout):
+            logging.warning("シャットダウン待機がタイムアウトしました（未処理のジョブがあります）")
+            # 持ち時間を超えて実行中のジョブを待たない
+            wait = False
+        self._executor.shutdown(wait=wait)
+
+
+scan_jobs = ChannelWorkerPool(
+    max_workers=int(os.environ.get("SCAN_WORKERS", "4")),
+    backend=os.environ.get("SCAN_JOB_BACKEND", "thread"),
+)
+
+
+class AsyncChannelWorkerPool:
+    """ChannelWorkerPool の asyncio 版。ジョブはコルーチン関数。
+
+    チャンネルごとの asyncio.Lock（取得順は FIFO）で投入順を守り、
+    Semaphore で同時に走るジョブ数を max_workers に抑える。
+    """
+
+    def __init__(self, max_workers: int = 16):
+        self.max_workers = max_workers
+        self._semaphore = None   # イベントループ上で初回に作る
+        self._locks = {}         # channel_id -> [asyncio.Lock, 投入済みで未完了のジョブ数]
+        self._tasks = set()
+
+    def submit(self, channel_id: str, fn, *args, **kwargs):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        entry = self._locks.setdefault(channel_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        lock = entry[0]
+        task = asyncio.get_running_loop().create_task(self._run(channel_id, lock, fn, args, kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, channel_id, lock, fn, args, kwargs):
+        # タスクは作成時のコンテキストのコピーで動くので、ここで足した相関 ID は他に漏れない
+        bind_log_context(channel_id=channel_id, job_id=new_job_id())
+        try:
+            async with lock:
+                async with self._semaphore:
+                    try:
+                        await fn(*args, **kwargs)
+                    except Exception as e:
+                        logging.exception(f"ジョブ実行でエラー: channel={channel_id}: {e}")
+        finally:
+            # 待っているジョブ（まだ lock に届いていないタスクも含む）がなければロックを捨てる
+            entry = self._locks.get(channel_id)
+            if entry is not None and entry[0] is lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[channel_id]
+
+    async def join(self, timeout: float | None = None):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
@@ -0,0 +1,37 @@
+# 本番用 WSGI エントリーポイント（gunicorn -c gunicorn.conf.py wsgi:flask_app）
+from config.logging import setup_logging
+import os
+import time
+import logging
+from dotenv import load_dotenv
+load_dotenv()
+
+log_level = logging.DEBUG if os.environ.get('ENVIRONMENT') == 'development' else logging.INFO
+logger, log_print, safe_log_info = setup_logging(log_level)
+
+# Slack App・OAuth 設定・ハンドラ登録をここで読み込む（gunicorn の preload_app でマスターが1回だけ行う）
+from slackApp.app import flask_app
+
+
+def shutdown(timeout: float = 30):
+    """ワーカー終了時に、処理中・待機中のスキャンとシートへの書き込みを処理し切る。
+    timeout は全体の持ち時間。失うと困るもの（シートへの書き込み・ジョブの手放し）を先に済ませる。"""
+    from slackApp.handlers import prefetcher
+    from slackApp.flow import journal
+    from slackApp.worker import scan_jobs
+    from google.sheets import get_sheet_writer
+
+    deadline = time.monotonic() + timeout
+    remaining = lambda: max(0.0, deadline - time.monotonic())
+    writer = get_sheet_writer()
+    writer.flush(timeout=remaining())
+    # レビュー待ち・待ち行列の残りは、次に起動したプロセスがすぐ引き取れるよう手放す
+    journal.release()
+
+    safe_log_info("シャットダウン: 処理中のスキャンを待機しています")
+    scan_jobs.shutdown(wait=True, timeout=remaining())
+    prefetcher.shutdown(wait=False)
+    # 待っている間に処理したジョブの行（持ち主が付き直る）も手放す
+    journal.release()
+    writer.close(timeout=remaining())
+    safe_log_info("シャットダウン: 完了")